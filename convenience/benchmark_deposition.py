@@ -0,0 +1,47 @@
+#times the SPH deposition of the gas density onto the leaves of the
+#octree of a snapshot: yt's octree deposition against the powderday
+#kernel (DEPOSITION_KERNEL = 'powderday', sph_deposit.deposit) on a
+#range of process counts, and checks that the two agree.
+#
+#usage: python benchmark_deposition.py snapshot [n_ref] [n_processes ...]
+
+from __future__ import print_function
+import sys
+import time
+import numpy as np
+import yt
+
+from powderday.sph_deposit import deposit
+
+fname = sys.argv[1]
+n_ref = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+process_counts = [int(n) for n in sys.argv[3:]] or [1,2,4,8]
+
+ds = yt.load(fname)
+ptype = ds._sph_ptypes[0]
+left = ds.domain_left_edge.in_units('code_length').value
+right = ds.domain_right_edge.in_units('code_length').value
+
+#the octree is built before the clock starts
+octree = ds.octree(left,right,n_ref=n_ref)
+refined = np.asarray(octree['index','refined']).astype(bool)
+leaves = np.array([octree['index',ax][~refined].in_units('code_length').value for ax in ['x','y','z']]).T
+print('%d leaves' % len(leaves))
+
+t1 = time.time()
+yt_density = octree[ptype,'density'].in_units('code_mass/code_length**3').value
+print('yt octree deposit: %.1f s' % (time.time()-t1))
+
+ad = ds.all_data()
+positions = ad[ptype,'particle_position'].in_units('code_length').value
+hsml = ad[ptype,'smoothing_length'].in_units('code_length').value
+mass = ad[ptype,'particle_mass'].in_units('code_mass').value
+
+for n_processes in process_counts:
+    t1 = time.time()
+    density = deposit(leaves,positions,hsml,mass,n_processes)
+    elapsed = time.time()-t1
+
+    filled = yt_density > 0
+    difference = np.abs(density[filled]/yt_density[filled]-1.)
+    print('powderday deposit on %d processes: %.1f s (median / max relative difference from yt: %.2e / %.2e)' % (n_processes,elapsed,np.median(difference),np.max(difference)))
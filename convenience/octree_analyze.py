@@ -3,7 +3,7 @@
 
 from __future__ import print_function
 from hyperion.model import ModelOutput
-from hyperion.grid.yt3_wrappers import find_order
+from powderday.find_order import find_order
 import astropy.units as u
 import numpy as np
 
@@ -13,6 +13,19 @@ zoom_box_len = 50 # kpc; so the box will be +/- zoom_box_len from the center
 bbox_lim = 1.e5 # kpc - this is the initial bounding box of the grid (+/- bbox_lim)
                 # This *must* encompass all of the particles in the
                 # simulation. 
+OCTREE_CACHE = False # If True, the octree of particle-based simulations (and all the fields deposited onto it) is cached on disk,
+                     # keyed on the snapshot contents, n_ref, oref, the bounding box and the dust model, so that reruns of the
+                     # same galaxy skip the octree construction. (Default: False)
+OCTREE_CACHE_DIR = '~/.cache/powderday/octree' # location of the on-disk octree cache (only used if OCTREE_CACHE = True)
+OCTREE_TAU_REFINEMENT = False # If True, the octree of particle-based simulations is adapted to the dust optical depth: optically thin
+                              # cells are merged and optically thick cells are refined (see below). (Default: False)
+TAU_MERGE_THRESHOLD = 1.e-3 # sibling cells are merged when the optical depth across their parent would be below this. (Default: 1.e-3)
+TAU_REFINE_THRESHOLD = 1. # cells with an optical depth across them above this are refined. (Default: 1.)
+TAU_REFINE_MAX_PASSES = 3 # maximum number of extra levels of refinement for optically thick cells. (Default: 3)
+TAU_REFERENCE_WAVELENGTH = 0.551 # micron; wavelength at which the optical depth of the cells is computed (Default: 0.551)
+OCTREE_PRUNE = False # If True, empty subtrees of the octree of particle-based simulations are collapsed before it is handed to hyperion; not with add_DIG_neb or draine21_pah_model (Default: False)
+OCTREE_PRUNE_TOLERANCE = 0. # fraction of the dust mass that pruning may redistribute within its parent cells; 0 only prunes cells without
+                            # any dust, which leaves the SED unchanged (Default: 0.)
 
 #===============================================
 #PARALLELIZATION
@@ -21,6 +34,8 @@ bbox_lim = 1.e5 # kpc - this is the initial bounding box of the grid (+/- bbox_l
 n_processes = 64 # number of pool processes to run for stellar SED generation
 n_MPI_processes = 32 # number of MPI tasks to run. for TORQUE this is
                      # best set as the same as n_processes, while for SLURM this may not be the case.
+DEPOSITION_KERNEL = 'yt' # 'yt' or 'powderday': which code smooths the particles of particle-based simulations onto the octree.
+                         # 'powderday' runs on n_processes processes (Default: 'yt')
 
 #===============================================
 #RT INFORMATION
@@ -124,6 +139,16 @@ pagb = 1 # weight given to post agb stars# 1 is the default
 
 add_agb_dust_model = False    # add circumstellar AGB dust model (100%); Villaume, Conroy & Jonson 2015
 
+SSP_CACHE = False                           # If True, FSPS spectra are cached on disk (keyed on the full FSPS parameter state) so that 
+                                            # reruns of the same snapshot skip the SPS calculation. (Default: False)
+SSP_CACHE_DIR = '~/.cache/powderday/ssp'    # location of the on-disk SSP cache (only used if SSP_CACHE = True)
+SSP_GRID_INTERPOLATION = False              # If True, SEDs of stars without nebular emission/birth clouds/alpha enhancement are interpolated 
+                                            # (in log age) from a precomputed grid of FSPS SSPs instead of one FSPS call per star/bin. (Default: False)
+
+SSP_LIBRARY_FILE = None                     # Path to an SSP library built with pd_ssp_library.py for this parameters file. If set, SSP spectra
+                                            # (and FSPS nebular spectra when use_cloudy_tables = True) are read from the library instead of
+                                            # being generated by FSPS during the run. (Default: None)
+
 alpha_enhacement = False                    # If set, then the metallicity of star particles is set to [Fe/H] rather than the total metals. 
                                             # Since FSPS does not support non solar abundance ratios, this parameter can be used to mimic the 
                                             # hardening of the radiation field due to alpha-enhancement. (Default: False)
@@ -185,6 +210,12 @@ bulge_stars_metals = 19 # in fsps metallicity units
 
 N_STELLAR_AGE_BINS = 100
 
+STELLAR_BINNING = 'fixed'         # 'fixed' uses N_STELLAR_AGE_BINS log(age) bins; 'adaptive' merges age bins (per fsps 
+                                  # metallicity) for as long as the integrated SED error of a bin stays below
+ADAPTIVE_BINNING_TOLERANCE = 0.01 # this fractional tolerance (only used if STELLAR_BINNING = 'adaptive').  the tolerance is
+                                  # checked on the SSP spectra only: stars that get nebular emission or a cluster
+                                  # decomposition are not merged, but binned in fine age bins and N_MASS_BINS mass bins
+
 #===============================================
 #BLACK HOLES
 #===============================================
@@ -291,5 +322,5 @@ REMOVE_INPUT_SEDS = False # If set, the hyperion input SED file is deleted after
 NEB_DEBUG = False # Dumps parameters related to nebular line emission in a file for debugging.
                   # The file includes the ionization parameter, number of ionizing photons,
                   # metallicity, inner radius, stellar mass and age for each particle.
-                  # Naming convention: nebular_properties_galaxy*.txt where * is the galaxy number
+                  # Naming convention: nebular_properties_galaxy*.h5 where * is the galaxy number
 OTF_EXTINCTION_MRN_FORCE = False
@@ -35,6 +35,14 @@ age_dist_min = 3e-3                         # Star particle above this age are s
 
 age_dist_max = 1e-2                         # Star particles below this age are sub-divided into an age distribution if use_age_distribution is set to True
                                             # (Units: Gyr, Default = 1.e-2)
+
+cmdf_memo_logm_res = 0.01                   # The cluster decomposition (cmdf and age distribution) of a star particle is reused for all particles whose
+                                            # log(mass) agree to within this resolution. The reused clusters are rescaled to the exact particle mass.
+                                            # Set to 0 to decompose every particle individually. (Units: log(Msun), Default = 0.01)
+
+cmdf_memo_age_res = 1.e-4                   # Same as above but for the particle age, when use_age_distribution is set to True. The reused cluster ages
+                                            # are shifted to the exact particle age. The stellar spectra of the clusters are evaluated on this age
+                                            # resolution, so that particles of similar ages share them. Set to 0 to use the exact ages. (Units: Gyr, Default = 1.e-4)
                                             
 #***********************
 # COMMON PARAMETERS
@@ -201,7 +209,7 @@ dump_emlines = False                        # If True, The emission lines are sa
                                             # The +2 in the (nlam+2) list are the O/H ratio and the id of that particle. With id = 0 , 1, 2 and 3 
                                             # corresponds to young stars, PAGB stars, AGN and DIG respectively. There is a convenience package in 
                                             # /convenience to help read in this file. This can be used as a fast way getting emission lines for the 
-                                            # purpose of debugging the code. Naming convention: emlines.galaxy*.txt where * is the galaxy number. 
+                                            # purpose of debugging the code. Naming convention: emlines.galaxy*.h5 where * is the galaxy number. 
                                             # This works only when add_neb_emission = True (Default: False) 
 
 cloudy_cleanup = True                       # If set to True, all the CLOUDY files will be deleted after the source addition is complete. 
@@ -213,6 +221,7 @@ cloudy_cleanup = True                       # If set to True, all the CLOUDY fil
 NEB_DEBUG = False # Dumps parameters related to nebular line emission in a file for debugging.
                   # The file includes the ionization parameter, number of ionizing photons, 
                   # metallicity, inner radius, stellar mass and age for each particle.
-                  # Naming convention: nebular_properties_galaxy*.txt where * is the galaxy number
+                  # Naming convention: nebular_properties_galaxy*.h5 where * is the galaxy number
 
-SAVE_NEB_SEDS = False # If set, the CLOUDY output SEDs are saved in a file 
+SAVE_NEB_SEDS = False # If set, the CLOUDY output SEDs are saved in a file
+                      # (neb_seds_galaxy*.h5, holding the datasets nu, fnu and positions) 
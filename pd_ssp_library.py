@@ -0,0 +1,79 @@
+# coding: utf-8
+#Code:  pd_ssp_library.py
+
+#precomputes the FSPS SSP grid (and, for runs with nebular emission
+#from the FSPS lookup tables, the nebular grid) for a parameters_master
+#file, and writes them to an SSP library file.  galaxy runs with the
+#same IMF/SSP settings then read the library (SSP_LIBRARY_FILE in
+#parameters_master) instead of starting up FSPS and generating the
+#spectra themselves, so the library only needs to be built once per
+#machine.
+#
+#usage:
+#    pd_ssp_library.py parameter_directory parameters_master_file [library_file]
+#
+#if library_file is not given, SSP_LIBRARY_FILE from the parameters
+#file is used.
+
+from __future__ import print_function
+import powderday.backwards_compatibility as bc
+import powderday.config as cfg
+from powderday.ssp_grid import SSPGrid, NebularGrid, save_ssp_library
+from datetime import datetime
+import fsps
+import sys
+import types
+
+
+if (len(sys.argv)) == 3:
+    script, pardir, parfile = sys.argv
+    library_file = None
+
+elif (len(sys.argv)) == 4:
+    script, pardir, parfile, library_file = sys.argv
+
+else:
+    print("usage: pd_ssp_library.py parameter_directory parameters_master_file [library_file]")
+    sys.exit(1)
+
+
+sys.path.insert(0, pardir)
+par = __import__(parfile)
+cfg.par = par
+
+#there is no model file for a library; variable_set also fills in a
+#few model defaults, so it gets an empty stand-in
+cfg.model = types.SimpleNamespace()
+
+#fill in the defaults for anything the parameters file does not set
+bc.variable_set()
+
+if library_file is None:
+    library_file = cfg.par.SSP_LIBRARY_FILE
+if library_file is None:
+    print("ERROR: no library file given, and SSP_LIBRARY_FILE is not set in "+parfile)
+    sys.exit(1)
+
+
+t1 = datetime.now()
+sp = fsps.StellarPopulation()
+
+try:
+    cfg.par.solar = sp.solar_metallicity
+except AttributeError:
+    #older python-fsps; see the corresponding block in pd_front_end.py
+    Ziso = {'mist': 0.0142, 'bsti': 0.020, 'gnva': 0.020, 'prsc': 0.01524, 'pdva': 0.019, 'bpss': 0.20}
+    cfg.par.solar = Ziso[str(sp.libraries[0].decode())]
+
+print('[pd_ssp_library:] computing the SSP grid')
+ssp_grid = SSPGrid.from_fsps(sp)
+
+nebular_grid = None
+if cfg.par.add_neb_emission and cfg.par.use_cloudy_tables:
+    print('[pd_ssp_library:] computing the nebular grid')
+    nebular_grid = NebularGrid.from_fsps(sp)
+
+save_ssp_library(library_file, ssp_grid, sp.libraries, nebular_grid=nebular_grid)
+
+t2 = datetime.now()
+print('[pd_ssp_library:] wrote '+library_file+' in '+str(t2-t1))
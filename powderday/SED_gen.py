@@ -7,19 +7,21 @@ import astropy.units as u
 import astropy.constants as constants
 from astropy import cosmology as cosmo
 
-import fsps 
 from datetime import datetime
 from powderday.grid_construction import stars_coordinate_boost
 
 from multiprocessing import Pool
 from functools import partial
 from itertools import repeat
-from scipy.integrate import simps
 
 from powderday.nebular_emission.cloudy_tools import calc_LogQ, age_dist, cmdf, get_nearest,convert_metals
 from powderday.analytics import logu_diagnostic,dump_emlines
 from powderday.nebular_emission.cloudy_model import get_nebular
+from powderday.ssp_cache import get_spectrum
+from powderday.helpers import find_nearest_sorted
+from powderday.ssp_grid import needs_individual_sps, get_ssp_grid, get_nebular_grid, load_ssp_library
 from p_tqdm import p_map
+from tqdm import tqdm
 
 
 #this is required to keep the reg as a strong reference.  for some
@@ -30,6 +32,13 @@ gc.set_threshold(0)
 
 # Lazily initialize FSPS
 sp = None
+_cloudy_nlam = None
+_stellar_populations = {}
+_cluster_decompositions = {}
+_cluster_spectra = {}
+_nebular_properties = []
+_pool = None
+_pool_model = None
 
 class Stars:
     def __init__(self,mass,metals,positions,age,sed_bin=[-1,-1,-1],lum=-1,fsps_zmet=20,all_metals=[-1,-1,-1,-1,-1,-1,-1,-1,-1,-1,-1]):
@@ -44,7 +53,45 @@ class Stars:
 
     def info(self):
         return(self.mass,self.metals,self.positions,self.age,self.sed_bin,self.lum,self.fsps_zmet)
-        
+
+
+class StarCatalog:
+
+    #columnar (struct of arrays) container for star particles: every
+    #property is one contiguous numpy array over all stars rather than
+    #one Stars object per particle.  indexing with an integer returns a
+    #Stars object (whose positions are a view into the catalog) so that
+    #single stars can still be handed to newstars_gen; indexing with a
+    #slice, index array or boolean mask returns a sub-catalog.
+
+    def __init__(self,mass,metals,positions,age,fsps_zmet=None,all_metals=None):
+        self.mass = np.atleast_1d(np.asarray(mass,dtype=np.float64))
+        nstars = len(self.mass)
+        self.metals = np.atleast_1d(np.asarray(metals,dtype=np.float64))
+        self.positions = np.asarray(positions,dtype=np.float64).reshape(nstars,3)
+        self.age = np.atleast_1d(np.asarray(age,dtype=np.float64))
+
+        if fsps_zmet is None:
+            fsps_zmet = np.repeat(20,nstars)
+        self.fsps_zmet = np.atleast_1d(np.asarray(fsps_zmet,dtype=int))
+
+        if all_metals is None:
+            all_metals = np.zeros([nstars,11])-1
+        self.all_metals = np.asarray(all_metals,dtype=np.float64).reshape(nstars,11)
+
+    def __len__(self):
+        return len(self.mass)
+
+    def __getitem__(self,idx):
+        if np.ndim(idx) == 0 and not isinstance(idx,slice):
+            return Stars(self.mass[idx],self.metals[idx],self.positions[idx],self.age[idx],fsps_zmet=self.fsps_zmet[idx],all_metals=self.all_metals[idx])
+
+        return StarCatalog(self.mass[idx],self.metals[idx],self.positions[idx],self.age[idx],fsps_zmet=self.fsps_zmet[idx],all_metals=self.all_metals[idx])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
 def star_list_gen(boost,dx,dy,dz,reg,ds,sp,m):
     print ('[SED_gen/star_list_gen]: reading in stars particles for SPS calculation')
     mass = reg["star","masses"].value
@@ -93,15 +140,11 @@ def star_list_gen(boost,dx,dy,dz,reg,ds,sp,m):
 
     #print '[SED_gen/star_list_gen: ] fsps zmet codes:',zmet
 
-    #create the stars_list full of Stars objects
-    stars_list = []
-    
+    #create the stars_list as a columnar catalog of all the stars
     if metals.ndim > 1:
-        for i in range(nstars):
-            stars_list.append(Stars(mass[i],metals_tot[i],positions[i],age[i],fsps_zmet=zmet[i],all_metals = metals[i]))
+        stars_list = StarCatalog(mass,metals_tot,positions,age,fsps_zmet=zmet,all_metals=metals)
     else:
-        for i in range(nstars):
-            stars_list.append(Stars(mass[i],metals_tot[i],positions[i],age[i],fsps_zmet=zmet[i]))
+        stars_list = StarCatalog(mass,metals_tot,positions,age,fsps_zmet=zmet)
     
     #boost stellar positions to grid center
     print ('boosting new stars to coordinate center')
@@ -110,13 +153,13 @@ def star_list_gen(boost,dx,dy,dz,reg,ds,sp,m):
     #orig_stars_list_len = len(stars_list)
     
     #ASSIGN DISK AND BULGE STARS - note, if these don't exist, it will
-    #just make empty lists
+    #just make empty catalogs
 
    
 
     
-    bulgestars_list = []
-    diskstars_list = []
+    bulgestars_list = StarCatalog([],[],np.zeros([0,3]),[])
+    diskstars_list = StarCatalog([],[],np.zeros([0,3]),[])
 
     
     #in principle, we should just be able to do the following blocks
@@ -135,9 +178,8 @@ def star_list_gen(boost,dx,dy,dz,reg,ds,sp,m):
             disk_masses =  reg[("diskstar","masses")].value
             nstars_disk = len(disk_masses)
      
-            #create the disk_list full of DiskStars objects
-            for i in range(nstars_disk):
-                diskstars_list.append(Stars(disk_masses[i],cfg.par.solar,disk_positions[i],cfg.par.disk_stars_age))
+            #create the disk catalog
+            diskstars_list = StarCatalog(disk_masses,np.repeat(cfg.par.solar,nstars_disk),disk_positions,np.repeat(cfg.par.disk_stars_age,nstars_disk))
 
             print ('boosting disk stars to coordinate center')    
             diskstars_list = stars_coordinate_boost(diskstars_list,boost)
@@ -153,11 +195,8 @@ def star_list_gen(boost,dx,dy,dz,reg,ds,sp,m):
             bulge_masses =  reg[("bulgestar","masses")].value
             nstars_bulge = len(bulge_masses)
             
-            #create the bulge_list full of BulgeStars objects
-            
-            for i in range(nstars_bulge):
-                bulgestars_list.append(Stars(bulge_masses[i],cfg.par.solar,bulge_positions[i],cfg.par.bulge_stars_age))
-                
+            #create the bulge catalog
+            bulgestars_list = StarCatalog(bulge_masses,np.repeat(cfg.par.solar,nstars_bulge),bulge_positions,np.repeat(cfg.par.bulge_stars_age,nstars_bulge))
 
             print ('boosting bulge stars to coordinate center')
             bulgestars_list = stars_coordinate_boost(bulgestars_list,boost)
@@ -170,35 +209,25 @@ def star_list_gen(boost,dx,dy,dz,reg,ds,sp,m):
 
     #EXPERIMENTAL FEATURES
     if cfg.par.SOURCES_IN_CENTER == True:
-        for i in range(nstars):
-            stars_list[i].positions[:] =  np.array([0,0,0])
-        if ("bulgestar","coordinates") in ds.derived_field_list:
-            for i in range(nstars_bulge):
-                bulgestars_list[i].positions[:] =  np.array([0,0,0])
-            for i in range(nstars_disk):
-                diskstars_list[i].positions[:] = np.array([0,0,0])
+        stars_list.positions[:] = 0
+        bulgestars_list.positions[:] = 0
+        diskstars_list.positions[:] = 0
 
     if cfg.par.SOURCES_RANDOM_POSITIONS == True:
         print ("================================")
         print ("SETTING SOURCES TO RANDOM POSITIONS")
         print ("================================")
-        for i in range(nstars):
-            xpos,ypos,zpos = np.random.uniform(-0.9*dx/2.,0.9*dx/2.),np.random.uniform(-0.9*dy/2.,0.9*dy/2.),np.random.uniform(-0.9*dz/2.,0.9*dz/2.)
-            stars_list[i].positions[:] = np.array([xpos,ypos,zpos])
-
-        if ("bulgestar","coordinates") in ds.derived_field_list:
-            for i in range(nstars_bulge):
-                xpos,ypos,zpos = np.random.uniform(-0.9*dx/2.,0.9*dx/2.),np.random.uniform(-0.9*dy/2.,0.9*dy/2.),np.random.uniform(-0.9*dz/2.,0.9*dz/2.)
-                bulgestars_list[i].positions[:] = np.array([xpos,ypos,zpos])
-            for i in range(nstars_disk):
-                xpos,ypos,zpos = np.random.uniform(-0.9*dx/2.,0.9*dx/2.),np.random.uniform(-0.9*dy/2.,0.9*dy/2.),np.random.uniform(-0.9*dz/2.,0.9*dz/2.)
-                diskstars_list[i].positions[:] = np.array([xpos,ypos,zpos])
+        for catalog in [stars_list,bulgestars_list,diskstars_list]:
+            ncat = len(catalog)
+            catalog.positions[:,0] = np.random.uniform(-0.9*dx/2.,0.9*dx/2.,ncat)
+            catalog.positions[:,1] = np.random.uniform(-0.9*dy/2.,0.9*dy/2.,ncat)
+            catalog.positions[:,2] = np.random.uniform(-0.9*dz/2.,0.9*dz/2.,ncat)
 
     return stars_list,diskstars_list,bulgestars_list,reg
 
 
 
-def allstars_sed_gen(stars_list,cosmoflag,sp):
+def allstars_sed_gen(stars_list,cosmoflag,sp,ssp_grid=None):
 
 
     #NOTE this part is just for the gadget simulations - this will
@@ -227,29 +256,59 @@ def allstars_sed_gen(stars_list,cosmoflag,sp):
     sp = fsps.StellarPopulation(tage=stars_list[0].age,imf_type=cfg.par.imf_type,pagb = cfg.par.pagb,sfh=0,zmet=stars_list[0].fsps_zmet,
                                 add_neb_emission = cfg.par.add_neb_emission, add_agb_dust_model=cfg.par.add_agb_dust_model)
                                 '''
-    spec = sp.get_spectrum(tage=stars_list[0].age,zmet=stars_list[0].fsps_zmet)
+    spec = get_spectrum(sp,tage=stars_list[0].age,zmet=stars_list[0].fsps_zmet)
     nu = 1.e8*constants.c.cgs.value/spec[0]
     nlam = len(nu)
 
-    nprocesses = np.min([cfg.par.n_processes,len(stars_list)]) #the pool.map will barf if there are less star bins than process threads
-
-    t1=datetime.now()
-    stars_sed_gen = p_map(newstars_gen, stars_list, num_cpus=nprocesses)
-    t2=datetime.now()
-
-    print ('Execution time for SED generation in Pool.map multiprocessing = '+str(t2-t1))
-    
-    cloudy_nlam = len(np.genfromtxt(cfg.par.pd_source_dir + "/powderday/nebular_emission/data/refLines.dat", delimiter=','))
     stellar_fnu = np.zeros([nstars,nlam])
     mfrac = np.zeros(nstars)
-    line_em = np.zeros([nstars,cloudy_nlam])
+    line_em = np.zeros([nstars,cloudy_nlam()])
+
+    #stars that need no special treatment in newstars_gen (no
+    #nebular emission, birth clouds or alpha enhancement) can be
+    #interpolated from a precomputed SSP grid in one go; everything
+    #else still gets its own FSPS call
+    if cfg.par.SSP_GRID_INTERPOLATION:
+        t1=datetime.now()
+        grid_idx = np.flatnonzero(~needs_individual_sps(stars_list.age))
+        if len(grid_idx) > 0:
+            if ssp_grid is None:
+                ssp_grid = get_ssp_grid(sp)
+            stellar_fnu[grid_idx,:],mfrac[grid_idx] = ssp_grid.interpolate(stars_list.age[grid_idx],stars_list.fsps_zmet[grid_idx])
+        fsps_idx = np.setdiff1d(np.arange(nstars),grid_idx)
+        t2=datetime.now()
+        print ('[SED_gen/allstars_sed_gen:] interpolated %d of %d star SEDs from the SSP grid in %s'%(len(grid_idx),nstars,str(t2-t1)))
+    else:
+        fsps_idx = np.arange(nstars)
 
-    # stars_sed_gen returns three things for each star/star bin: the spectrum,the associated surviving stellar mass fraction for that SSP
-    # and the line luminosities from CLOUDY
-    for i in range(nstars):
-        stellar_fnu[i,:] = stars_sed_gen[i][0]
-        mfrac[i] = stars_sed_gen[i][1]
-        line_em[i, :] = stars_sed_gen[i][2]
+    if len(fsps_idx) > 0:
+        nprocesses = np.min([cfg.par.n_processes,len(fsps_idx)])
+
+        #the stars are handed to the workers in chunks (a few per
+        #worker, to keep the load balanced) rather than one task per
+        #star.  the pool is persistent (get_pool), and every worker
+        #builds its StellarPopulation once in the pool initializer
+        chunksize = int(np.ceil(len(fsps_idx)/(4.*nprocesses)))
+        star_chunks = [[stars_list[i] for i in fsps_idx[j:j+chunksize]] for j in range(0,len(fsps_idx),chunksize)]
+
+        t1=datetime.now()
+        pool = get_pool()
+        chunks_sed_gen = list(tqdm(pool.imap(newstars_gen_chunk,star_chunks),total=len(star_chunks)))
+
+        stars_sed_gen = [sed for seds,_ in chunks_sed_gen for sed in seds]
+        nebular_properties = [props for _,chunk_props in chunks_sed_gen for props in chunk_props]
+        if len(nebular_properties) > 0:
+            logu_diagnostic(*np.transpose(nebular_properties))
+        t2=datetime.now()
+
+        print ('Execution time for SED generation in Pool.map multiprocessing = '+str(t2-t1))
+
+        # stars_sed_gen returns three things for each star/star bin: the spectrum,the associated surviving stellar mass fraction for that SSP
+        # and the line luminosities from CLOUDY
+        for j,i in enumerate(fsps_idx):
+            stellar_fnu[i,:] = stars_sed_gen[j][0]
+            mfrac[i] = stars_sed_gen[j][1]
+            line_em[i, :] = stars_sed_gen[j][2]
 
     stellar_nu = nu
 
@@ -289,7 +348,7 @@ def allstars_sed_gen(stars_list,cosmoflag,sp):
         else:
             sp.params['gas_logz'] = cfg.par.gas_logz
 
-        spec = sp.get_spectrum(tage=cfg.par.disk_stars_age,zmet=cfg.par.disk_stars_metals)
+        spec = get_spectrum(sp,tage=cfg.par.disk_stars_age,zmet=cfg.par.disk_stars_metals)
         disk_fnu = spec[1]
         
         #calculate the SED for bulge stars
@@ -310,7 +369,7 @@ def allstars_sed_gen(stars_list,cosmoflag,sp):
             sp.params['gas_logz'] = cfg.par.gas_logz
 
 
-        spec = sp.get_spectrum(tage=cfg.par.bulge_stars_age,zmet=cfg.par.bulge_stars_metals)
+        spec = get_spectrum(sp,tage=cfg.par.bulge_stars_age,zmet=cfg.par.bulge_stars_metals)
         bulge_fnu = spec[1]
     
 
@@ -330,10 +389,79 @@ def allstars_sed_gen(stars_list,cosmoflag,sp):
     return stellar_nu,stellar_fnu,disk_fnu,bulge_fnu, mfrac, line_em
 
 
+def cloudy_nlam():
+    #number of lines in the CLOUDY line list (refLines.dat); the file
+    #is only read once per process
+    global _cloudy_nlam
+    if _cloudy_nlam is None:
+        _cloudy_nlam = len(np.genfromtxt(cfg.par.pd_source_dir + "/powderday/nebular_emission/data/refLines.dat", delimiter=','))
+    return _cloudy_nlam
+
+
+def get_stellar_population(**kwargs):
+    #per-process registry of fsps.StellarPopulation objects, keyed on
+    #their construction arguments.  building a StellarPopulation is
+    #expensive, so it is only done once per process for every set of
+    #arguments; callers just update the (mutable) sp.params they need.
+    #(fsps is only imported here, so that the rest of this module can
+    #be used without it)
+    import fsps
+    key = tuple(sorted(kwargs.items()))
+    if key not in _stellar_populations:
+        _stellar_populations[key] = fsps.StellarPopulation(**kwargs)
+    return _stellar_populations[key]
+
+
+def newstars_worker_init():
+    #pool initializer: every worker sets up FSPS and reads the line
+    #list once, instead of once per star
+    global sp
+    if sp is None:
+        sp = get_stellar_population()
+    cloudy_nlam()
+
+
+def get_pool():
+    #the SED worker pool is kept warm for every later call of the same
+    #model.  the workers work with the cfg.par and cfg.model they were
+    #forked with, so the pool is restarted when cfg.model is not that
+    #model any more (the next galaxy of a batch run, see
+    #pd_front_end.py), rather than the per-model settings being handed
+    #to newstars_gen_chunk.  (a restart costs every worker one
+    #StellarPopulation set-up, once per galaxy)
+    global _pool,_pool_model
+    if _pool is not None and _pool_model is not cfg.model:
+        close_pool()
+    if _pool is None:
+        _pool = Pool(processes=cfg.par.n_processes,initializer=newstars_worker_init)
+        _pool_model = cfg.model
+    return _pool
+
+
+def close_pool():
+    global _pool,_pool_model
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+        _pool_model = None
+
+
+def newstars_gen_chunk(star_chunk):
+    #returns the SEDs of the chunk along with the nebular diagnostics
+    #(NEB_DEBUG) collected for it, so that those are written in bulk
+    #by the parent process rather than by every worker
+    del _nebular_properties[:]
+    seds = [newstars_gen(star_object) for star_object in star_chunk]
+    nebular_properties = list(_nebular_properties)
+    del _nebular_properties[:]
+    return seds, nebular_properties
+
+
 def newstars_gen(star_object):
     global sp
     if sp is None:
-        sp = fsps.StellarPopulation()
+        sp = get_stellar_population()
     
     #the newstars (particle type 4; so, for cosmological runs, this is all
     #stars) are calculated in a separate function with just one argument so that it is can be fed 
@@ -341,6 +469,9 @@ def newstars_gen(star_object):
     #sp = fsps.StellarPopulation()
     sp.params["tage"] = star_object.age
     sp.params["imf_type"] = cfg.par.imf_type
+    sp.params["imf1"] = cfg.par.imf1
+    sp.params["imf2"] = cfg.par.imf2
+    sp.params["imf3"] = cfg.par.imf3
     sp.params["pagb"] = cfg.par.pagb
     sp.params["sfh"] = 0
     sp.params["zmet"] = star_object.fsps_zmet
@@ -349,7 +480,7 @@ def newstars_gen(star_object):
 
     #first figure out how many wavelengths there are
     
-    spec = sp.get_spectrum(tage=star_object.age,zmet=star_object.fsps_zmet)
+    spec = stellar_spectrum(star_object.age, star_object.fsps_zmet)
     nu = 1.e8*constants.c.cgs.value/spec[0]
 
     nlam = len(nu)
@@ -379,8 +510,10 @@ def newstars_gen(star_object):
 
     if cfg.par.alpha_enhance: #Setting Zstar based on Fe/H
         spec_noneb, mfrac_neb = alpha_enhance(star_object.all_metals[-1], star_object.fsps_zmet, star_object.age, tesc_age)
+    elif cfg.par.CF_on:
+        spec_noneb = get_spectrum(sp, tage=star_object.age, zmet=star_object.fsps_zmet)
     else:
-        spec_noneb = sp.get_spectrum(tage=star_object.age, zmet=star_object.fsps_zmet)
+        spec_noneb = spec
     
     f = spec_noneb[1]
 
@@ -389,10 +522,9 @@ def newstars_gen(star_object):
     #(surviving, observed, etc.) stellar mass. In simulations, we only know the current star particle mass. To get the formed mass for an SSP,
     #we generate the surviving mass fraction (sp.stellar_mass) to extrapolate the initial mass from the current mass, metallicity, and age
     #this 'mfrac' is used to scale the FSPS SSP luminosities in source_creation
-    mfrac = sp.stellar_mass
+    mfrac = spec[2]
     
-    cloudy_nlam = len(np.genfromtxt(cfg.par.pd_source_dir + "/powderday/nebular_emission/data/refLines.dat", delimiter=','))
-    line_em = np.zeros(cloudy_nlam)
+    line_em = np.zeros(cloudy_nlam())
 
     pagb = cfg.par.add_pagb_stars and cfg.par.PAGB_min_age <= star_object.age <= cfg.par.PAGB_max_age
     young_star = cfg.par.add_young_stars and cfg.par.HII_min_age <= star_object.age <= cfg.par.HII_max_age
@@ -405,11 +537,16 @@ def newstars_gen(star_object):
                             mstar=star_object.mass/constants.M_sun.cgs.value, mfrac=mfrac)
         LogU = np.log10((10**LogQ)/(4*np.pi*Rin*Rin*nh*constants.c.cgs.value))
 
-        sp.params['gas_logu'] = LogU
-        sp.params['gas_logz'] = LogZ
-        sp.params["add_neb_emission"] = True
-        lam_neb, spec_neb = sp.get_spectrum(tage=star_object.age, zmet=star_object.fsps_zmet)
-        line_em = sp.emline_luminosity
+        nebular_grid = get_nebular_grid(sp)
+        if nebular_grid is not None and not (cfg.par.CF_on or cfg.par.alpha_enhance):
+            # from the precomputed library (see pd_ssp_library.py), with
+            # the gas metallicity of the fsps metallicity of the star
+            spec_neb, line_em = nebular_grid.interpolate(star_object.age, star_object.fsps_zmet, LogU)
+        else:
+            sp.params['gas_logu'] = LogU
+            sp.params['gas_logz'] = LogZ
+            sp.params["add_neb_emission"] = True
+            lam_neb, spec_neb, _, line_em = get_spectrum(sp, tage=star_object.age, zmet=star_object.fsps_zmet)
         f = spec_neb
         
     elif (cfg.par.add_neb_emission or cfg.par.use_cmdf) and (young_star or pagb) and not cfg.par.use_cloudy_tables:
@@ -422,38 +559,7 @@ def newstars_gen(star_object):
         # down into 30 particles and these arrays will store the properties of all the 30 particles. This allows us to consider these as 30 individual
         # particles rest of the calculation and their fluxes are combined in end to get the final result for this one particle.
             
-        cluster_mass = [np.log10(star_object.mass / constants.M_sun.cgs.value)]
-        num_clusters = [1]
-        age_clusters = [star_object.age]
-
-        if star_object.mass / constants.M_sun.cgs.value > 10 ** cfg.par.cmdf_max_mass and cfg.par.use_cmdf:
-            cluster_mass, num_clusters = cmdf(star_object.mass / constants.M_sun.cgs.value,
-                                                int(cfg.par.cmdf_bins), cfg.par.cmdf_min_mass,
-                                                cfg.par.cmdf_max_mass, cfg.par.cmdf_beta)
-            age_clusters = []
-            for k in range(len(cluster_mass)):
-                age_clusters.append(star_object.age)
-
-            if cfg.par.use_age_distribution:
-                num_clusters_cmdf = num_clusters
-                cluster_mass_cmdf = cluster_mass
-                num_clusters = []
-                cluster_mass = []
-                age_clusters = []
-                for k in range(len(cluster_mass_cmdf)):
-                    num, t = age_dist(num_clusters_cmdf[k], star_object.age)
-                    rescale = np.sum(num_clusters_cmdf[k])/np.sum(num)
-                        
-                    for l in range(len(num)):
-                        if num[l] == 0:
-                            continue
-                        num_clusters.append(num[l])
-                        cluster_mass.append(np.log10((10**cluster_mass_cmdf[k])*rescale))
-                        age_clusters.append(t[l])
-
-            cluster_mass = np.array(cluster_mass)
-            num_clusters = np.array(num_clusters)
-            age_clusters = np.array(age_clusters)
+        cluster_mass, num_clusters, age_clusters, spectrum_ages = cluster_decomposition(star_object.mass / constants.M_sun.cgs.value, star_object.age)
             
         f = np.zeros(nlam)
 
@@ -464,12 +570,7 @@ def newstars_gen(star_object):
 
             sp.params["add_neb_emission"] = False
 
-            if cfg.par.alpha_enhance: #Setting Zstar based on Fe/H
-                spec, mfrac_neb = alpha_enhance(star_object.all_metals[-1], star_object.fsps_zmet, age, tesc_age)
-                    
-            else:
-                spec = sp.get_spectrum(tage=age,zmet=star_object.fsps_zmet)
-                mfrac_neb = sp.stellar_mass
+            spec, mfrac_neb = cluster_spectrum(star_object, spectrum_ages[j], tesc_age)
 
             if cfg.par.add_neb_emission:
                 # id_val = 0, 1, 2 for young stars, Post-AGB star and AGNs respectively.
@@ -520,7 +621,8 @@ def newstars_gen(star_object):
                     Rin = cfg.par.inner_radius[id_val]
 
                 if neb_file_output:        
-                    logu_diagnostic(LogQ, LogU, LogZ, Rs, 10**cluster_mass[j], num_HII_clusters, age, append=True)
+                    #collected here and written by the parent process (see newstars_gen_chunk)
+                    _nebular_properties.append((LogQ, LogU, LogZ, Rs, 10**cluster_mass[j], num_HII_clusters, age))
                     neb_file_output = False
 
                 try:
@@ -537,8 +639,7 @@ def newstars_gen(star_object):
                     sp.params['gas_logu'] = LogU
                     sp.params['gas_logz'] = LogZ
                     sp.params["add_neb_emission"] = True
-                    lam_neb, spec_neb = sp.get_spectrum(tage=age, zmet=star_object.fsps_zmet)
-                    line_lum = sp.emline_luminosity
+                    lam_neb, spec_neb, _, line_lum = get_spectrum(sp, tage=age, zmet=star_object.fsps_zmet)
 
             else:
                 spec_neb = spec[1]
@@ -553,6 +654,135 @@ def newstars_gen(star_object):
     return stellar_fnu, mfrac, line_em
 
 
+def quantized_age(age):
+
+    # The age on the cmdf_memo_age_res grid (unchanged if the
+    # resolution is 0, or if it would round the age to 0).
+
+    if cfg.par.cmdf_memo_age_res > 0 and np.round(age/cfg.par.cmdf_memo_age_res) > 0:
+        return np.round(age/cfg.par.cmdf_memo_age_res)*cfg.par.cmdf_memo_age_res
+    return age
+
+
+def cluster_decomposition(star_mass, star_age):
+
+    # Breaks a star particle (mass in Msun, age in Gyr) into clusters
+    # following the cluster mass distribution function (cmdf) and, if
+    # use_age_distribution is set, the cluster age distribution
+    # (age_dist). Returns the log10 cluster masses, the number of
+    # clusters of each mass, their ages and the ages their stellar
+    # spectra are evaluated at.
+    #
+    # The decomposition only depends on the mass and age of the
+    # particle, so it is memoized on the log mass and age quantized to
+    # cmdf_memo_logm_res and cmdf_memo_age_res. A cached decomposition
+    # is rescaled to the exact particle mass, so that the total mass is
+    # conserved. The age distribution is memoized as the offsets of the
+    # cluster ages from the quantized age, and those are added to the
+    # exact particle age. The spectrum ages are the quantized age plus
+    # the offsets instead, so that all the particles that share a
+    # decomposition also share the cluster spectra (see
+    # cluster_spectrum).
+
+    if not (cfg.par.use_cmdf and star_mass > 10 ** cfg.par.cmdf_max_mass):
+        return np.array([np.log10(star_mass)]), np.array([1]), np.array([star_age]), np.array([quantized_age(star_age)])
+
+    log_mass = np.log10(star_mass)
+    if cfg.par.cmdf_memo_logm_res > 0:
+        log_mass_key = np.round(log_mass/cfg.par.cmdf_memo_logm_res)*cfg.par.cmdf_memo_logm_res
+    else:
+        log_mass_key = log_mass
+
+    #(age_dist leaves the particles outside of its age range whole)
+    if not (cfg.par.use_age_distribution and cfg.par.age_dist_min < star_age < cfg.par.age_dist_max):
+        age_key = None
+    else:
+        age_key = np.clip(quantized_age(star_age),np.nextafter(cfg.par.age_dist_min,np.inf),np.nextafter(cfg.par.age_dist_max,-np.inf))
+
+    key = (log_mass_key, age_key)
+    if key not in _cluster_decompositions:
+        if len(_cluster_decompositions) >= 1000:
+            _cluster_decompositions.clear()
+
+        cluster_mass, num_clusters = cmdf(10**log_mass_key, int(cfg.par.cmdf_bins), cfg.par.cmdf_min_mass,
+                                          cfg.par.cmdf_max_mass, cfg.par.cmdf_beta)
+        age_offsets = [0.]*len(cluster_mass)
+
+        if age_key is not None:
+            num_clusters_cmdf = num_clusters
+            cluster_mass_cmdf = cluster_mass
+            num_clusters = []
+            cluster_mass = []
+            age_offsets = []
+            for k in range(len(cluster_mass_cmdf)):
+                num, t = age_dist(num_clusters_cmdf[k], age_key)
+                rescale = np.sum(num_clusters_cmdf[k])/np.sum(num)
+
+                for l in range(len(num)):
+                    if num[l] == 0:
+                        continue
+                    num_clusters.append(num[l])
+                    cluster_mass.append(np.log10((10**cluster_mass_cmdf[k])*rescale))
+                    age_offsets.append(t[l]-age_key)
+
+        _cluster_decompositions[key] = (np.array(cluster_mass), np.array(num_clusters), np.array(age_offsets))
+
+    cluster_mass, num_clusters, age_offsets = _cluster_decompositions[key]
+    spectrum_age = quantized_age(star_age) if age_key is None else age_key
+
+    return cluster_mass + (log_mass - log_mass_key), num_clusters, star_age + age_offsets, spectrum_age + age_offsets
+
+
+def stellar_spectrum(age, fsps_zmet):
+
+    # The (non-nebular, dust free) SSP spectrum of the given age and
+    # metallicity, in the form returned by ssp_cache.get_spectrum. It
+    # is interpolated from the SSP library if one is given
+    # (SSP_LIBRARY_FILE), otherwise it comes from FSPS with the current
+    # sp.params.
+
+    if cfg.par.SSP_LIBRARY_FILE is not None:
+        ssp_grid,_ = load_ssp_library(cfg.par.SSP_LIBRARY_FILE, sp)
+        if ssp_grid is not None:
+            fnu, mfrac = ssp_grid.interpolate([age], [fsps_zmet])
+            return ssp_grid.wav, fnu[0], mfrac[0], None
+
+    return get_spectrum(sp, tage=age, zmet=fsps_zmet)
+
+
+def cluster_spectrum(star_object, age, tesc_age):
+
+    # The stellar (non-nebular) SSP of a cluster of the given age (the
+    # spectrum age of cluster_decomposition). With cmdf_memo_age_res >
+    # 0 those ages are quantized, and the clusters of all the particles
+    # that share a decomposition have the same ones, so the spectra are
+    # memoized (per process, keyed on everything that changes the
+    # spectrum).
+
+    key = (age, star_object.fsps_zmet)
+    if cfg.par.alpha_enhance:
+        key += (star_object.all_metals[-1],)
+    if cfg.par.CF_on:
+        key += (tesc_age,)
+
+    if key not in _cluster_spectra:
+        if len(_cluster_spectra) >= 1000:
+            _cluster_spectra.clear()
+
+        if cfg.par.alpha_enhance: #Setting Zstar based on Fe/H
+            spec, mfrac_neb = alpha_enhance(star_object.all_metals[-1], star_object.fsps_zmet, age, tesc_age)
+        elif cfg.par.CF_on:
+            spec = get_spectrum(sp,tage=age,zmet=star_object.fsps_zmet)
+            mfrac_neb = spec[2]
+        else:
+            spec = stellar_spectrum(age, star_object.fsps_zmet)
+            mfrac_neb = spec[2]
+
+        _cluster_spectra[key] = (spec, mfrac_neb)
+
+    return _cluster_spectra[key]
+
+
 def get_gas_metals(ngas, reg):
     # This function outputs the metallicity (total as well as all the 10 elements tracked by the simulation)
     # for all the gas particles
@@ -587,9 +817,6 @@ def get_nearest_gas_metals(all_gas_coordinates, particle_coordinates, all_gas_me
 
 def get_agn_seds(agn_ids, reg):
     print ('Starting AGN SED generation')
-    
-    if cfg.par.dump_emlines:
-        dump_emlines(None, None)
 
     t1 = datetime.now()
     nprocesses = np.min([cfg.par.n_processes,len(agn_ids)])
@@ -606,8 +833,9 @@ def get_agn_seds(agn_ids, reg):
         all_gas_metals = get_gas_metals(len(all_gas_coordinates), reg)
         metals_avg.append(get_nearest_gas_metals(all_gas_coordinates, agn_coordinates, all_gas_metals))
 
-    fnu_out = p_map(agn_sed, agn_ids, nu, fnu_in, metals_avg, num_cpus=nprocesses)
-    fnu_out = np.atleast_2d(fnu_out)
+    agn_out = p_map(agn_sed, agn_ids, nu, fnu_in, metals_avg, num_cpus=nprocesses)
+    fnu_out = np.atleast_2d([spec for spec,_ in agn_out])
+    dump_line_records([line_em for _,line_em in agn_out])
     t2 = datetime.now()
 
     print ('Execution time for AGN SED generation = '+str(t2-t1))
@@ -624,6 +852,7 @@ def agn_sed(agn_id, nu, fnu, metals_avg):
         nu = nu[::-1]
         fnu = fnu[::-1]
 
+    line_em = None
     if cfg.par.add_neb_emission and cfg.par.add_AGN_neb:
         
         id_val = 2
@@ -662,12 +891,13 @@ def agn_sed(agn_id, nu, fnu, metals_avg):
             OH = metals[4]
             line_em = np.append(line_em, OH)
             line_em = np.append(line_em, 4)
-            dump_emlines(line_em)
 
     else:
         spec = fnu
 
-    return spec
+    #the emission lines (or None) are returned to be written by the
+    #parent process
+    return spec, line_em
 
 
 def get_dig_seds(lam ,sed, logU, cell_widths, metals):
@@ -677,8 +907,9 @@ def get_dig_seds(lam ,sed, logU, cell_widths, metals):
     t1 = datetime.now()
     nprocesses = np.min([cfg.par.n_processes,len(cell_widths)])
     
-    fnu_out = p_map(partial(dig_sed, spec_lam=lam), sed, logU, cell_widths, metals, num_cpus=nprocesses)
-    fnu_out = np.atleast_2d(fnu_out)
+    dig_out = p_map(partial(dig_sed, spec_lam=lam), sed, logU, cell_widths, metals, num_cpus=nprocesses)
+    fnu_out = np.atleast_2d([spec for spec,_ in dig_out])
+    dump_line_records([line_em for _,line_em in dig_out])
     
     t2 = datetime.now()
 
@@ -693,30 +924,38 @@ def dig_sed(sspi, logU, cell_width, metal, spec_lam):
     spec, wave_line, line_lum = get_nebular(spec_lam, sspi, cfg.par.DIG_nh, metal, logu=logU, Cell_width=cell_width, Dust=False,
                                             abund=cfg.par.neb_abund[id_val], clean_up = cfg.par.cloudy_cleanup, index=id_val)
 
+    line_em = None
     if cfg.par.dump_emlines:
         # The stellar population returns the calculation in units of Lsun
         line_em = line_lum * 3.839e33  # Units: ergs/s
         OH = metal[4]
         line_em = np.append(line_em, OH)
         line_em = np.append(line_em, id_val)
-        dump_emlines(line_em)
         
-    return spec
+    #the emission lines (or None) are returned to be written by the
+    #parent process
+    return spec, line_em
+
+
+def dump_line_records(line_ems):
+    #writes the emission lines returned by the agn_sed / dig_sed workers in one go
+    line_ems = [line_em for line_em in line_ems if line_em is not None]
+    if len(line_ems) > 0:
+        dump_emlines(np.array(line_ems))
 
 
 def fsps_metallicity_interpolate(metals, sp):
 
-    # takes a list of metallicities for star particles, and returns a
-    # list of interpolated metallicities
+    # takes an array of metallicities for star particles, and returns
+    # an array of interpolated metallicities (1-indexed fsps zmet
+    # codes; see find_nearest_zmet)
 
     fsps_metals = np.array(sp.zlegend)
+    metals = np.atleast_1d(metals)
 
-    nstars = len(metals)
-    
-    zmet = []
-
-    for i in range(nstars):
-        zmet.append(find_nearest_zmet(fsps_metals,metals[i]))
+    #zlegend is sorted, so only the two neighbours of every star's
+    #metallicity need to be compared (no nstars x nZ array)
+    zmet = find_nearest_sorted(fsps_metals,metals)+1
     
     return zmet
     
@@ -777,69 +1016,29 @@ def remove_stars_outside_grid(stars_list,bulgestars_list,diskstars_list,m):
                 if grid_ref.zmax>zmax:
                     zmax = grid_ref.zmax
 
-    star_idx_to_remove = []
-    bulge_idx_to_remove = []
-    disk_idx_to_remove = []
-
-    total_mass = 0
-    mass_removed = 0
-
+    def outside_grid(catalog):
+        pos = catalog.positions
+        return (pos[:,0] > xmax) | (pos[:,0] < xmin) | \
+               (pos[:,1] > ymax) | (pos[:,1] < ymin) | \
+               (pos[:,2] > zmax) | (pos[:,2] < zmin)
 
-    for i in range(len(stars_list)):
-        if (stars_list[i].positions[0] > xmax) or \
-           (stars_list[i].positions[0] < xmin) or \
-           (stars_list[i].positions[1] > ymax) or \
-           (stars_list[i].positions[1] < ymin) or \
-           (stars_list[i].positions[2] > zmax) or \
-           (stars_list[i].positions[2] < zmin):
-           
-            star_idx_to_remove.append(i)
-            mass_removed += stars_list[i].mass
+    star_idx_to_remove = outside_grid(stars_list)
+    bulge_idx_to_remove = outside_grid(bulgestars_list)
+    disk_idx_to_remove = outside_grid(diskstars_list)
 
-
-
-        if (len(bulgestars_list) > 0):
-            if (bulgestars_list[i].positions[0] > xmax) or \
-               (bulgestars_list[i].positions[0] < xmin) or \
-               (bulgestars_list[i].positions[1] > ymax) or \
-               (bulgestars_list[i].positions[1] < ymin) or \
-               (bulgestars_list[i].positions[2] > zmax) or \
-               (bulgestars_list[i].positions[2] < zmin):
-
-                bulge_idx_to_remove.append(i)
-                mass_removed += bulgestars_list[i].mass
-
-        
-        if (len(diskstars_list) > 0):
-            if (diskstars_list[i].positions[0] > xmax) or \
-               (diskstars_list[i].positions[0] < xmin) or \
-               (diskstars_list[i].positions[1] > ymax) or \
-               (diskstars_list[i].positions[1] < ymin) or \
-               (diskstars_list[i].positions[2] > zmax) or \
-               (diskstars_list[i].positions[2] < zmin):
-            
-                disk_idx_to_remove.append(i)
-                mass_removed += diskstars_list[i].mass
-
-
-
-        total_mass += stars_list[i].mass
-    
+    total_mass = np.sum(stars_list.mass)
+    mass_removed = np.sum(stars_list.mass[star_idx_to_remove]) + \
+                   np.sum(bulgestars_list.mass[bulge_idx_to_remove]) + \
+                   np.sum(diskstars_list.mass[disk_idx_to_remove])
 
     #now that we've figured out which stars to remove, actually remove
-    #them from the lists.  remove them in reverse order so that we
-    #don't destroy the indexing as soon as we remove a single star
-    for idx in star_idx_to_remove[::-1]:
-        stars_list.pop(idx)
-
-    for idx in bulge_idx_to_remove[::-1]:
-        bulgestars_list.pop(idx)
-
-    for idx in disk_idx_to_remove[::-1]:
-        diskstars_list.pop(idx)
+    #them from the catalogs
+    stars_list = stars_list[~star_idx_to_remove]
+    bulgestars_list = bulgestars_list[~bulge_idx_to_remove]
+    diskstars_list = diskstars_list[~disk_idx_to_remove]
     
 
-    number_of_removed_stars = len(star_idx_to_remove) + len(bulge_idx_to_remove) + len(disk_idx_to_remove)
+    number_of_removed_stars = np.sum(star_idx_to_remove) + np.sum(bulge_idx_to_remove) + np.sum(disk_idx_to_remove)
     mass_fraction_removed = mass_removed/total_mass
     print("[SED_gen/remove_stars_outside_grid:] removing %f stars because they are outside the dust grid" % number_of_removed_stars)
     print("[SED_gen/remove_stars_outside_grid:] this corresponds to %f of the total stellar mass in the volume " % mass_fraction_removed)
@@ -864,7 +1063,7 @@ def alpha_enhance(star_Fe, star_zmet, age, tesc_age):
 
     Logzsol = np.log10(FeH/FeH_sol)
                         
-    sp1 = fsps.StellarPopulation(zcontinuous=1)
+    sp1 = get_stellar_population(zcontinuous=1)
     sp1.params["tage"] = age
     sp1.params["imf_type"] = cfg.par.imf_type
     sp1.params["imf1"] = cfg.par.imf1
@@ -883,7 +1082,7 @@ def alpha_enhance(star_Fe, star_zmet, age, tesc_age):
         sp1.params["dust2"] = 0
         sp1.params["dust_tesc"] = tesc_age
 
-        spec = sp1.get_spectrum(tage=age)
-        mfrac_neb = sp1.stellar_mass
+    spec = get_spectrum(sp1,tage=age)
+    mfrac_neb = spec[2]
 
     return spec, mfrac_neb
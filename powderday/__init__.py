@@ -1,30 +1,17 @@
-from . import front_ends
-from . import front_end_tools
-from . import agn_models
-from . import agn_spectrum
-from . import SED_gen
-from . import analytics
-from . import backwards_compatibility
-from . import config
-from . import constants
-from . import cutout_data
-from . import dust_grid_gen
-from . import enzo_tributary
-from . import error_handling
-from . import find_order
-from . import grid_construction
-from . import gridstats
-from . import helpers
-from . import hyperion_octree_stats
-from . import image_processing
-from . import m_control_tools
-from . import octree_sanity_check
-from . import zoom
-from . import pfh_readsnap
-from . import powderday_test_octree
-from . import source_creation
-from . import sph_tributary
-from . import mlt
-from . import tributary_dust_add
-from . import pah
-from . import active_dust
+#the submodules are imported the first time they are accessed (PEP 562)
+#rather than all at once here: most of them pull in yt, hyperion, fsps
+#or astropy, and e.g. importing powderday.config to read a parameters
+#file should not have to wait for all of them.
+import importlib
+
+_submodules = ['front_ends', 'front_end_tools', 'agn_models', 'agn_spectrum', 'SED_gen', 'ssp_cache', 'ssp_grid', 'analytics', 'backwards_compatibility', 'config', 'constants', 'cutout_data', 'dust_grid_gen', 'enzo_tributary', 'error_handling', 'find_order', 'grid_construction', 'gridstats', 'helpers', 'hyperion_octree_stats', 'image_processing', 'm_control_tools', 'octree_sanity_check', 'octree_tools', 'octree_cache', 'sph_deposit', 'zoom', 'pfh_readsnap', 'powderday_test_octree', 'source_creation', 'sph_tributary', 'mlt', 'tributary_dust_add', 'pah', 'active_dust']
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + _submodules)
@@ -8,6 +8,7 @@ from astropy import constants
 import astropy.units as u
 from hyperion.model import ModelOutput
 import os,pdb
+import h5py
 
 def proj_plots(ds):
     print ('\n[analytics/proj_plots] Saving Diagnostic Projection Plots \n')
@@ -213,27 +214,20 @@ def SKIRT_data_dump(reg,ds,m,stars_list,bulgestars_list,diskstars_list,ds_type,s
 
     #create stars file.  this assumes the 'extragalactic [length in pc, distance in Mpc]' units for SKIRT
 
-    spos_x = ([stars.positions[0] for stars in stars_list]*u.cm).to(u.pc).value
-    spos_y = ([stars.positions[1] for stars in stars_list]*u.cm).to(u.pc).value
-    spos_z = ([stars.positions[2] for stars in stars_list]*u.cm).to(u.pc).value
-    smasses = ([stars.mass for stars in stars_list]*u.g).to(u.Msun).value
+    spos_x = (stars_list.positions[:,0]*u.cm).to(u.pc).value
+    spos_y = (stars_list.positions[:,1]*u.cm).to(u.pc).value
+    spos_z = (stars_list.positions[:,2]*u.cm).to(u.pc).value
+    smasses = (stars_list.mass*u.g).to(u.Msun).value
 
-    try:
-        disk_x = ([diskstars.positions[0] for diskstars in diskstars_list]*u.cm).to(u.pc).value
-        disk_y = ([diskstars.positions[1] for diskstars in diskstars_list]*u.cm).to(u.pc).value
-        disk_z = ([diskstars.positions[2] for diskstars in diskstars_list]*u.cm).to(u.pc).value
-        diskmasses = ([diskstars.mass for diskstars in diskstars_list]*u.g).to(u.Msun).value
-
-    except: 
-        disk_x, disk_y, disk_z, diskmasses = (np.array([]),)*4
+    disk_x = (diskstars_list.positions[:,0]*u.cm).to(u.pc).value
+    disk_y = (diskstars_list.positions[:,1]*u.cm).to(u.pc).value
+    disk_z = (diskstars_list.positions[:,2]*u.cm).to(u.pc).value
+    diskmasses = (diskstars_list.mass*u.g).to(u.Msun).value
 
-    try:
-        bulge_x = ([bulgestars.positions[0] for bulgestars in bulgestars_list]*u.cm).to(u.pc).value
-        bulge_y = ([bulgestars.positions[1] for bulgestars in bulgestars_list]*u.cm).to(u.pc).value
-        bulge_z = ([bulgestars.positions[2] for bulgestars in bulgestars_list]*u.cm).to(u.pc).value
-        bulgemasses = ([bulgestars.mass for bulgstars in bulgestars_list]*u.g).to(u.Msun).value
-    except:
-        bulge_x, bulge_y, bulge_z, bulgemasses = (np.array([]),)*4
+    bulge_x = (bulgestars_list.positions[:,0]*u.cm).to(u.pc).value
+    bulge_y = (bulgestars_list.positions[:,1]*u.cm).to(u.pc).value
+    bulge_z = (bulgestars_list.positions[:,2]*u.cm).to(u.pc).value
+    bulgemasses = (bulgestars_list.mass*u.g).to(u.Msun).value
 
 
 
@@ -259,8 +253,8 @@ def SKIRT_data_dump(reg,ds,m,stars_list,bulgestars_list,diskstars_list,ds_type,s
 
     #ages and metallicities need to come from the stars list in case
     #we do something in parameters master to change the values
-    smetallicity = [stars.metals for stars in stars_list] + dmet + bmet
-    sage = [(stars.age*u.Gyr).to(u.yr).value for stars in stars_list] + dage + bage
+    smetallicity = list(stars_list.metals) + dmet + bmet
+    sage = list((stars_list.age*u.Gyr).to(u.yr).value) + dage + bage
     shsml = np.repeat(hsml_in_pc,len(sage))
 
     #create the gas file for SPH-oids.  this assumes the 'extragalactic [length in pc, distance in Mpc]' units for SKIRT
@@ -302,42 +296,133 @@ def SKIRT_data_dump(reg,ds,m,stars_list,bulgestars_list,diskstars_list,ds_type,s
         np.savetxt(outfile_gas, np.column_stack((gpos_x,gpos_y,gpos_z,ghsml,gmass,gmetallicity)))
 
 
+class HDF5RecordWriter:
+
+    #run-scoped, appendable HDF5 store for row records (nebular SEDs,
+    #emission lines, nebular diagnostics).  rows are buffered in memory
+    #and written in blocks to resizable, chunked 2D datasets, so every
+    #record is written to disk once no matter how many times we append.
+    #datasets that do not grow (e.g. a wavelength array) can be attached
+    #with set_static and are written along with the first block.
+
+    def __init__(self, outfile, buffer_rows=4096):
+        self.outfile = outfile
+        self.buffer_rows = buffer_rows
+        self._static = {}
+        self._rows = {}
+        self._nbuffered = 0
+
+        #start from an empty file
+        with h5py.File(self.outfile, 'w'):
+            pass
+
+    def set_static(self, name, data):
+        if name not in self._static:
+            self._static[name] = np.asarray(data)
+
+    def append(self, **rows):
+        #every keyword is a dataset name, with one or more rows for it
+        nrows = 0
+        for name, row in rows.items():
+            row = np.atleast_2d(row)
+            self._rows.setdefault(name, []).append(row)
+            nrows = max(nrows, len(row))
+        self._nbuffered += nrows
+
+        if self._nbuffered >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        with h5py.File(self.outfile, 'a') as f:
+            for name, data in self._static.items():
+                if name not in f:
+                    f.create_dataset(name, data=data)
+
+            for name, blocks in self._rows.items():
+                if len(blocks) == 0:
+                    continue
+                data = np.concatenate(blocks).astype('f8')
+
+                if name not in f:
+                    #chunks of about 1 MB (the size of the default chunk
+                    #cache), whatever the width of the rows
+                    ncol = data.shape[1]
+                    f.create_dataset(name, shape=(0, ncol), maxshape=(None, ncol),
+                                     chunks=(max(1, 2**20//(8*ncol)), ncol), dtype='f8')
+
+                n = f[name].shape[0]
+                f[name].resize(n+len(data), axis=0)
+                f[name][n:] = data
+
+        self._rows = {}
+        self._nbuffered = 0
+
+    def load(self, *names):
+        self.flush()
+        with h5py.File(self.outfile, 'r') as f:
+            return tuple(f[name][:] for name in names)
+
+
+#the writers of the current run, keyed on what they store
+_record_writers = {}
+
+def record_writer(kind, outfile):
+
+    #the writer for this kind of record in the current run (a new one is
+    #started if the output file changed, e.g. for the next galaxy)
+    writer = _record_writers.get(kind)
+    if writer is None or writer.outfile != outfile:
+        writer = HDF5RecordWriter(outfile)
+        _record_writers[kind] = writer
+    return writer
+
+
+def flush_records():
+    #writes out everything that is still buffered
+    for writer in _record_writers.values():
+        writer.flush()
+
+
 # Saves logU, Q and other related parameters in a file (seperate file is created for each galaxy)
 def logu_diagnostic(logQ, LogU, LogZ, Rin, cluster_mass, num_cluster, age, append = True):
+
+    #the arguments are either scalars (one cluster) or arrays with one
+    #entry per cluster; columns are stored in this order in the
+    #nebular_properties dataset
+    if hasattr(cfg.model, 'galaxy_num_str'):
+        outfile = cfg.model.PD_output_dir + "nebular_properties_galaxy" + cfg.model.galaxy_num_str + ".h5"
+    else:
+        outfile = cfg.model.PD_output_dir + "nebular_properties_galaxy.h5"
+
     if append == False:
-        try: outfile = cfg.model.PD_output_dir + "nebular_properties_galaxy" + cfg.model.galaxy_num_str + ".txt"
-        except: outfile = cfg.model.PD_output_dir + "nebular_properties_galaxy.txt"
-        f = open(outfile, 'w+')
-        f.close()
+        _record_writers.pop('nebular_properties', None)
+        record_writer('nebular_properties', outfile)
+        with h5py.File(outfile, 'a') as f:
+            f.attrs['columns'] = ['logQ', 'logU', 'logZ', 'Rin', 'cluster_mass', 'num_cluster', 'age']
     else:
-        try:outfile = cfg.model.PD_output_dir + "nebular_properties_galaxy" + cfg.model.galaxy_num_str + ".txt"
-        except: outfile = cfg.model.PD_output_dir + "nebular_properties_galaxy.txt"
-        f = open(outfile, 'a+')
-        f.write(str(logQ) + "\t" + str(LogU) + "\t" + str(LogZ) + "\t" + str(Rin) + "\t"+ str(cluster_mass) + "\t" + str(num_cluster) + "\t" + str(age) + "\n")
-        f.close()
+        row = np.column_stack([logQ, LogU, LogZ, Rin, cluster_mass, num_cluster, age])
+        record_writer('nebular_properties', outfile).append(nebular_properties=row)
 
 
 # Dumps emission lines
 def dump_emlines(line_em, append=True):
     if hasattr(cfg.model, 'galaxy_num_str'):
-        outfile_lines = cfg.model.PD_output_dir + "emlines.galaxy" + cfg.model.galaxy_num_str + ".txt"
+        outfile_lines = cfg.model.PD_output_dir + "emlines.galaxy" + cfg.model.galaxy_num_str + ".h5"
     else:
-        outfile_lines = cfg.model.PD_output_dir + "emlines.galaxy.txt"
+        outfile_lines = cfg.model.PD_output_dir + "emlines.galaxy.h5"
 
     if append == False:
         refline_file = cfg.par.pd_source_dir + "/powderday/nebular_emission/data/refLines.dat"
-        f = open(outfile_lines,'w')
         wdat = np.genfromtxt(refline_file, delimiter=',')
         wl = np.array([dat[0] for dat in wdat])
         sinds = np.argsort(wl)
-        line_wav = wl[sinds]  
-        np.savetxt(f,np.expand_dims(line_wav,axis=0))
-        f.close()
+        line_wav = wl[sinds]
+
+        _record_writers.pop('emlines', None)
+        record_writer('emlines', outfile_lines).set_static('line_wavelengths', line_wav)
     else:
-        f = open(outfile_lines,'a+')
-        np.savetxt(f,np.expand_dims(line_em,axis=0))
-        
-        f.close()
+        #line_em is either a single row or a 2D array with one row per source
+        record_writer('emlines', outfile_lines).append(emlines=line_em)
 
 # Dumps AGN SEDs
 def dump_AGN_SEDs(nu,fnu,luminosity):
@@ -350,58 +435,41 @@ def dump_AGN_SEDs(nu,fnu,luminosity):
     np.savez(outfile_bh,nu = nu,fnu = fnu, luminosity = luminosity)
                       
 
-def dump_NEB_SEDs(nu_arr, fnu_arr, pos_arr, append=True, clean_up=False):
-    
+def neb_sed_filename():
     if hasattr(cfg.model,'galaxy_num_str'):
-        outfile = cfg.model.PD_output_dir+"/neb_seds_galaxy_"+cfg.model.galaxy_num_str+".npz"
+        return cfg.model.PD_output_dir+"/neb_seds_galaxy_"+cfg.model.galaxy_num_str+".h5"
     else:
-        outfile = cfg.model.PD_output_dir+"/neb_seds.npz"
+        return cfg.model.PD_output_dir+"/neb_seds.h5"
+
+
+def dump_NEB_SEDs(nu_arr, fnu_arr, pos_arr, append=True, clean_up=False):
+
+    outfile = neb_sed_filename()
 
     if clean_up:
+        _record_writers.pop('neb_seds', None)
         os.remove(outfile)
         return
         
-    # If append is False then just save an empty npz file.
+    # If append is False then just start a new (empty) file.
     if not append:
-        np.savez(outfile)
+        _record_writers.pop('neb_seds', None)
+        record_writer('neb_seds', outfile)
         return
 
-    data = np.load(outfile)
-    
-    # If the npz file is not empty then the new data is appeneded 
-    # to the previous arrays
-    if (len(list(data.keys())) == 0):
-        fnu_arr_tot = np.atleast_2d(fnu_arr)
-        pos_arr_tot = np.atleast_2d(pos_arr)
-        
-    else:
-        fnu_old = np.atleast_2d(data["fnu"])
-        pos_old = np.atleast_2d(data["positions"])
-        pos_arr = np.atleast_2d(pos_arr)
-        fnu_arr = np.atleast_2d(fnu_arr)
-        fnu_arr_tot = np.append(fnu_old, fnu_arr, axis=0)
-        pos_arr_tot = np.append(pos_old, pos_arr, axis=0)
-
-    np.savez(outfile, nu=nu_arr, fnu=fnu_arr_tot, positions=pos_arr_tot)
+    writer = record_writer('neb_seds', outfile)
+    writer.set_static('nu', nu_arr)
+    writer.append(fnu=fnu_arr, positions=pos_arr)
 
 
+def load_NEB_SEDs():
 
-'''
-#def dump_emline(emline_wavelengths,emline_luminosity,append=True):
-def dump_emline(emline_wave,emline_lum,append=True):
+    #flushes anything still buffered and returns nu, fnu and the
+    #positions of all the nebular SEDs dumped so far
+    outfile = neb_sed_filename()
+    writer = _record_writers.get('neb_seds')
+    if writer is not None and writer.outfile == outfile:
+        return writer.load('nu', 'fnu', 'positions')
 
-    if hasattr(cfg.model, 'galaxy_num_str'):
-        outfile_lines = cfg.model.PD_output_dir + "emlines.galaxy" + cfg.model.galaxy_num_str + ".txt"
-    else:
-        outfile_lines = cfg.model.PD_output_dir + "emlines.galaxy.txt"
-
-    if append == False:
-        f = open(outfile_lines,'w')
-        #np.expand_dims sets up a dummy dimension so it saves as a row
-        np.savetxt(f,np.expand_dims(emline_wave,axis=0))
-        f.close()
-    else:
-        f = open(outfile_lines,'a+')
-        np.savetxt(f,emline_lum)#,fmt='%.18g', delimiter=' ', newline=os.linesep)
-        f.close()
-'''
+    with h5py.File(outfile, 'r') as f:
+        return f['nu'][:], f['fnu'][:], f['positions'][:]
@@ -8,7 +8,7 @@ mpl.use('Agg')
 import powderday.config as cfg
 
 from powderday.grid_construction import arepo_vornoi_grid_generate
-from hyperion.dust import SphericalDust
+from powderday.helpers import load_dust
 
 from powderday.helpers import energy_density_absorbed_by_CMB
 from powderday.tributary_dust_add import active_dust_add
@@ -115,16 +115,12 @@ def arepo_m_gen(fname,field_add):
             frac = {k: v / total for k, v in frac.items()}
 
             for size in frac.keys():
-                d = SphericalDust(cfg.par.dustdir+'%s.hdf5'%size)
-                if cfg.par.SUBLIMATION == True:
-                    d.set_sublimation_temperature('fast',temperature=cfg.par.SUBLIMATION_TEMPERATURE)
+                d = load_dust(cfg.par.dustdir+'%s.hdf5'%size)
                     #m.add_density_grid(dustdens * frac[size], cfg.par.dustdir+'%s.hdf5' % size)
                 m.add_density_grid(dustdens*frac[size],d,specific_energy=specific_energy)
             m.set_enforce_energy_range(cfg.par.enforce_energy_range)
         else:
-            d = SphericalDust(cfg.par.dustdir+cfg.par.dustfile)
-            if cfg.par.SUBLIMATION == True:
-                d.set_sublimation_temperature('fast',temperature=cfg.par.SUBLIMATION_TEMPERATURE)
+            d = load_dust(cfg.par.dustdir+cfg.par.dustfile)
             m.add_density_grid(dustdens,d,specific_energy=specific_energy)
         #m.add_density_grid(dustdens,cfg.par.dustdir+cfg.par.dustfile)  
 
@@ -517,5 +517,104 @@ def variable_set():
     except:
         cfg.par.OTF_EXTINCTION_MRN_FORCE = False
 
+
+    try:
+        cfg.par.SSP_CACHE
+    except:
+        cfg.par.SSP_CACHE = False
+
+    try:
+        cfg.par.SSP_CACHE_DIR
+    except:
+        cfg.par.SSP_CACHE_DIR = '~/.cache/powderday/ssp'
+
+
+    try:
+        cfg.par.SSP_GRID_INTERPOLATION
+    except:
+        cfg.par.SSP_GRID_INTERPOLATION = False
+
+
+    try:
+        cfg.par.STELLAR_BINNING
+    except:
+        cfg.par.STELLAR_BINNING = 'fixed'
+
+    try:
+        cfg.par.ADAPTIVE_BINNING_TOLERANCE
+    except:
+        cfg.par.ADAPTIVE_BINNING_TOLERANCE = 0.01
+
+
+    try:
+        cfg.par.cmdf_memo_logm_res
+    except:
+        cfg.par.cmdf_memo_logm_res = 0.01
+
+    try:
+        cfg.par.cmdf_memo_age_res
+    except:
+        cfg.par.cmdf_memo_age_res = 1.e-4
+
+
+    try:
+        cfg.par.SSP_LIBRARY_FILE
+    except:
+        cfg.par.SSP_LIBRARY_FILE = None
+
+
+    try:
+        cfg.par.OCTREE_CACHE
+    except:
+        cfg.par.OCTREE_CACHE = False
+
+    try:
+        cfg.par.OCTREE_CACHE_DIR
+    except:
+        cfg.par.OCTREE_CACHE_DIR = '~/.cache/powderday/octree'
+
+
+    try:
+        cfg.par.OCTREE_TAU_REFINEMENT
+    except:
+        cfg.par.OCTREE_TAU_REFINEMENT = False
+
+    try:
+        cfg.par.TAU_MERGE_THRESHOLD
+    except:
+        cfg.par.TAU_MERGE_THRESHOLD = 1.e-3
+
+    try:
+        cfg.par.TAU_REFINE_THRESHOLD
+    except:
+        cfg.par.TAU_REFINE_THRESHOLD = 1.
+
+    try:
+        cfg.par.TAU_REFINE_MAX_PASSES
+    except:
+        cfg.par.TAU_REFINE_MAX_PASSES = 3
+
+    try:
+        cfg.par.TAU_REFERENCE_WAVELENGTH
+    except:
+        cfg.par.TAU_REFERENCE_WAVELENGTH = 0.551
+
+
+    try:
+        cfg.par.OCTREE_PRUNE
+    except:
+        cfg.par.OCTREE_PRUNE = False
+
+    try:
+        cfg.par.OCTREE_PRUNE_TOLERANCE
+    except:
+        cfg.par.OCTREE_PRUNE_TOLERANCE = 0.
+
+
+    try:
+        cfg.par.DEPOSITION_KERNEL
+    except:
+        cfg.par.DEPOSITION_KERNEL = 'yt'
+
         
-    return cfg.par.FORCE_RANDOM_SEED, cfg.par.FORCE_BINNED, cfg.par.max_age_direct, cfg.par.imf1, cfg.par.imf2, cfg.par.imf3, cfg.par.use_cmdf, cfg.par.use_cloudy_tables, cfg.par.cmdf_min_mass, cfg.par.cmdf_max_mass, cfg.par.cmdf_bins, cfg.par.cmdf_beta, cfg.par.use_age_distribution, cfg.par.age_dist_min, cfg.par.age_dist_max, cfg.par.FORCE_gas_logu, cfg.par.gas_logu, cfg.par.gas_logu_init, cfg.par.FORCE_gas_logz, cfg.par.gas_logz, cfg.par.FORCE_logq, cfg.par.source_logq, cfg.par.FORCE_inner_radius, cfg.par.inner_radius, cfg.par.FORCE_N_O_Pilyugin, cfg.par.FORCE_N_O_ratio, cfg.par.N_O_ratio, cfg.par.neb_abund, cfg.par.add_young_stars, cfg.par.HII_Rinner_per_Rs, cfg.par.HII_nh, cfg.par.HII_min_age, cfg.par.HII_max_age, cfg.par.HII_dust, cfg.par.HII_escape_fraction, cfg.par.alpha_enhance, cfg.par.add_pagb_stars, cfg.par.PAGB_min_age, cfg.par.PAGB_max_age, cfg.par.PAGB_N_enhancement, cfg.par.PAGB_C_enhancement, cfg.par.PAGB_Rinner_per_Rs, cfg.par.PAGB_nh, cfg.par.PAGB_escape_fraction, cfg.par.add_AGN_neb, cfg.par.AGN_nh, cfg.par.AGN_num_gas, cfg.par.dump_emlines, cfg.par.cloudy_cleanup, cfg.par.BH_SED, cfg.par.IMAGING, cfg.par.SED, cfg.par.IMAGING_TRANSMISSION_FILTER, cfg.par.SED_MONOCHROMATIC, cfg.par.SKIP_RT, cfg.par.FIX_SED_MONOCHROMATIC_WAVELENGTHS, cfg.par.n_MPI_processes, cfg.par.SOURCES_RANDOM_POSITIONS, cfg.par.SUBLIMATION, cfg.par.SUBLIMATION_TEMPERATURE, cfg.model.TCMB, cfg.model.THETA, cfg.model.PHI, cfg.par.MANUAL_ORIENTATION, cfg.par.dust_grid_type, cfg.par.BH_model, cfg.par.BH_modelfile, cfg.par.BH_var, cfg.par.FORCE_STELLAR_AGES,cfg.par.FORCE_STELLAR_AGES_VALUE, cfg.par.FORCE_STELLAR_METALLICITIES, cfg.par.FORCE_STELLAR_METALLICITIES_VALUE, cfg.par.NEB_DEBUG, cfg.par.filterdir, cfg.par.filterfiles,  cfg.par.PAH_frac,cfg.par.otf_extinction, cfg.par.explicit_pah, cfg.par.draine21_pah_model, cfg.par.dust_density, cfg.par.add_DIG_neb, cfg.par.DIG_nh, cfg.par.DIG_min_logU, cfg.par.stars_max_dist, cfg.par.max_stars_num, cfg.par.use_black_sed, cfg.par.n_photons_DIG, cfg.par.SKIRT_DATA_DUMP, cfg.par.SAVE_NEB_SEDS, cfg.par.REMOVE_INPUT_SEDS,cfg.par.OTF_EXTINCTION_MRN_FORCE, cfg.par.separate_into_dust_species, cfg.par.OTF_EXTINCTION_MRN_FORCE
+    return cfg.par.FORCE_RANDOM_SEED, cfg.par.FORCE_BINNED, cfg.par.max_age_direct, cfg.par.imf1, cfg.par.imf2, cfg.par.imf3, cfg.par.use_cmdf, cfg.par.use_cloudy_tables, cfg.par.cmdf_min_mass, cfg.par.cmdf_max_mass, cfg.par.cmdf_bins, cfg.par.cmdf_beta, cfg.par.use_age_distribution, cfg.par.age_dist_min, cfg.par.age_dist_max, cfg.par.FORCE_gas_logu, cfg.par.gas_logu, cfg.par.gas_logu_init, cfg.par.FORCE_gas_logz, cfg.par.gas_logz, cfg.par.FORCE_logq, cfg.par.source_logq, cfg.par.FORCE_inner_radius, cfg.par.inner_radius, cfg.par.FORCE_N_O_Pilyugin, cfg.par.FORCE_N_O_ratio, cfg.par.N_O_ratio, cfg.par.neb_abund, cfg.par.add_young_stars, cfg.par.HII_Rinner_per_Rs, cfg.par.HII_nh, cfg.par.HII_min_age, cfg.par.HII_max_age, cfg.par.HII_dust, cfg.par.HII_escape_fraction, cfg.par.alpha_enhance, cfg.par.add_pagb_stars, cfg.par.PAGB_min_age, cfg.par.PAGB_max_age, cfg.par.PAGB_N_enhancement, cfg.par.PAGB_C_enhancement, cfg.par.PAGB_Rinner_per_Rs, cfg.par.PAGB_nh, cfg.par.PAGB_escape_fraction, cfg.par.add_AGN_neb, cfg.par.AGN_nh, cfg.par.AGN_num_gas, cfg.par.dump_emlines, cfg.par.cloudy_cleanup, cfg.par.BH_SED, cfg.par.IMAGING, cfg.par.SED, cfg.par.IMAGING_TRANSMISSION_FILTER, cfg.par.SED_MONOCHROMATIC, cfg.par.SKIP_RT, cfg.par.FIX_SED_MONOCHROMATIC_WAVELENGTHS, cfg.par.n_MPI_processes, cfg.par.SOURCES_RANDOM_POSITIONS, cfg.par.SUBLIMATION, cfg.par.SUBLIMATION_TEMPERATURE, cfg.model.TCMB, cfg.model.THETA, cfg.model.PHI, cfg.par.MANUAL_ORIENTATION, cfg.par.dust_grid_type, cfg.par.BH_model, cfg.par.BH_modelfile, cfg.par.BH_var, cfg.par.FORCE_STELLAR_AGES,cfg.par.FORCE_STELLAR_AGES_VALUE, cfg.par.FORCE_STELLAR_METALLICITIES, cfg.par.FORCE_STELLAR_METALLICITIES_VALUE, cfg.par.NEB_DEBUG, cfg.par.filterdir, cfg.par.filterfiles,  cfg.par.PAH_frac,cfg.par.otf_extinction, cfg.par.explicit_pah, cfg.par.draine21_pah_model, cfg.par.dust_density, cfg.par.add_DIG_neb, cfg.par.DIG_nh, cfg.par.DIG_min_logU, cfg.par.stars_max_dist, cfg.par.max_stars_num, cfg.par.use_black_sed, cfg.par.n_photons_DIG, cfg.par.SKIRT_DATA_DUMP, cfg.par.SAVE_NEB_SEDS, cfg.par.REMOVE_INPUT_SEDS,cfg.par.OTF_EXTINCTION_MRN_FORCE, cfg.par.separate_into_dust_species, cfg.par.OTF_EXTINCTION_MRN_FORCE, cfg.par.SSP_CACHE, cfg.par.SSP_CACHE_DIR, cfg.par.SSP_GRID_INTERPOLATION, cfg.par.STELLAR_BINNING, cfg.par.ADAPTIVE_BINNING_TOLERANCE, cfg.par.cmdf_memo_logm_res, cfg.par.cmdf_memo_age_res, cfg.par.SSP_LIBRARY_FILE, cfg.par.OCTREE_CACHE, cfg.par.OCTREE_CACHE_DIR, cfg.par.OCTREE_TAU_REFINEMENT, cfg.par.TAU_MERGE_THRESHOLD, cfg.par.TAU_REFINE_THRESHOLD, cfg.par.TAU_REFINE_MAX_PASSES, cfg.par.TAU_REFERENCE_WAVELENGTH, cfg.par.OCTREE_PRUNE, cfg.par.OCTREE_PRUNE_TOLERANCE, cfg.par.DEPOSITION_KERNEL
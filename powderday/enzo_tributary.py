@@ -5,7 +5,7 @@ from hyperion.grid import AMRGrid
 import powderday.config as cfg
 from powderday.analytics import proj_plots
 from powderday.helpers import energy_density_absorbed_by_CMB
-from hyperion.dust import SphericalDust
+from powderday.helpers import load_dust
 from powderday.grid_construction import enzo_grid_generate
 import yt
 import os
@@ -115,9 +115,7 @@ def enzo_m_gen(fname,field_add):
     #energy_density_absorbed=energy_density_absorbed_by_CMB()
     #energy_density_absorbed =np.repeat(energy_density_absorbed.value,reg.index.num_grids)#amr['density'].shape)
 
-    d = SphericalDust(cfg.par.dustdir+cfg.par.dustfile)
-    if cfg.par.SUBLIMATION == True:
-        d.set_sublimation_temperature('fast',temperature=cfg.par.SUBLIMATION_TEMPERATURE)
+    d = load_dust(cfg.par.dustdir+cfg.par.dustfile)
         
     m.add_density_grid(amr["density"],d)
     #uncomment when we're ready to put CMB in (and comment out previous line)
@@ -10,6 +10,32 @@ def check_parameter_compatibility():
         except AssertionError:
             raise AssertionError("otf_extinction is set in parameters_master: this means the dust_grid_type must be manual.  it is currently set as something else.")
 
+    try:
+        assert(cfg.par.DEPOSITION_KERNEL in ['yt','powderday'])
+    except AssertionError:
+        raise AssertionError("DEPOSITION_KERNEL in parameters_master must be either 'yt' or 'powderday'.")
+
+    if cfg.par.OCTREE_TAU_REFINEMENT==True:
+        #these compute per-cell quantities on the octree yt built, which
+        #no longer matches the refined one
+        try:
+            assert(cfg.par.otf_extinction == False and cfg.par.add_DIG_neb == False and cfg.par.draine21_pah_model == False)
+        except AssertionError:
+            raise AssertionError("OCTREE_TAU_REFINEMENT is set in parameters_master: this can not be combined with otf_extinction, add_DIG_neb or draine21_pah_model, one of which is set.")
+        try:
+            assert(cfg.par.TAU_MERGE_THRESHOLD < cfg.par.TAU_REFINE_THRESHOLD)
+        except AssertionError:
+            raise AssertionError("OCTREE_TAU_REFINEMENT is set in parameters_master: TAU_MERGE_THRESHOLD must be smaller than TAU_REFINE_THRESHOLD.")
+
+    if cfg.par.OCTREE_PRUNE==True:
+        #the DIG and PAH models look up per-cell quantities (gas
+        #metallicities, cell sizes) on the octree yt built, which no
+        #longer matches the pruned one
+        try:
+            assert(cfg.par.add_DIG_neb == False and cfg.par.draine21_pah_model == False)
+        except AssertionError:
+            raise AssertionError("OCTREE_PRUNE is set in parameters_master: this can not be combined with add_DIG_neb or draine21_pah_model, one of which is set.")
+
 
 def file_exist(fname):
     if os.path.isfile(fname) == True: pass
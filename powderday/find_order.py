@@ -1,32 +1,11 @@
 import numpy as np
+from powderday.octree_tools import OctreeTraversal
 
 def find_order(refined):
     """
     Find the index array to use to sort the ``refined`` and ``density`` arrays.
     """
 
-    order = np.zeros(refined.shape)
-
-    if not refined[0]:
-        return [0]
-
-
-    def find_nested(i):
-        cells = [i]
-        for cell in range(8):
-            i += 1
-
-            if i >= len(refined):
-                return i,np.hstack(cells)
-
-            if refined[i]:
-                parent = i
-                i, sub_cells = find_nested(i)
-                cells.append(sub_cells)
-            else:
-                cells.append(i)
-        cells = [cells[j] for j in [0,1,5,3,7,2,6,4,8]]
-        return i, np.hstack(cells)
-    
-    return find_nested(0)[1]
-    
+    #see octree_tools.OctreeTraversal; the octree is no longer walked
+    #recursively, so arbitrarily deep octrees are fine
+    return OctreeTraversal(refined).order
@@ -135,22 +135,32 @@ def compute_ISRF_SED(m, par, model):
         m.run(model.outputfile + '_isrf.sed', mpi=False, overwrite=True)
 
     
+#filter banks read so far in this process, so that every galaxy of a
+#batch run reuses them
+_filter_banks = {}
+
+def load_filters(par):
+    key = (par.filterdir,tuple(par.filterfiles))
+    if key not in _filter_banks:
+        try:
+            _filter_banks[key] = [np.loadtxt(par.filterdir+f) for f in par.filterfiles]
+        except:
+            raise ValueError("Filters not found. You may be running above changeset 'f1f16eb' with an outdated parameters_master file. Please update to the most recent parameters_master format or ensure that the'filterdir' and 'filterfiles' parameters are set properly.")
+    return _filter_banks[key]
+
+    
 def make_image(m_imaging, par, model,dx,dy,dz):
     print("Beginning Monochromatic Imaging RT")
     
     if cfg.par.IMAGING_TRANSMISSION_FILTER == False:
         
         # read in the filters file
-        try:
-            filter_data = [np.loadtxt(par.filterdir+f) for f in par.filterfiles]
-        except:
-            raise ValueError("Filters not found. You may be running above changeset 'f1f16eb' with an outdated parameters_master file. Please update to the most recent parameters_master format or ensure that the'filterdir' and 'filterfiles' parameters are set properly.")
+        filter_data = load_filters(par)
             
         # Extract and flatten all wavelengths in the filter files
 
         wavs = []
-        for single_filter in par.filterfiles:
-            single_filter_data = np.loadtxt(par.filterdir+'/'+single_filter)
+        for single_filter_data in filter_data:
             wavs.append(single_filter_data[:,0])
 
 
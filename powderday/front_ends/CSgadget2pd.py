@@ -3,6 +3,7 @@ import numpy as np
 import yt
 from yt.fields.particle_fields import add_volume_weighted_smoothed_field
 import powderday.config as cfg
+from powderday.front_ends.cosmology_tools import cosmic_time_table
 
 
 def gadget_field_add(fname,bounding_box = None,ds=None,starages=False):
@@ -101,13 +102,12 @@ def gadget_field_add(fname,bounding_box = None,ds=None,starages=False):
         return (data[('deposit', 'PartType0_smoothed_metalmass')].value)
 
     def _stellarages(field,data):
-        ad = data.ds.all_data()
         if data.ds.cosmological_simulation == False:
 
             simtime = data.ds.current_time.in_units('Gyr')
             simtime = simtime.value
 
-            age = simtime-ad[("starformationtime")].value #Gyr (assumes that ad["starformationtime"] is in Gyr for Gadget)
+            age = simtime-data[("starformationtime")].value #Gyr (assumes that data["starformationtime"] is in Gyr for Gadget)
             #make the minimum age 1 million years 
             age[np.where(age < 1.e-3)[0]] = 1.e-3
             
@@ -116,14 +116,10 @@ def gadget_field_add(fname,bounding_box = None,ds=None,starages=False):
             print ('[SED_gen/star_list_gen: ] Idealized Galaxy Simulation Assumed: Simulation time is (Gyr): ',simtime)
             print ('--------------\n')
         else:
-            yt_cosmo = yt.utilities.cosmology.Cosmology(hubble_constant=data.ds.hubble_constant,
-                                                        omega_matter=data.ds.omega_matter,
-                                                        omega_lambda=data.ds.omega_lambda)
-            simtime = yt_cosmo.t_from_z(ds.current_redshift).in_units('Gyr').value  # Current age of the universe
-            scalefactor = ad[("starformationtime")].value
-            formation_z = (1. / scalefactor) - 1.
-            formation_time = yt_cosmo.t_from_z(formation_z).in_units('Gyr').value
-            age = simtime - formation_time
+            cosmic_time = cosmic_time_table(data.ds)
+            simtime = cosmic_time.simtime  # Current age of the universe
+            scalefactor = data[("starformationtime")].value
+            age = cosmic_time.ages(scalefactor)
             # Minimum age is set to 1 Myr (FSPS doesn't work properly for ages below 1 Myr)
             age[np.where(age < 1.e-3)[0]] = 1.e-3
 
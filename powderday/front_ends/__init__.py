@@ -1,5 +1,15 @@
-from . import enzo2pd
-from . import front_end_controller
-from . import gadget2pd
-from . import tipsy2pd
-from . import arepo2pd
+#the front ends are imported the first time they are accessed (see
+#powderday/__init__.py); each of them imports yt.
+import importlib
+
+_submodules = ['enzo2pd', 'front_end_controller', 'gadget2pd', 'tipsy2pd', 'arepo2pd']
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + _submodules)
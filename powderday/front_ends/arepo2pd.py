@@ -11,6 +11,7 @@ import numpy as np
 import yt
 #from yt.fields.particle_fields import add_volume_weighted_smoothed_field
 import powderday.config as cfg
+from powderday.front_ends.cosmology_tools import cosmic_time_table
 from powderday.mlt.dgr_extrarandomtree_part import dgr_ert
 #from yt.data_objects.particle_filters import add_particle_filter
 
@@ -142,7 +143,6 @@ def arepo_field_add(fname, bounding_box=None, ds=None):
         #return (ad['PartType3','Coordinates'])
 
     def _stellarages(field, data):
-        ad = data.ds.all_data()
         if data.ds.cosmological_simulation == False:
 
             simtime = data.ds.current_time.in_units('Gyr')
@@ -155,7 +155,7 @@ def arepo_field_add(fname, bounding_box=None, ds=None):
             print("if this is not true - please edit _stellarages in front_ends/arepo2pd.py right under this warning message")
             print("------------------------------------------------------------------")
 
-            age = simtime-(data.ds.arr(ad[("newstars","GFM_StellarFormationTime")],'s*kpc/km').in_units('Gyr')).value
+            age = simtime-(data.ds.arr(data[("newstars","GFM_StellarFormationTime")],'s*kpc/km').in_units('Gyr')).value
             # make the minimum age 1 million years
             age[np.where(age < 1.e-3)[0]] = 1.e-3
 
@@ -164,14 +164,10 @@ def arepo_field_add(fname, bounding_box=None, ds=None):
                 '[arepo2pd: ] Idealized Galaxy Simulation Assumed: Simulation time is (Gyr): ', simtime)
             print('--------------\n')
         else:
-            yt_cosmo = yt.utilities.cosmology.Cosmology(hubble_constant=data.ds.hubble_constant,
-                                                        omega_matter=data.ds.omega_matter,
-                                                        omega_lambda=data.ds.omega_lambda)
-            simtime = yt_cosmo.t_from_z(ds.current_redshift).in_units('Gyr').value # Current age of the universe
+            cosmic_time = cosmic_time_table(data.ds)
+            simtime = cosmic_time.simtime # Current age of the universe
             scalefactor = data[("newstars","GFM_StellarFormationTime")].value
-            formation_z = (1./scalefactor)-1.
-            formation_time = yt_cosmo.t_from_z(formation_z).in_units('Gyr').value
-            age = simtime - formation_time
+            age = cosmic_time.ages(scalefactor)
             # Minimum age is set to 1 Myr (FSPS doesn't work properly for ages below 1 Myr)
             age[np.where(age < 1.e-3)[0]] = 1.e-3
 
@@ -86,7 +86,6 @@ def gadget_field_add(fname,bounding_box = None,ds=None,starages=False):
         return (data[('deposit', 'PartType0_smoothed_metalmass')].value)
 
     def _stellarages(field,data):
-        ad = data.ds.all_data()
         if data.ds.cosmological_simulation == False:
 
             #we assume that the romeel stellar ages are the same as
@@ -96,7 +95,7 @@ def gadget_field_add(fname,bounding_box = None,ds=None,starages=False):
             simtime = data.ds.current_time.in_units('yr')
             simtime = simtime.value
 
-            age = simtime-ad[("starformationtime")].value #yr (assumes that ad["starformationtime"] is in Myr for benopp/romeel Gadget)
+            age = simtime-data[("starformationtime")].value #yr (assumes that data["starformationtime"] is in Myr for benopp/romeel Gadget)
             #make the minimum age 1 million years 
             age[np.where(age < 1.e6)[0]] = 1.e6
             
@@ -108,7 +107,7 @@ def gadget_field_add(fname,bounding_box = None,ds=None,starages=False):
             simtime = data.ds.current_time.in_units('Gyr')
             simtime = simtime.value
 
-            age = ad["starformationtime"].value #yr
+            age = data["starformationtime"].value #yr
             #make the minimum age 1 million years 
 
             if len(np.where(age < 1.e6)[0]) > 0:
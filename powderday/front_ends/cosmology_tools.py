@@ -0,0 +1,46 @@
+from __future__ import print_function
+import numpy as np
+import yt
+
+#cosmic time lookup for the front ends.  yt's Cosmology.t_from_z
+#integrates the Friedmann equation for every value it is handed, so
+#instead we tabulate t(a) once per dataset on a dense, monotonic grid
+#in log(a) and evaluate the stellar ages of every chunk with np.interp.
+
+
+class CosmicTimeTable:
+
+    def __init__(self, ds, amin=1.e-3, npoints=8192):
+        yt_cosmo = yt.utilities.cosmology.Cosmology(hubble_constant=ds.hubble_constant,
+                                                    omega_matter=ds.omega_matter,
+                                                    omega_lambda=ds.omega_lambda)
+
+        #the table runs from amin to (at least) the current scale
+        #factor.  t(a) is smooth in log(a) (t ~ a^1.5 in the matter
+        #dominated era), so with the default spacing (~4e-4 dex) the
+        #interpolation error is ~1 kyr.
+        amax = max(1., 1./(1.+ds.current_redshift))
+        a = np.logspace(np.log10(amin), np.log10(amax), npoints)
+
+        self.log_a = np.log10(a)
+        self.time = yt_cosmo.t_from_z(1./a-1.).in_units('Gyr').value
+        self.simtime = yt_cosmo.t_from_z(ds.current_redshift).in_units('Gyr').value  # Current age of the universe
+
+    def t_from_a(self, scalefactor):
+        #cosmic time (Gyr) at the given scale factors
+        return np.interp(np.log10(scalefactor), self.log_a, self.time)
+
+    def ages(self, scalefactor):
+        #ages (Gyr) today of stars formed at the given scale factors
+        return self.simtime - self.t_from_a(scalefactor)
+
+
+def cosmic_time_table(ds):
+
+    #the table is built once per dataset and then reused by every chunk
+    #the stellar age fields are evaluated on
+    table = getattr(ds, '_pd_cosmic_time_table', None)
+    if table is None:
+        table = CosmicTimeTable(ds)
+        ds._pd_cosmic_time_table = table
+    return table
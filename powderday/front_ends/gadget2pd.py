@@ -14,7 +14,9 @@ import numpy as np
 import yt
 #from yt.fields.particle_fields import add_volume_weighted_smoothed_field
 import powderday.config as cfg
+from powderday.front_ends.cosmology_tools import cosmic_time_table
 from powderday.mlt.dgr_extrarandomtree_part import dgr_ert
+from powderday.octree_cache import OctreeCache
 
 def gadget_field_add(fname, bounding_box=None, ds=None,add_smoothed_quantities=True):
 
@@ -213,12 +215,11 @@ def gadget_field_add(fname, bounding_box=None, ds=None,add_smoothed_quantities=T
         return data['dust','mass']
 
     def _stellarages(field, data):
-        ad = data.ds.all_data()
         if data.ds.cosmological_simulation == False:
             simtime = data.ds.current_time.in_units('Gyr')
             simtime = simtime.value
 
-            age = simtime-data.ds.arr(ad[('PartType4', 'StellarFormationTime')],'Gyr').value
+            age = simtime-data.ds.arr(data[('PartType4', 'StellarFormationTime')],'Gyr').value
             # make the minimum age 1 million years
             age[np.where(age < 1.e-3)[0]] = 1.e-3
 
@@ -227,14 +228,10 @@ def gadget_field_add(fname, bounding_box=None, ds=None,add_smoothed_quantities=T
                 '[gadget2pd: ] Idealized Galaxy Simulation Assumed: Simulation time is (Gyr): ', simtime)
             print('--------------\n')
         else:
-            yt_cosmo = yt.utilities.cosmology.Cosmology(hubble_constant=data.ds.hubble_constant,
-                                                        omega_matter=data.ds.omega_matter,
-                                                        omega_lambda=data.ds.omega_lambda)
-            simtime = yt_cosmo.t_from_z(ds.current_redshift).in_units('Gyr').value # Current age of the universe
+            cosmic_time = cosmic_time_table(data.ds)
+            simtime = cosmic_time.simtime # Current age of the universe
             scalefactor = data[('PartType4', 'StellarFormationTime')].value
-            formation_z = (1./scalefactor)-1.
-            formation_time = yt_cosmo.t_from_z(formation_z).in_units('Gyr').value
-            age = simtime - formation_time
+            age = cosmic_time.ages(scalefactor)
             # Minimum age is set to 1 Myr (FSPS doesn't work properly for ages below 1 Myr)
             age[np.where(age < 1.e-3)[0]] = 1.e-3
 
@@ -357,7 +354,14 @@ def gadget_field_add(fname, bounding_box=None, ds=None,add_smoothed_quantities=T
         left = np.array([pos[0] for pos in bounding_box])
         right = np.array([pos[1] for pos in bounding_box])
         #octree = ds.octree(left, right, over_refine_factor=cfg.par.oref, n_ref=cfg.par.n_ref, force_build=True)
-        octree = ds.octree(left,right,n_ref=cfg.par.n_ref)
+        #(the octree and the fields deposited onto it are cached; see
+        #octree_cache.py).  the gas density, masses and metals
+        #(including every species the snapshot has) are deposited in
+        #one pass
+        gas_fields = [('PartType0','density'),('PartType0','Masses'),('PartType0','metallicity')]
+        gas_fields += [('PartType0',el+'_metallicity') for el in ['He','C','N','O','Ne','Mg','Si','S','Ca','Fe']]
+        gas_fields = [field for field in gas_fields if field in ds.derived_field_list]
+        octree = OctreeCache(ds,left,right,n_ref=cfg.par.n_ref,fused_fields=gas_fields)
         ds.parameters['octree'] = octree
 
     print ('BOUNDING BOX:', bounding_box, 'LEFT: ', left, 'RIGHT: ', right)
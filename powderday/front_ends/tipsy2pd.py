@@ -4,6 +4,7 @@ import powderday.config as cfg
 from yt.config import ytcfg
 from yt.data_objects.particle_filters import add_particle_filter
 from powderday.mlt.dgr_extrarandomtree_part import dgr_ert
+from powderday.octree_cache import OctreeCache
 from unyt import G
 
 #ytcfg["yt","skip_dataset_cache"] = "True"
@@ -24,7 +25,6 @@ def tipsy_field_add(fname,bounding_box = None ,ds=None,add_smoothed_quantities=T
         return data[("newstars", "FormationTime")]
 
     def _stellarages(field,data):
-        ad = data.ds.all_data()
         simtime = data.ds.current_time.in_units('Gyr')
         simtime = simtime.value
         age = simtime - data[("newstars","FormationTime")].in_units('Gyr').value
@@ -150,7 +150,10 @@ def tipsy_field_add(fname,bounding_box = None ,ds=None,add_smoothed_quantities=T
         left = np.array([pos[0] for pos in bounding_box])
         right = np.array([pos[1] for pos in bounding_box])
         # Add option for scatter vs gather to parameters_master file?
-        octree = ds.octree(left,right,n_ref=cfg.par.n_ref)
+        #(the octree and the fields deposited onto it are cached; see
+        #octree_cache.py).  the gas density, metals and masses are
+        #deposited in one pass
+        octree = OctreeCache(ds,left,right,n_ref=cfg.par.n_ref,fused_fields=[("Gas","Density"),("Gas","Metals"),("Gas","Mass")])
         ds.parameters['octree'] = octree
     
 
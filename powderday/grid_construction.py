@@ -13,10 +13,12 @@ from powderday.dust_grid_gen import dtm_grid_oct, remy_ruyer_oct, manual_oct,li_
 from powderday.dust_grid_gen import dtm_particle_mesh,manual_particle_mesh,remy_ruyer_particle_mesh,li_bestfit_particle_mesh,li_ml_particle_mesh
 from powderday.dust_grid_gen import dtm_amr,remy_ruyer_amr,li_bestfit_amr,li_ml_amr
 from powderday.analytics import proj_plots
+from powderday.octree_tools import OctreeTraversal,HYPERION_CHILD_SIGNS,octree_cell_geometry,collapse_octree_cells,split_octree_cells
 
 import yt
 import pdb
 import os
+import h5py
 
 random.seed('octree-demo')
 
@@ -37,21 +39,8 @@ def find_max_level(refined):
 
 def yt_octree_generate(fname, field_add):
 
-    print('[grid_construction]: bbox_lim = ', cfg.par.bbox_lim)
-
-    bbox = [[-2.*cfg.par.bbox_lim, 2.*cfg.par.bbox_lim],
-            [-2.*cfg.par.bbox_lim, 2.*cfg.par.bbox_lim],
-            [-2.*cfg.par.bbox_lim, 2.*cfg.par.bbox_lim]]
-
-    # load the DS and add pd fields.  this is the first field addition
-    # of the simulation, so we don't yet need to add the smoothed
-    # quantities (which can take some time in yt4.x).
-    ds = field_add(fname, bounding_box=bbox,add_smoothed_quantities=False)
-
-        
-
-    #now zoom in.
-    reg = octree_zoom_bbox_filter(fname, ds, bbox, field_add)
+    # load the DS, zoomed in, and add pd fields.
+    reg, ds = octree_zoom_bbox_filter(fname, field_add)
 
     
     # ---------------------------------------------------------------
@@ -125,14 +114,10 @@ def yt_octree_generate(fname, field_add):
     #try:
     #    refined.reshape(len(ir1))
     #except:
+    #every leaf cell is expanded into 2**(3*oref) (unrefined) cells
     refinements = 2**(3*cfg.par.oref)
-    refined2 = []
-    for r in refined:
-        if r == 1:
-            refined2.append(True)
-        if r == 0:
-            refined2.append(np.zeros(refinements).astype('bool'))
-    refined = np.hstack(refined2)
+    refined = np.asarray(refined).astype('bool')
+    refined = np.repeat(refined, np.where(refined, 1, refinements))
 
 
     if cfg.par.CONSTANT_DUST_GRID == False:
@@ -176,6 +161,72 @@ def yt_octree_generate(fname, field_add):
     return refined, dust_smoothed, fc1, fw1, reg, ds
 
 
+def reference_opacity():
+
+    #dust mass extinction coefficient (cm^2/g) of cfg.par.dustfile at
+    #cfg.par.TAU_REFERENCE_WAVELENGTH (micron)
+    with h5py.File(cfg.par.dustdir+cfg.par.dustfile,'r') as df:
+        nu = df['optical_properties']['nu'][:]
+        chi = df['optical_properties']['chi'][:]
+    nu_ref = 2.99792458e10/(cfg.par.TAU_REFERENCE_WAVELENGTH*1.e-4)
+    idx = np.argsort(nu)
+    return float(np.interp(nu_ref,nu[idx],chi[idx]))
+
+
+def tau_adaptive_octree(refined,dustdens,root_width,sampler):
+
+    #adapts a hyperion-ordered octree to the dust optical depth across
+    #its cells, tau = kappa * rho_dust * cell width, at
+    #TAU_REFERENCE_WAVELENGTH.  families of 8 leaves that would together
+    #be thinner than TAU_MERGE_THRESHOLD are merged into their parent
+    #(repeatedly, so whole optically thin subtrees collapse), and then
+    #leaves thicker than TAU_REFINE_THRESHOLD are split, for at most
+    #TAU_REFINE_MAX_PASSES levels.  merged cells get the mean of their
+    #children's density, so the dust mass is conserved; split cells
+    #share their dust mass among their children following the gas
+    #density that sampler (an SPHSampler, in cm and g, centred on the
+    #root cell) estimates at the children's centres.  returns the new
+    #refined and dustdens arrays (hyperion order)
+    kappa = reference_opacity()
+    root_width = np.asarray(root_width,dtype=float)
+    ncells_in = len(refined)
+
+    refined = np.asarray(refined,dtype=bool)
+    dustdens = np.asarray(dustdens,dtype=float)
+
+    #merge optically thin families, from the deepest level up
+    while True:
+        traversal = OctreeTraversal(refined)
+        family = np.flatnonzero(refined & (traversal.subtree_size == 9))
+        if len(family) == 0: break
+        size = np.cbrt(np.prod(root_width))/2.**traversal.depth[family]
+        rho = np.mean(dustdens[family[:,np.newaxis]+1+np.arange(8)],axis=1)
+        merge = family[kappa*rho*size < cfg.par.TAU_MERGE_THRESHOLD]
+        if len(merge) == 0: break
+        refined,dustdens = collapse_octree_cells(refined,dustdens,merge)
+
+    #split optically thick leaves
+    for npass in range(cfg.par.TAU_REFINE_MAX_PASSES):
+        traversal = OctreeTraversal(refined)
+        center,width = octree_cell_geometry(refined,root_width,traversal)
+        tau = kappa*dustdens*np.cbrt(np.prod(width,axis=1))
+        split = np.flatnonzero(~refined & (tau > cfg.par.TAU_REFINE_THRESHOLD) & (traversal.depth < 20))
+        if len(split) == 0: break
+
+        child_centers = center[split][:,np.newaxis,:]+HYPERION_CHILD_SIGNS[np.newaxis,:,:]*width[split][:,np.newaxis,:]/4.
+        gas = sampler.density(child_centers.reshape(-1,3)).reshape(-1,8)
+        mean_gas = np.mean(gas,axis=1)
+        weight = np.ones_like(gas)
+        has_gas = mean_gas > 0
+        weight[has_gas] = gas[has_gas]/mean_gas[has_gas][:,np.newaxis]
+
+        refined,dustdens = split_octree_cells(refined,dustdens,split,dustdens[split][:,np.newaxis]*weight)
+
+    print('[grid_construction/tau_adaptive_octree:] kappa(%g micron) = %g cm^2/g' % (cfg.par.TAU_REFERENCE_WAVELENGTH,kappa))
+    print('[grid_construction/tau_adaptive_octree:] %d cells -> %d cells' % (ncells_in,len(refined)))
+    return refined,dustdens
+
+
 def enzo_grid_generate(fname,field_add):
     #call the front end (frontends/enzo2pd) to add the fields in powderday format
 
@@ -215,19 +266,8 @@ def enzo_grid_generate(fname,field_add):
 
 def arepo_vornoi_grid_generate(fname, field_add):
 
-    print('[grid_construction/arepo_vornoi_grid_generate]: bbox_lim = ', cfg.par.bbox_lim)
-
-    bbox = [[-2.*cfg.par.bbox_lim, 2.*cfg.par.bbox_lim],
-            [-2.*cfg.par.bbox_lim, 2.*cfg.par.bbox_lim],
-            [-2.*cfg.par.bbox_lim, 2.*cfg.par.bbox_lim]]
-
-    # load the DS and add pd fields.  this is the first field addition
-    # of the simulation, so we don't yet need to add the smoothed
-    # quantities (which can take some time in yt4.x).
-    ds = field_add(fname, bounding_box=bbox)
-
-    #now zoom in.
-    reg = arepo_zoom(fname, ds, bbox, field_add)
+    # load the DS, zoomed in, and add pd fields.
+    reg, ds = arepo_zoom(fname, field_add)
 
 
     # ---------------------------------------------------------------
@@ -308,12 +348,8 @@ def grid_coordinate_boost(xmin, xmax, ymin, ymax, zmin, zmax):
 
 def stars_coordinate_boost(star_list, boost):
 
-    # center the stars
-    nstars = len(star_list)
-    for i in range(nstars):
-        star_list[i].positions[0] -= boost[0]
-        star_list[i].positions[1] -= boost[1]
-        star_list[i].positions[2] -= boost[2]
+    # center the stars (star_list is a SED_gen.StarCatalog)
+    star_list.positions -= np.asarray(boost)[np.newaxis,:]
     return star_list
 
 
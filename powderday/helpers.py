@@ -4,12 +4,56 @@ from astropy import units as u
 # from astropy.modeling.blackbody import blackbody_lambda,blackbody_nu
 from astropy.modeling.models import BlackBody
 import h5py
+import os
+from hyperion.dust import SphericalDust
+
+#hyperion dust models read so far in this process (see load_dust)
+_dust_models = {}
+
+def load_dust(filename,sublimation=True):
+    #reads a hyperion dust model once per process, so that every galaxy
+    #of a batch run (and every dust grid of a run) reuses it.  a file
+    #that is rewritten (e.g. by the active dust file writer) is read
+    #again.  if sublimation is True, the sublimation settings from the
+    #parameters file are applied.
+    key = (filename,os.path.getmtime(filename),sublimation and cfg.par.SUBLIMATION,cfg.par.SUBLIMATION_TEMPERATURE)
+
+    if key not in _dust_models:
+        d = SphericalDust(filename)
+        if sublimation and cfg.par.SUBLIMATION == True:
+            d.set_sublimation_temperature('fast',temperature=cfg.par.SUBLIMATION_TEMPERATURE)
+        _dust_models[key] = d
+
+    return _dust_models[key]
+
+
+#np.trapz was renamed np.trapezoid in numpy 2 (and np.trapz is gone in
+#the later releases)
+trapz = getattr(np,'trapezoid',None) or np.trapz
+
 
 def find_nearest(array,value):
     idx = (np.abs(array-value)).argmin()
     
     return idx
 
+def find_nearest_sorted(array,values):
+    #vectorized find_nearest for a sorted (ascending) array: returns
+    #the index of the nearest element of array for every entry in
+    #values.  like find_nearest, ties go to the lower index.
+    array = np.asarray(array)
+    values = np.asarray(values)
+
+    if len(array) == 1:
+        return np.zeros(values.shape,dtype=int)
+
+    idx = np.searchsorted(array,values,side='left')
+    idx = np.clip(idx,1,len(array)-1)
+    idx -= np.abs(values-array[idx-1]) <= np.abs(array[idx]-values)
+
+    #repeated elements: the first of them, as with np.argmin
+    return np.searchsorted(array,array[idx],side='left')
+
 def get_J_CMB():
     #returns the mean intensity for the CMB integrated over min_lam to
     #max_lam (i.e. returns erg/s/cm**2; the same thing as doing 4*sigma
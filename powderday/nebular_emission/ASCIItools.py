@@ -6,16 +6,9 @@ import os
 import numpy as np
 import subprocess
 from powderday.nebular_emission.cloudy_tools import grouper
-#getting cfg.par accessible outside the definitions (ala pd_front_end.py)
+#the parameters are the ones pd_front_end.py has set in cfg.par (for
+#every model of a batch), not read from the command line
 import powderday.config as cfg
-import sys
-#script, pardir, parfile, modelfile = sys.argv
-print(sys.argv)
-sys.path.insert(0, sys.argv[1])
-par = __import__(sys.argv[2])
-model = __import__(sys.argv[3])
-cfg.par = par  # re-write cfg.par for all modules that read this in now
-cfg.model = model
 
 """
 --------------------------------------------------------------------------------------
@@ -0,0 +1,260 @@
+from __future__ import print_function
+import numpy as np
+import powderday.config as cfg
+import hashlib
+import h5py
+import os
+import tempfile
+from urllib.parse import quote
+
+from powderday.octree_tools import OctreeTraversal
+from powderday.sph_deposit import deposit
+
+#cache of the yt octree and of everything deposited onto it.  the front
+#ends put an OctreeCache in ds.parameters['octree'] in place of the yt
+#octree itself; every field that is asked of it is then looked up in
+#memory, then (if OCTREE_CACHE is set) in a cache directory on disk, and
+#only if neither has it is the octree built and the field deposited
+#(by yt, or with DEPOSITION_KERNEL = 'powderday' by the multiprocess
+#kernel in sph_deposit.py).
+#
+#the directory is keyed on the size and modification time of every file of
+#the snapshot, n_ref, oref, the octree bounding box, the deposition
+#kernel and the dust model settings that change what is deposited
+#(otf_extinction, which adds the dust particles to the deposition, and
+#dust_grid_type).  dust parameters that are applied after the
+#deposition (dust to metals ratios, the dust file, ...) and the
+#radiative transfer settings are not part of the key, so sweeps over
+#those reuse the octree.
+
+
+def snapshot_files(ds):
+
+    #every file of the snapshot: multi-file snapshots (snap.N.hdf5)
+    #are described by yt's filename_template and file_count
+    template = getattr(ds,'filename_template',None)
+    nfiles = getattr(ds,'file_count',None) or 1
+    if template is None or nfiles <= 1:
+        return [ds.filename]
+    return [template % {'num':i} for i in range(nfiles)]
+
+
+def snapshot_signature(ds):
+
+    #(path, size, modification time) of every file of the snapshot.
+    #cheap to get, unlike a checksum of the contents, and a rewritten
+    #file of any part of the snapshot changes it
+    signature = []
+    for fname in snapshot_files(ds):
+        stat = os.stat(fname)
+        signature.append((os.path.abspath(fname),stat.st_size,stat.st_mtime_ns))
+    return signature
+
+
+def octree_cache_key(ds,left,right,n_ref):
+    import yt
+    signature = [('snapshot',snapshot_signature(ds)),
+                 ('n_ref',int(n_ref)),
+                 ('oref',int(cfg.par.oref)),
+                 ('left',np.asarray(left,dtype=float).tolist()),
+                 ('right',np.asarray(right,dtype=float).tolist()),
+                 ('otf_extinction',bool(cfg.par.otf_extinction)),
+                 ('dust_grid_type',cfg.par.dust_grid_type),
+                 ('deposition_kernel',cfg.par.DEPOSITION_KERNEL),
+                 ('yt_version',yt.__version__)]
+    return hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()
+
+
+def _refined_digest(refined):
+    return hashlib.sha1(np.packbits(np.asarray(refined,dtype=bool)).tobytes()).hexdigest()
+
+
+class OctreeCache:
+
+    def __init__(self,ds,left,right,n_ref=None,fused_fields=()):
+        self.ds = ds
+        self.left = np.asarray(left)
+        self.right = np.asarray(right)
+        self.n_ref = cfg.par.n_ref if n_ref is None else n_ref
+        #particle fields that are deposited together (with
+        #DEPOSITION_KERNEL = 'powderday') as soon as one of them is
+        #asked for, e.g. the gas density, masses and all of the metal
+        #species: the particles are read and the kernel weights are
+        #computed once for all of them
+        self.fused_fields = [tuple(field) for field in fused_fields]
+        self._octree = None
+        self._memo = {}
+
+        #one hdf5 file per field in a directory per key
+        self.directory = None
+        if cfg.par.OCTREE_CACHE:
+            key = octree_cache_key(ds,self.left,self.right,self.n_ref)
+            self.directory = os.path.join(os.path.expanduser(cfg.par.OCTREE_CACHE_DIR),key)
+            print('[octree_cache:] octree cache directory: '+self.directory)
+
+    @property
+    def octree(self):
+        #the yt octree is only built once something that is not cached
+        #is asked for
+        if self._octree is None:
+            print('[octree_cache:] building the yt octree')
+            self._octree = self.ds.octree(self.left,self.right,n_ref=self.n_ref)
+        return self._octree
+
+    def __getattr__(self,name):
+        #anything else is the yt octree's
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.octree,name)
+
+    def __getitem__(self,field):
+        field = tuple(field) if not isinstance(field,str) else field
+        if field not in self._memo:
+            fields = [field]
+            if cfg.par.DEPOSITION_KERNEL == 'powderday' and field in self.fused_fields:
+                fields = [f for f in self.fused_fields if f not in self._memo]
+
+            missing = []
+            for f in fields:
+                value = self._read(f)
+                if value is None:
+                    missing.append(f)
+                else:
+                    self._memo[f] = value
+
+            if len(missing) > 0:
+                deposited = dict(zip(missing,self._deposit(missing)))
+                self._write(deposited)
+                self._memo.update(deposited)
+        return self._memo[field]
+
+    def _deposit(self,fields):
+
+        #particle fields of the sph particle types are deposited by
+        #sph_deposit.deposit (on n_processes processes) if
+        #DEPOSITION_KERNEL is 'powderday', and by yt otherwise.  the
+        #fields of one particle type are deposited together.  returns
+        #the values of fields, in order
+        values = {}
+        by_ptype = {}
+        for field in fields:
+            if (cfg.par.DEPOSITION_KERNEL != 'powderday' or isinstance(field,str)
+                or field[0] not in self.ds._sph_ptypes):
+                values[field] = self.octree[field]
+            else:
+                by_ptype.setdefault(field[0],[]).append(field[1])
+
+        if len(by_ptype) > 0:
+            refined = np.asarray(self[('index','refined')]).astype(bool)
+            leaves = np.array([self[('index',ax)][~refined].in_units('code_length').value for ax in ['x','y','z']]).T
+
+        for ptype,names in by_ptype.items():
+            print('[octree_cache:] depositing (%s, %s) with %d processes' % (ptype,', '.join(names),cfg.par.n_processes))
+
+            #the kernels of particles just outside of the octree still
+            #reach its edge leaves, so the particles are read from the
+            #octree box widened by the largest smoothing length in it
+            hmax = float(self.ds.box(self.left,self.right)[ptype,'smoothing_length'].in_units('code_length').max())
+            reg = self.ds.box(self.left-hmax,self.right+hmax)
+
+            #the scatter interpolation of yt's octree: every particle
+            #adds its fields times its volume m/rho times the kernel to
+            #the leaves (centres) within its smoothing length
+            positions = reg[ptype,'particle_position'].in_units('code_length').value
+            hsml = reg[ptype,'smoothing_length'].in_units('code_length').value
+            volume = (reg[ptype,'particle_mass']/reg[ptype,'density']).in_units('code_length**3').value
+            particle_values = [reg[ptype,name] for name in names]
+
+            result = deposit(leaves,positions,hsml,
+                             volume[:,np.newaxis]*np.array([np.asarray(v) for v in particle_values]).T,
+                             cfg.par.n_processes)
+            for i,name in enumerate(names):
+                values[(ptype,name)] = self.ds.arr(result[:,i],str(getattr(particle_values[i],'units','dimensionless')))
+
+        return [values[field] for field in fields]
+
+    def ordering(self,refined):
+
+        #the hyperion (x-first) cell ordering of refined (see
+        #find_order).  returns the order, and the OctreeTraversal it
+        #was computed with, or None if it came from the cache
+        digest = _refined_digest(refined)
+        order = self._read('ordering',digest=digest)
+        if order is not None:
+            return order,None
+
+        traversal = OctreeTraversal(refined)
+        self._write({'ordering':traversal.order},digest=digest)
+        return traversal.order,traversal
+
+    #-----------------------------------------------------------------
+
+    @staticmethod
+    def _dataset_name(field):
+        return field if isinstance(field,str) else '/'.join(field)
+
+    def _entry(self,field):
+        #the file of field in the cache directory
+        return os.path.join(self.directory,quote(self._dataset_name(field),safe='')+'.h5')
+
+    def _read(self,field,digest=None):
+        if self.directory is None:
+            return None
+        name = self._dataset_name(field)
+        fname = self._entry(field)
+        if not os.path.isfile(fname):
+            return None
+        try:
+            with h5py.File(fname,'r') as f:
+                dset = f['value']
+                if digest is not None and dset.attrs.get('digest') != digest:
+                    return None
+                value = dset[()]
+                if 'units' in dset.attrs:
+                    value = self.ds.arr(value,dset.attrs['units'])
+        except (OSError,KeyError) as err:
+            #a corrupt entry is just treated as a miss
+            print('[octree_cache:] could not read %s from %s: %s' % (name,fname,err))
+            return None
+        print('[octree_cache:] read %s from the octree cache' % name)
+        return value
+
+    def _write(self,values,digest=None):
+
+        #values is {field: value}.  the cache directory is shared by
+        #all the runs on the same snapshot (e.g. a sweep over dust
+        #parameters run at the same time), so every field is written to
+        #a temporary file that is then moved into place, as in
+        #ssp_cache._write_entry: readers never see a half written entry,
+        #and no write touches the entries already there
+        if self.directory is None:
+            return
+        for field,value in values.items():
+            fname = self._entry(field)
+            try:
+                os.makedirs(self.directory,exist_ok=True)
+                fd,tmpname = tempfile.mkstemp(dir=self.directory,suffix='.tmp')
+                os.close(fd)
+                try:
+                    with h5py.File(tmpname,'w') as f:
+                        dset = f.create_dataset('value',data=np.asarray(value))
+                        if hasattr(value,'units'):
+                            dset.attrs['units'] = str(value.units)
+                        if digest is not None:
+                            dset.attrs['digest'] = digest
+                    os.replace(tmpname,fname)
+                finally:
+                    if os.path.isfile(tmpname):
+                        os.remove(tmpname)
+            except OSError as err:
+                print('[octree_cache:] could not write %s to %s: %s' % (self._dataset_name(field),fname,err))
+
+def octree_ordering(reg,refined):
+
+    #the cell ordering for sph_m_gen: from the octree cache if the front
+    #end set one up, otherwise computed
+    cache = reg.parameters.get('octree',None)
+    if isinstance(cache,OctreeCache):
+        return cache.ordering(refined)
+    traversal = OctreeTraversal(refined)
+    return traversal.order,traversal
@@ -1,24 +1,22 @@
 from __future__ import print_function
+import numpy as np
+from powderday.octree_tools import octree_error
 
 
-def sanity_check(refined_string,max_level):
+def sanity_check(refined,max_level):
+    #refined can be the refined array itself, or (as it used to be
+    #passed) a string of T and F
     print ('Entering the Octree Sanity Check')
-    content = refined_string
-    prev = content
- 
-    print ('inside sanity_check: max_level = ',max_level)
 
-    for iter in range(max_level):
- 
-        content = content.replace('TFFFFFFFF', 'F')
- 
-        print ("Length: {0}".format(len(content)))
-        if content == prev:
-            break
- 
-            prev = content
- 
+    if isinstance(refined,str):
+        refined = np.frombuffer(refined.encode(),dtype='S1') == b'T'
+
+    print ('inside sanity_check: max_level = ',max_level)
 
-    print ('Converged: {0} (should be F)'.format(content))
+    error = octree_error(refined)
+    if error is None:
+        print ('Octree is consistent ({0} cells)'.format(len(refined)))
+    else:
+        print ('WARNING: Octree is not consistent; first bad index {0}: {1}'.format(*error))
 
-        
+    return error
@@ -0,0 +1,315 @@
+from __future__ import print_function
+import numpy as np
+
+#non-recursive traversal of a depth-first (parent followed by its 8
+#children) octree `refined` array.  instead of walking the tree cell by
+#cell, everything is derived from one prefix sum over the array:
+#
+#every cell fills one slot of its parent, and a refined cell opens 8
+#new ones, so with
+#
+#    P[i] = sum_{j<i} (8*refined[j] - 1)
+#
+#the number of open slots before cell i is P[i]+1, the array is a
+#single consistent tree if P[i] >= 0 for every cell and P[N] == -1, and
+#the subtree of cell i ends at the first index e > i with P[e] ==
+#P[i]-1.  those ends are found for all cells at once with a
+#searchsorted over the (P, index) pairs.  the children of a refined
+#cell then follow from the ends (each child starts where the previous
+#one ends), and the depths and the hyperion (x-first) ordering from
+#cumulative sums over the subtrees.
+
+#yt deposits the children of a cell z-first, hyperion expects them
+#x-first: the k-th child in the hyperion order is child XFIRST[k] in
+#the yt order (the 3 bit child index reversed)
+XFIRST = np.array([0,4,2,6,1,5,3,7])
+
+
+def octree_error(refined):
+
+    #structural check of a depth-first refined array, from the same
+    #count of open slots as OctreeTraversal (no stack and no string
+    #copy of the array).  returns None for a consistent octree, and
+    #otherwise (index, message) for the first index at which it goes
+    #wrong
+    refined = np.asarray(refined,dtype=bool).ravel()
+    n = len(refined)
+    if n == 0:
+        return 0,"refined is empty"
+
+    #int32 unless the octree is too large for it (8 slots per cell at
+    #most)
+    dtype = np.int32 if 8*(n+1) < np.iinfo(np.int32).max else np.int64
+    open_slots = np.where(refined,dtype(7),dtype(-1))
+    np.cumsum(open_slots,dtype=dtype,out=open_slots)
+    open_slots += 1
+
+    #the octree is complete once no slots are left, so any cell after
+    #that is one too many
+    complete = np.flatnonzero(open_slots[:-1] == 0)
+    if len(complete) > 0:
+        ncomplete = int(complete[0])+1
+        return ncomplete,"the octree is complete after %d cells, but refined has %d" % (ncomplete,n)
+
+    if open_slots[-1] > 0:
+        return n,"refined ends after %d cells with %d cells still missing" % (n,int(open_slots[-1]))
+
+    return None
+
+
+class OctreeTraversal:
+
+    #only the subtree ends are computed up front; the depths, the
+    #parents and child indices and the hyperion ordering are computed
+    #when they are first asked for (and only the depths and the
+    #ordering are kept), so that large octrees do not hold more than a
+    #few arrays of ncells at a time.  indices are int32 wherever the
+    #octree is small enough for them
+
+    def __init__(self,refined):
+
+        refined = np.asarray(refined,dtype=bool).ravel()
+        n = len(refined)
+        self.refined = refined
+        self.ncells = n
+
+        if n == 0 or (n-1) % 8 != 0:
+            raise ValueError("refined should have shape 8 * n + 1")
+
+        error = octree_error(refined)
+        if error is not None:
+            raise ValueError("refined is not a consistent octree at index %d: %s" % error)
+
+        self.index_dtype = np.int32 if 8*(n+1) < np.iinfo(np.int32).max else np.int64
+        self._depth = None
+        self._order = None
+        self._position = None
+
+        #open slots (minus one) before every cell and at the end, P in
+        #the description above.  the end (exclusive) of the subtree of a
+        #refined cell i is the first j > i with P[j] == P[i]-1, which is
+        #looked up in the sorted composite keys P*(n+1)+j; built in
+        #place so that only the keys are held
+        ref_idx = np.flatnonzero(refined)
+        keys = np.zeros(n+1,dtype=np.int64)
+        np.cumsum(np.where(refined,np.int8(7),np.int8(-1)),dtype=np.int64,out=keys[1:])
+        query = (keys[ref_idx]-1)*(n+1)+ref_idx+1
+
+        keys *= n+1
+        for i in range(0,n+1,2**24):
+            keys[i:i+2**24] += np.arange(i,min(i+2**24,n+1),dtype=np.int64)
+        keys.sort()
+
+        #(every refined cell of a consistent octree has an end)
+        ends = keys[np.searchsorted(keys,query)] % (n+1)
+        del keys,query
+
+        self.subtree_end = np.arange(1,n+1,dtype=self.index_dtype)
+        self.subtree_end[ref_idx] = ends
+
+    @property
+    def subtree_size(self):
+        return self.subtree_end-np.arange(self.ncells,dtype=self.index_dtype)
+
+    @property
+    def depth(self):
+        #the number of refined cells whose subtree contains the cell
+        if self._depth is None:
+            ref_idx = np.flatnonzero(self.refined)
+            delta = np.zeros(self.ncells+1,dtype=np.int16)
+            delta[ref_idx+1] += 1
+            np.subtract.at(delta,self.subtree_end[ref_idx],1)
+            self._depth = np.cumsum(delta[:-1],dtype=np.int16)
+        return self._depth
+
+    def _child_starts(self):
+        #[nrefined,8]: the first cell of each child (yt order) of every
+        #refined cell, following the subtree ends from child to child
+        ref_idx = np.flatnonzero(self.refined).astype(self.index_dtype)
+        starts = np.empty([len(ref_idx),8],dtype=self.index_dtype)
+        starts[:,0] = ref_idx+1
+        for k in range(1,8):
+            starts[:,k] = self.subtree_end[starts[:,k-1]]
+        return ref_idx,starts
+
+    @property
+    def parent(self):
+        ref_idx,starts = self._child_starts()
+        parent = np.full(self.ncells,-1,dtype=self.index_dtype)
+        parent[starts] = ref_idx[:,np.newaxis]
+        return parent
+
+    @property
+    def child_index(self):
+        #which of its parent's children (0-7, yt order) the cell is
+        _,starts = self._child_starts()
+        child_index = np.zeros(self.ncells,dtype=np.int8)
+        child_index[starts] = np.arange(8,dtype=np.int8)
+        return child_index
+
+    @property
+    def order(self):
+        #hyperion ordering.  the children of every refined cell are laid
+        #out in XFIRST order, so the offset of a child from its parent
+        #is one plus the sizes of the children that precede it there.
+        #the new position of a cell is the sum of the offsets of itself
+        #and all of its ancestors, i.e. every cell adds its offset to
+        #its whole subtree
+        if self._order is None:
+            n = self.ncells
+            _,starts = self._child_starts()
+            slots = starts[:,XFIRST]
+            del starts
+            slot_sizes = self.subtree_end[slots]-slots
+            slot_offsets = np.cumsum(slot_sizes,axis=1,dtype=self.index_dtype)-slot_sizes+1
+            del slot_sizes
+
+            delta = np.zeros(n+1,dtype=self.index_dtype)
+            delta[slots] = slot_offsets
+            np.subtract.at(delta,self.subtree_end[slots],slot_offsets)
+            del slots,slot_offsets
+
+            position = np.cumsum(delta[:-1],dtype=self.index_dtype)
+            del delta
+            self._order = np.empty(n,dtype=self.index_dtype)
+            self._order[position] = np.arange(n,dtype=self.index_dtype)
+        return self._order
+
+    @property
+    def position(self):
+        #where every cell ends up in the hyperion ordering
+        if self._position is None:
+            self._position = np.empty(self.ncells,dtype=self.index_dtype)
+            self._position[self.order] = np.arange(self.ncells,dtype=self.index_dtype)
+        return self._position
+
+    #leaf statistics
+
+    @property
+    def n_leaves(self):
+        return int(self.ncells-np.count_nonzero(self.refined))
+
+    @property
+    def max_level(self):
+        return int(np.max(self.depth[~self.refined]))
+
+    @property
+    def leaves_per_level(self):
+        return np.bincount(self.depth[~self.refined],minlength=self.max_level+1)
+
+
+#---------------------------------------------------------------------
+# editing hyperion-ordered octrees
+#---------------------------------------------------------------------
+
+#hyperion lays out the children of a cell x first: child k sits on the
+#(k&1, (k>>1)&1, (k>>2)&1) side of its parent in (x, y, z).  these are
+#the directions (-1 or +1) of the child centres from the parent centre
+HYPERION_CHILD_SIGNS = np.array([[2*(k&1)-1,2*((k>>1)&1)-1,2*((k>>2)&1)-1] for k in range(8)])
+
+
+def octree_cell_geometry(refined,root_width,traversal=None):
+
+    #centres (relative to the centre of the root cell) and widths [n,3]
+    #of every cell of a hyperion-ordered refined array, for a root cell
+    #of width root_width [3]
+    if traversal is None: traversal = OctreeTraversal(refined)
+    n = traversal.ncells
+
+    width = np.asarray(root_width,dtype=float)[np.newaxis,:]/(2.**traversal.depth)[:,np.newaxis]
+
+    #every cell sits half its own width from its parent's centre, so
+    #its centre is the sum of those offsets over itself and its
+    #ancestors (added to every cell of its subtree, as in
+    #OctreeTraversal)
+    offset = np.zeros([n,3])
+    offset[1:] = HYPERION_CHILD_SIGNS[traversal.child_index[1:]]*width[1:]/2.
+
+    delta = np.zeros([n+1,3])
+    delta[:-1] += offset
+    np.add.at(delta,traversal.subtree_end,-offset)
+    center = np.cumsum(delta[:-1],axis=0)
+
+    return center,width
+
+
+def collapse_octree_cells(refined,values,idx):
+
+    #turns the refined cells idx, all of whose children are leaves,
+    #into leaves.  their value becomes the mean of their children's
+    #(i.e. mass is conserved for densities).  returns the new refined
+    #and values arrays
+    idx = np.asarray(idx,dtype=np.int64)
+    children = idx[:,np.newaxis]+1+np.arange(8)
+
+    refined = refined.copy()
+    values = values.copy()
+    refined[idx] = False
+    values[idx] = np.mean(values[children],axis=1)
+
+    keep = np.ones(len(refined),dtype=bool)
+    keep[children.ravel()] = False
+    return refined[keep],values[keep]
+
+
+def split_octree_cells(refined,values,idx,child_values):
+
+    #refines the leaves idx (sorted) into 8 children each, with the
+    #values child_values [len(idx),8] (hyperion child order).  as for
+    #every refined cell, the value of a split cell itself is set to 0.
+    #returns the new refined and values arrays
+    idx = np.asarray(idx,dtype=np.int64)
+    insert_at = np.repeat(idx+1,8)
+
+    refined = np.insert(refined,insert_at,False)
+    values = np.insert(values,insert_at,np.asarray(child_values).ravel())
+
+    #every split cell has moved up by the 8 children inserted for each
+    #of the split cells before it
+    split = idx+8*np.arange(len(idx))
+    refined[split] = True
+    values[split] = 0.
+    return refined,values
+
+
+def prune_octree(refined,values,tolerance=0.,cell_values=None):
+
+    #collapses empty and nearly empty subtrees of a hyperion-ordered
+    #octree into their parents, before it is handed to hyperion.
+    #values are the cell densities; families of 8 leaves are merged
+    #(conserving mass, see collapse_octree_cells) from the lightest up,
+    #for as long as the total mass of the merged families stays within
+    #tolerance times the total mass, and repeatedly, so that whole
+    #subtrees collapse.  with tolerance = 0 only families without any
+    #mass are merged, which leaves the radiative transfer unchanged.
+    #cell_values [n,...] are carried along (averaged over merged
+    #families, like the densities).  returns the new refined, values
+    #and cell_values arrays
+    refined = np.asarray(refined,dtype=bool)
+    values = np.asarray(values,dtype=float)
+    ncells_in = len(refined)
+
+    #masses in units of the root cell volume
+    traversal = OctreeTraversal(refined)
+    mass = values*8.**(-traversal.depth)
+    budget = tolerance*np.sum(mass[~refined])
+
+    while True:
+        family = np.flatnonzero(refined & (traversal.subtree_size == 9))
+        if len(family) == 0: break
+        children = family[:,np.newaxis]+1+np.arange(8)
+        family_mass = np.sum(values[children],axis=1)*8.**(-traversal.depth[family]-1)
+
+        lightest = np.argsort(family_mass,kind='stable')
+        fits = np.cumsum(family_mass[lightest]) <= budget
+        merge = np.sort(family[lightest[fits]])
+        if len(merge) == 0: break
+
+        budget = max(budget-np.sum(family_mass[lightest[fits]]),0.)
+        if cell_values is not None:
+            cell_values = collapse_octree_cells(refined,np.asarray(cell_values),merge)[1]
+        refined,values = collapse_octree_cells(refined,values,merge)
+        traversal = OctreeTraversal(refined)
+
+    print('[octree_tools/prune_octree:] %d cells -> %d cells' % (ncells_in,len(refined)))
+    return refined,values,cell_values
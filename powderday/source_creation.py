@@ -4,13 +4,14 @@ from __future__ import print_function
 import powderday.config as cfg
 import numpy as np
 import powderday.SED_gen as sg
+from powderday.ssp_grid import get_ssp_grid, needs_individual_sps, mass_dependent_sps
 from datetime import datetime
 import astropy.units as units
 import astropy.constants as constants
-from powderday.helpers import find_nearest
-from powderday.analytics import dump_AGN_SEDs,dump_NEB_SEDs,dump_emlines
+from powderday.helpers import find_nearest_sorted,trapz
+from powderday.analytics import dump_AGN_SEDs,dump_NEB_SEDs,load_NEB_SEDs,dump_emlines
 from hyperion.model import ModelOutput
-from hyperion.grid.yt3_wrappers import find_order
+from powderday.find_order import find_order
 from powderday.nebular_emission.cloudy_tools import get_DIG_sed_shape, get_DIG_logU
 from tqdm import tqdm
 from scipy import spatial
@@ -29,12 +30,7 @@ def direct_add_stars(df_nu, stars_list, diskstars_list, bulgestars_list, cosmofl
     print("Adding unbinned stars to the grid\n")
     print("--------------------------------\n")
 
-    totallum_newstars = 0.
-    unbinned_stars_list = []
-
-    for star in stars_list:
-        if star.age <= cfg.par.max_age_direct:
-            unbinned_stars_list.append(star)
+    unbinned_stars_list = stars_list[stars_list.age <= cfg.par.max_age_direct]
 
 
     nstars = len(unbinned_stars_list)
@@ -48,49 +44,65 @@ def direct_add_stars(df_nu, stars_list, diskstars_list, bulgestars_list, cosmofl
     stellar_nu, stellar_fnu, disk_fnu, bulge_fnu, mfrac, unbinned_line_em = sg.allstars_sed_gen(unbinned_stars_list, cosmoflag, sp)
     
     #SED_gen now returns an additional parameter, mfrac, to properly scale the FSPS SSP spectra, which are in units of formed mass, not current stellar mass
-    pos_arr = []
-    fnu_arr = []
-    for i in range(nstars):
-        nu = stellar_nu[:]
-        fnu = stellar_fnu[i, :]
-        pos = unbinned_stars_list[i].positions
-
-        nu, fnu = wavelength_compress(nu, fnu, df_nu)
-        # reverse the arrays for hyperion
-        nu = nu[::-1]
-        fnu = fnu[::-1]
-
-        lum = np.absolute(np.trapz(fnu, x=nu))*unbinned_stars_list[i].mass/constants.M_sun.cgs.value/mfrac[i]
-        lum *= constants.L_sun.cgs.value
-        
-        young_star = cfg.par.add_young_stars and cfg.par.HII_min_age <= unbinned_stars_list[i].age <= cfg.par.HII_max_age
-        pagb = cfg.par.add_pagb_stars and cfg.par.PAGB_min_age <= unbinned_stars_list[i].age <= cfg.par.PAGB_max_age
-
-        if cfg.par.add_neb_emission and (star or pagb):
-            pos_arr.append(pos)
-            fnu_arr.append(stellar_fnu[i, :])
-
-            line_em = unbinned_line_em[i,:]
-
-            # the stellar population returns the calculation in units of Lsun/1 Msun: 
-            # https://github.com/dfm/python-fsps/issues/117#issuecomment-546513619
-            line_em = line_em * (unbinned_stars_list[i].mass * units.g).to(units.Msun).value * 3.839e33 # Units: ergs/s
-            OH = unbinned_stars_list[i].all_metals[4]
-
-            line_em = np.append(line_em, OH)
-            if young_star:
-                line_em = np.append(line_em, 1)
-            elif pagb:
-                line_em = np.append(line_em, 2)
-                
-            dump_emlines(line_em)
-
-
-        # add new stars
-        totallum_newstars += lum
-        #m.add_spherical_source(luminosity = lum,radius = 10.*const.rsun,spectrum = (nu,fnu),
-
-        m.add_point_source(luminosity = lum,spectrum=(nu,fnu), position = pos)
+    compressor = WavelengthCompressor(stellar_nu, df_nu)
+
+    # reverse the arrays for hyperion
+    nu = compressor.nu[::-1]
+    compressed_fnu = compressor(stellar_fnu)[:, ::-1]
+
+    lums = np.absolute(trapz(compressed_fnu, x=nu, axis=1))*unbinned_stars_list.mass/constants.M_sun.cgs.value/mfrac
+    lums *= constants.L_sun.cgs.value
+
+    young_star = cfg.par.add_young_stars & (cfg.par.HII_min_age <= unbinned_stars_list.age) & (unbinned_stars_list.age <= cfg.par.HII_max_age)
+    pagb = cfg.par.add_pagb_stars & (cfg.par.PAGB_min_age <= unbinned_stars_list.age) & (unbinned_stars_list.age <= cfg.par.PAGB_max_age)
+    nebular = cfg.par.add_neb_emission & (young_star | pagb)
+
+    pos_arr = unbinned_stars_list.positions[nebular]
+    fnu_arr = stellar_fnu[nebular, :]
+
+    if cfg.par.dump_emlines and np.any(nebular):
+        # the stellar population returns the calculation in units of Lsun/1 Msun: 
+        # https://github.com/dfm/python-fsps/issues/117#issuecomment-546513619
+        line_em = unbinned_line_em[nebular, :] * (unbinned_stars_list.mass[nebular] * units.g).to(units.Msun).value[:, None] * 3.839e33 # Units: ergs/s
+        OH = unbinned_stars_list.all_metals[nebular, 4]
+        source_id = np.where(young_star[nebular], 1, 2)
+
+        dump_emlines(np.column_stack([line_em, OH, source_id]))
+
+    # add new stars: apart from the ones that newstars_gen gives a
+    # spectrum of their own (needs_individual_sps: nebular emission,
+    # cluster mass functions, birth clouds, alpha enhancement), a
+    # star's spectrum is set by its fsps metallicity and by its age,
+    # which FSPS (and the SSP grid) interpolate between the ages of the
+    # isochrone grid.  stars with the same metallicity and the same
+    # nearest isochrone age are added as a single point source
+    # collection rather than one point source per star.  the spectrum
+    # of the collection is the summed spectrum of its members, so the
+    # luminosity of every star and the total SED are unchanged; only
+    # the shape of each star's spectrum is that of its collection
+    individual = needs_individual_sps(unbinned_stars_list.age)
+
+    age_idx = find_nearest_sorted(sp.log_age,np.log10(unbinned_stars_list.age*1.e9))
+    zmet = np.asarray(unbinned_stars_list.fsps_zmet).astype(np.int64)
+    key = age_idx.astype(np.int64)*(np.max(zmet)+1)+zmet
+    key[individual] = -1-np.arange(np.sum(individual))
+    source_group = np.unique(key,return_inverse=True)[1].ravel()
+
+    ngroups = np.max(source_group)+1
+    group_members = np.split(np.argsort(source_group,kind='stable'),np.cumsum(np.bincount(source_group,minlength=ngroups))[:-1])
+
+    # (the spectra are per unit formed mass)
+    group_fnu = np.zeros((ngroups,len(nu)))
+    np.add.at(group_fnu,source_group,compressed_fnu*(unbinned_stars_list.mass/mfrac)[:,np.newaxis])
+
+    for k,members in enumerate(group_members):
+        source = m.add_point_source_collection()
+        source.luminosity = lums[members]
+        source.position = unbinned_stars_list.positions[members]
+        source.spectrum = (nu, group_fnu[k, :])
+
+    totallum_newstars = np.sum(lums)
+    print('[source_creation/add_unbinned_newstars:] added %d stars as %d point source collections' % (nstars, ngroups))
 
     print('[source_creation/add_unbinned_newstars:] totallum_newstars = ', totallum_newstars)
     
@@ -108,13 +120,13 @@ def add_bulge_disk_stars(df_nu,stellar_nu,stellar_fnu,disk_fnu,bulge_fnu,stars_l
     print ('Non-Cosmological Simulation: Adding Disk and Bulge Stars:')
     
 
-    nu = stellar_nu[:]
-    nu,bulge_fnu = wavelength_compress(nu,bulge_fnu,df_nu)
-    nu,disk_fnu = wavelength_compress(nu,disk_fnu,df_nu)
+    compressor = WavelengthCompressor(stellar_nu,df_nu)
+    bulge_fnu = compressor(bulge_fnu)
+    disk_fnu = compressor(disk_fnu)
 
 
     #reverse the arrays for hyperion
-    nu = nu[::-1]
+    nu = compressor.nu[::-1]
     
 
 
@@ -134,17 +146,14 @@ def add_bulge_disk_stars(df_nu,stellar_nu,stellar_fnu,disk_fnu,bulge_fnu,stars_l
         disksource = m.add_point_source_collection()
             
         
-        disk_lum = np.absolute(np.trapz(fnu,x=nu))*diskstars_list[0].mass/constants.M_sun.cgs.value
+        disk_lum = np.absolute(trapz(fnu,x=nu))*diskstars_list.mass[0]/constants.M_sun.cgs.value
         #since stellar masses are in cgs, and we need them to be in msun - we
         #multiply by mass to get the *total* luminosity of the stellar
         #cluster since int(nu,fnu) is just the luminosity of a 1 Msun single star
         disk_lum *= constants.L_sun.cgs.value
         disksource.luminosity = np.repeat(disk_lum,nstars_disk)
         
-        disk_pos = np.zeros([len(diskstars_list),3])
- 
-        for i in range(len(diskstars_list)): disk_pos[i,:] = diskstars_list[i].positions
-        disksource.position=disk_pos
+        disksource.position=diskstars_list.positions
         
         disksource.spectrum = (nu,fnu)
     
@@ -162,13 +171,11 @@ def add_bulge_disk_stars(df_nu,stellar_nu,stellar_fnu,disk_fnu,bulge_fnu,stars_l
 
         print ('adding bulge stars to the grid: adding as a point source collection')
         bulgesource = m.add_point_source_collection()
-        bulge_lum = np.absolute(np.trapz(fnu,x=nu))*bulgestars_list[0].mass/constants.M_sun.cgs.value
+        bulge_lum = np.absolute(trapz(fnu,x=nu))*bulgestars_list.mass[0]/constants.M_sun.cgs.value
         bulge_lum *= constants.L_sun.cgs.value
         bulgesource.luminosity = np.repeat(bulge_lum,nstars_bulge)
         
-        bulge_pos = np.zeros([len(bulgestars_list),3])
-        for i in range(len(bulgestars_list)): bulge_pos[i,:] = bulgestars_list[i].positions
-        bulgesource.position=bulge_pos
+        bulgesource.position=bulgestars_list.positions
         bulgesource.spectrum = (nu,fnu)
         
         print ('[source_creation/add_bulge_disk_stars:] totallum_bulgetars = ',bulgesource.luminosity[0])
@@ -177,152 +184,58 @@ def add_bulge_disk_stars(df_nu,stellar_nu,stellar_fnu,disk_fnu,bulge_fnu,stars_l
 
 def add_binned_seds(df_nu,stars_list,diskstars_list,bulgestars_list,cosmoflag,m,sp):
     
-    # calculate max and min ages
-    minimum_age = 15 #Gyr - obviously too high of a number
-    maximum_age = 0 #Gyr
-
-    # calculate the minimum and maximum luminosity
-    minimum_mass = 1e15*constants.M_sun.cgs.value #msun - some absurdly large value for a single stellar cluster
-    maximum_mass = 0 #msun
-
-    # calculate the minimum and maximum stellar metallicity
-    minimum_metallicity = 1.e5 #some absurdly large metallicity
-    maximum_metallicity = 0
-
     nstars = len(stars_list)
-    for i in range(nstars):
-        #if stars_list[i].metals[0] < minimum_metallicity: minimum_metallicity = stars_list[i].metals[0]
-        #if stars_list[i].metals[0] > maximum_metallicity: maximum_metallicity = stars_list[i].metals[0]
-        
-        if stars_list[i].mass < minimum_mass: minimum_mass = stars_list[i].mass
-        if stars_list[i].mass > maximum_mass: maximum_mass = stars_list[i].mass
-
-        if stars_list[i].age < minimum_age: minimum_age = stars_list[i].age
-        if stars_list[i].age > maximum_age: maximum_age = stars_list[i].age
-
-    # If Flag is set we do not bin stars younger than the age set by max_age_unbinned_stars
-    if not cfg.par.FORCE_BINNED and cfg.par.max_age_direct > minimum_age:
-        minimum_age = cfg.par.max_age_direct + 0.001
-
-    delta_age = (maximum_age-minimum_age)/cfg.par.N_STELLAR_AGE_BINS
-
-    if delta_age <= 0: # If max age for direct adding stars is greater than the max age of stars in the galaxy then 
-        return m       # exit the function since there are no stars left for binning
 
-    # define the metallicity bins: we do this by saying that they are the number of metallicity bins in FSPS
-
-    fsps_metals = np.array(sp.zlegend)
-    N_METAL_BINS = len(fsps_metals)
-
-    # note the bins are NOT metallicity, but rather the zmet keys in
-    # fsps (i.e. the zmet column in Table 1 of the fsps manual)
-    metal_bins = np.arange(N_METAL_BINS)+1
-
-    # define the age bins in log space so that we maximise resolution around young stars
-    age_bins = 10.**(np.linspace(np.log10(minimum_age),np.log10(maximum_age),cfg.par.N_STELLAR_AGE_BINS))
-
-    #tack on the maximum age bin
-    age_bins = np.append(age_bins,age_bins[-1]+delta_age)
-
-   
-    #define the mass bins (log)
-    #note - for some codes, all star particles have the same mass.  in this case, we have to have a trap:
-    if minimum_mass == maximum_mass or cfg.par.N_MASS_BINS == 0: 
-        mass_bins = np.zeros(cfg.par.N_MASS_BINS+1)+minimum_mass
+    if cfg.par.FORCE_BINNED:
+        binned_idx = np.arange(nstars)
     else:
-        delta_mass = (np.log10(maximum_mass)-np.log10(minimum_mass))/cfg.par.N_MASS_BINS
-        mass_bins = np.arange(np.log10(minimum_mass),np.log10(maximum_mass),delta_mass)
-        mass_bins = np.append(mass_bins,mass_bins[-1]+delta_mass)
-        mass_bins = 10.**mass_bins
-        
-    print ('mass_bins = ',mass_bins)
-    print ('metal_bins = ',metal_bins)
-    print ('age_bins = ',age_bins)
+        # If a particle was directly added using direct_add_stars() then it is skipped over.
+        binned_idx = np.where(stars_list.age > cfg.par.max_age_direct)[0]
+
+    if len(binned_idx) == 0: # If max age for direct adding stars is greater than the max age of stars in the galaxy then 
+        return m             # exit the function since there are no stars left for binning
+
+    #group the stars into SED bins.  star_bin gives the bin (in
+    #0..n_occupied-1) of every star in binned_idx, and bin_zmet,
+    #bin_age and bin_mass describe the occupied bins; only those get
+    #an SED and a point source collection downstream.
+    ssp_grid = None
+    if cfg.par.STELLAR_BINNING == 'adaptive':
+        ssp_grid = get_ssp_grid(sp)
+        star_bin,bin_zmet,bin_age,bin_mass = adaptive_sed_bins(stars_list,binned_idx,ssp_grid)
+    else:
+        fixed_bins = fixed_sed_bins(stars_list,binned_idx,sp)
+        if fixed_bins is None:
+            return m
+        star_bin,bin_zmet,bin_age,bin_mass = fixed_bins
 
-    #has_stellar_mass is a 3D boolean array that's [wz,wa,wm] big and
-    #says whether or not that bin is being used downstream for
-    #creating a point source collection (i.e. that it actually has at
-    #least one star cluster that falls into it)
-    has_stellar_mass = np.zeros([N_METAL_BINS,cfg.par.N_STELLAR_AGE_BINS+1,cfg.par.N_MASS_BINS+1],dtype=bool)
+    fsps_metals = np.array(sp.zlegend)
+    n_occupied = len(bin_zmet)
+    stars_per_bin = np.bincount(star_bin,minlength=n_occupied)
 
+    #stars_in_bin[k] holds the indices (into stars_list) of the star
+    #particles that fall in occupied bin k
+    bin_order = binned_idx[np.argsort(star_bin,kind='stable')]
+    stars_in_bin = np.split(bin_order,np.cumsum(stars_per_bin)[:-1])
 
-    stars_in_bin = {} #this will be a dictionary that holds the list
-    #of star particles that go in every [wz,wa,wm]
-    #group.  The keys will be tuples that hold a
-    #(wz,wa,wm) set that we will then use later to
-    #speed up adding sources.
-    
-    for i in range(nstars):
-        # If a particle was directly added using direct_add_stars() then it is skipped over.
-        if not cfg.par.FORCE_BINNED and stars_list[i].age <= cfg.par.max_age_direct:
-            continue
-            
-        wz = find_nearest(metal_bins,stars_list[i].fsps_zmet)
-        wa = find_nearest(age_bins,stars_list[i].age)
-        wm = find_nearest(mass_bins,stars_list[i].mass)
-        
-        stars_list[i].sed_bin = [wz,wa,wm]
-        has_stellar_mass[wz,wa,wm] = True
+    print ('assigning stars to SED bins')
 
-        if (wz,wa,wm) in stars_in_bin:
-            stars_in_bin[(wz,wa,wm)].append(i)
-        else:
-            stars_in_bin[(wz,wa,wm)] = [i]
+    #the mean element abundances of the stars in each occupied bin
+    bin_metals = np.zeros([n_occupied,stars_list.all_metals.shape[1]])
+    for q in range(stars_list.all_metals.shape[1]):
+        bin_metals[:,q] = np.bincount(star_bin,weights=stars_list.all_metals[binned_idx,q],minlength=n_occupied)/stars_per_bin
 
+    #(the bins have no positions of their own)
+    sed_bins_list_has_stellar_mass = sg.StarCatalog(bin_mass,fsps_metals[bin_zmet-1],np.zeros([n_occupied,3]),bin_age,fsps_zmet=bin_zmet,all_metals=bin_metals)
 
-    print ('assigning stars to SED bins')
-    sed_bins_list=[]
-    sed_bins_list_has_stellar_mass = []
-       
-    #we loop through age bins +1 because the max values were tacked
-    #onto those bin lists. but for metal bins, this isn't the case, so
-    #we don't loop the extra +1
-    for wz in range(N_METAL_BINS):
-        for wa in range(cfg.par.N_STELLAR_AGE_BINS+1):
-            for wm in range(cfg.par.N_MASS_BINS+1):
-                sed_bins_list.append(Sed_Bins(mass_bins[wm],fsps_metals[wz],age_bins[wa],metal_bins[wz]))
-                if has_stellar_mass[wz,wa,wm] == True:
-                    stars_metals = []
-                    for star in stars_in_bin[(wz,wa,wm)]:
-                        stars_metals.append(stars_list[star].all_metals)
-                    stars_metals = np.array(stars_metals)
-                    stars_metals = np.mean(stars_metals,axis=0)
-                    sed_bins_list_has_stellar_mass.append(Sed_Bins(mass_bins[wm],fsps_metals[wz],age_bins[wa],metal_bins[wz],stars_metals))
-   
-    #sed_bins_list is a list of Sed_Bins objects that have the
-    #information about what mass bin, metal bin and age bin they
-    #correspond to.  It is unnecessary, and heavy computational work
-    #to re-create the SED for each of these bins - rather, we can just
-    #calculate the SED for the bins that have any actual stellar mass.
+    #it is unnecessary, and heavy computational work to create the SED
+    #for every possible bin - rather, we just calculate the SED for the
+    #bins that have any actual stellar mass.
             
     print ('Running SPS for Binned SEDs')
     print ('calculating the SEDs for ',len(sed_bins_list_has_stellar_mass),' bins')
     
-    binned_stellar_nu,binned_stellar_fnu_has_stellar_mass,disk_fnu,bulge_fnu,mfrac,binned_line_em_has_stellar_mass = sg.allstars_sed_gen(sed_bins_list_has_stellar_mass,cosmoflag,sp)
-    
-
-    #since the binned_stellar_fnu_has_stellar_mass is now
-    #[len(sed_bins_list_has_stellar_mass),nlam)] big, we need to
-    #transform it back to the a larger array.  this is an ugly loop
-    #that could probably be prettier...but whatever.  this saves >an
-    #order of magnitude in time in SED gen.  
-    nlam = binned_stellar_nu.shape[0]
-    cloudy_nlam = len(np.genfromtxt(cfg.par.pd_source_dir + "/powderday/nebular_emission/data/refLines.dat", delimiter=','))
-    binned_stellar_fnu = np.zeros([len(sed_bins_list),nlam])
-    binned_mfrac = np.zeros([len(sed_bins_list)])
-    binned_line_em = np.zeros([len(sed_bins_list),cloudy_nlam])
-
-    counter = 0
-    counter_has_stellar_mass = 0
-    for wz in range(N_METAL_BINS):
-        for wa in range(cfg.par.N_STELLAR_AGE_BINS+1):
-            for wm in range(cfg.par.N_MASS_BINS+1):
-                if has_stellar_mass[wz,wa,wm] == True:
-                    binned_mfrac[counter] = mfrac[counter_has_stellar_mass]
-                    binned_stellar_fnu[counter,:] = binned_stellar_fnu_has_stellar_mass[counter_has_stellar_mass,:]
-                    binned_line_em[counter,:] = binned_line_em_has_stellar_mass[counter_has_stellar_mass,:]
-                    counter_has_stellar_mass += 1 
-                counter+=1
+    binned_stellar_nu,binned_stellar_fnu,disk_fnu,bulge_fnu,binned_mfrac,binned_line_em = sg.allstars_sed_gen(sed_bins_list_has_stellar_mass,cosmoflag,sp,ssp_grid=ssp_grid)
 
     print(f'after selecting for ones with stellar mass: {np.shape(binned_stellar_fnu)}')
 
@@ -336,12 +249,10 @@ def add_binned_seds(df_nu,stars_list,diskstars_list,bulgestars_list,cosmoflag,m,
     if np.isnan(np.sum(binned_stellar_fnu)): pdb.set_trace()
     '''
 
-    #now binned_stellar_nu and binned_stellar_fnu are the SEDs for the bins in order of wz, wa, wm 
+    #now binned_stellar_nu and binned_stellar_fnu are the SEDs for the occupied bins in order of wz, wa, wm 
     
-    #create the point source collections: we loop through the bins and
-    #see what star particles correspond to these.  if any do, then we
-    #add them to a list, and create a point source collection out of
-    #these
+    #create the point source collections: one for every occupied bin,
+    #holding all the star particles that fall in that bin
 
 
     print ('adding point source collections')
@@ -350,83 +261,64 @@ def add_binned_seds(df_nu,stars_list,diskstars_list,bulgestars_list,cosmoflag,m,
 
     totallum = 0 
     totalmass = 0 
-    counter=0
     fnu_arr = []
     pos_arr = []
 
-    for wz in range(N_METAL_BINS):
-        for wa in range(cfg.par.N_STELLAR_AGE_BINS+1):
-            for wm in range(cfg.par.N_MASS_BINS+1):
-                
-                if has_stellar_mass[wz,wa,wm] == True:
-                
-                    source = m.add_point_source_collection()                    
-                    
-                    nu = binned_stellar_nu
-                    fnu = binned_stellar_fnu[counter,:]
+    #compress (and reverse for hyperion) the SEDs of all the occupied bins at once
+    compressor = WavelengthCompressor(binned_stellar_nu,df_nu)
+    nu = compressor.nu[::-1]
+    compressed_fnu = compressor(binned_stellar_fnu)[:,::-1]
+    bin_lum = np.absolute(trapz(compressed_fnu,x=nu,axis=1))
 
-                    nu,fnu = wavelength_compress(nu,fnu,df_nu)
+    for k in range(n_occupied):
 
-                    #reverse for hyperion
-                    nu = nu[::-1]
-                    fnu = fnu[::-1]
+        members = stars_in_bin[k]
 
+        source = m.add_point_source_collection()                    
                     
-                    #source luminosities
-                    #here, each (wz, wa, wm) bin will have an associated mfrac that corresponds to the fnu generated for this bin
-                    #while each star particle in the bin has a distinct mass, they all share mfrac as this value depends only on the age and Z of the star
-                    #thus, there are 'counter' number of binned_mfrac values (to match the number of fnu arrays)
-                    lum = np.array([stars_list[i].mass/constants.M_sun.cgs.value*constants.L_sun.cgs.value/binned_mfrac[counter] for i in stars_in_bin[(wz,wa,wm)]])
-                    lum *= np.absolute(np.trapz(fnu,x=nu))
-                    source.luminosity = lum
-
-                    pagb = cfg.par.add_pagb_stars and cfg.par.PAGB_min_age <= age_bins[wa] <= cfg.par.PAGB_max_age
-                    young_star = cfg.par.add_young_stars and cfg.par.HII_min_age <= age_bins[wa] <= cfg.par.HII_max_age
+        fnu = compressed_fnu[k,:]
                     
-                    for i in stars_in_bin[(wz,wa,wm)]:  totalmass += stars_list[i].mass
+        #source luminosities
+        #here, each (wz, wa, wm) bin will have an associated mfrac that corresponds to the fnu generated for this bin
+        #while each star particle in the bin has a distinct mass, they all share mfrac as this value depends only on the age and Z of the star
+        lum = stars_list.mass[members]/constants.M_sun.cgs.value*constants.L_sun.cgs.value/binned_mfrac[k]
+        lum *= bin_lum[k]
+        source.luminosity = lum
+
+        pagb = cfg.par.add_pagb_stars and cfg.par.PAGB_min_age <= bin_age[k] <= cfg.par.PAGB_max_age
+        young_star = cfg.par.add_young_stars and cfg.par.HII_min_age <= bin_age[k] <= cfg.par.HII_max_age
                     
-                    #source positions
-                    pos = np.zeros([len(stars_in_bin[(wz,wa,wm)]),3])
-
-                    for i in range(len(stars_in_bin[(wz,wa,wm)])):
-                        pos[i,:] = stars_list[stars_in_bin[(wz,wa,wm)][i]].positions
-                        age_star = stars_list[stars_in_bin[(wz,wa,wm)][i]].age
-
-                        if (cfg.par.add_neb_emission) and (young_star or pagb):
-                            pos_arr.append(pos[i, :])
-                            fnu_arr.append(binned_stellar_fnu[counter,:])
-                            line_em = binned_line_em[counter,:]
-                            # the stellar population returns the calculation in units of Lsun/1 Msun: 
-                            # https://github.com/dfm/python-fsps/issues/117#issuecomment-546513619
-                            line_em = line_em * (stars_list[stars_in_bin[(wz,wa,wm)][i]].mass * units.g).to(units.Msun).value * 3.839e33 # Units: ergs/s
-                            OH = stars_list[stars_in_bin[(wz,wa,wm)][i]].all_metals[4]
-                            line_em = np.append(line_em, OH)
-
-                            if young_star:
-                                line_em = np.append(line_em, 1)
-                            elif pagb:
-                                line_em = np.append(line_em, 2)
-
-                            dump_emlines(line_em)
+        totalmass += np.sum(stars_list.mass[members])
+                    
+        #source positions
+        pos = stars_list.positions[members]
+
+        if (cfg.par.add_neb_emission) and (young_star or pagb):
+            pos_arr.extend(pos)
+            fnu_arr.extend([binned_stellar_fnu[k,:]]*len(members))
+
+        if cfg.par.add_neb_emission and cfg.par.dump_emlines and (young_star or pagb):
+            # the stellar population returns the calculation in units of Lsun/1 Msun: 
+            # https://github.com/dfm/python-fsps/issues/117#issuecomment-546513619
+            line_em = np.outer((stars_list.mass[members] * units.g).to(units.Msun).value * 3.839e33, binned_line_em[k,:]) # Units: ergs/s
+            OH = stars_list.all_metals[members,4]
+
+            if young_star:
+                source_id = np.ones(len(members))
+            else:
+                source_id = np.ones(len(members))*2
+
+            dump_emlines(np.column_stack([line_em,OH,source_id]))
 
                             
-                    source.position=pos
-                    #source spectrum
-                    source.spectrum = (nu,fnu)
+        source.position=pos
+        #source spectrum
+        source.spectrum = (nu,fnu)
                                     
-                    totallum += np.sum(source.luminosity)
-
-                    '''
-                    if np.isnan(lum): 
-                        print 'lum is a nan in point source collection addition. exiting now.'
-                        sys.exit()
-                    if np.isinf(lum): 
-                        print 'lum is an inf in point source collection addition. exiting now.'
-                        sys.exit()
-                    '''
-                counter+=1
-    
+        totallum += np.sum(source.luminosity)
+
     
+
     if cfg.par.add_neb_emission and (cfg.par.SAVE_NEB_SEDS or cfg.par.add_DIG_neb) and (len(pos_arr) != 0):
         dump_NEB_SEDs(binned_stellar_nu, fnu_arr, pos_arr)
 
@@ -441,24 +333,216 @@ def add_binned_seds(df_nu,stars_list,diskstars_list,bulgestars_list,cosmoflag,m,
     return m
 
 
+def fixed_sed_bins(stars_list,binned_idx,sp):
+
+    #bins the stars on the fixed grid of N_STELLAR_AGE_BINS
+    #logarithmic age bins, the fsps metallicities and N_MASS_BINS
+    #mass bins.  returns None if there is nothing to bin.
+
+    # calculate max and min ages and masses
+    minimum_age = np.min(stars_list.age)
+    maximum_age = np.max(stars_list.age)
+
+    # If Flag is set we do not bin stars younger than the age set by max_age_unbinned_stars
+    if not cfg.par.FORCE_BINNED and cfg.par.max_age_direct > minimum_age:
+        minimum_age = cfg.par.max_age_direct + 0.001
+
+    delta_age = (maximum_age-minimum_age)/cfg.par.N_STELLAR_AGE_BINS
+
+    if delta_age <= 0:
+        return None
+
+    # define the metallicity bins: we do this by saying that they are the number of metallicity bins in FSPS
+
+    fsps_metals = np.array(sp.zlegend)
+    N_METAL_BINS = len(fsps_metals)
+
+    # note the bins are NOT metallicity, but rather the zmet keys in
+    # fsps (i.e. the zmet column in Table 1 of the fsps manual)
+    metal_bins = np.arange(N_METAL_BINS)+1
+
+    # define the age bins in log space so that we maximise resolution around young stars
+    age_bins = 10.**(np.linspace(np.log10(minimum_age),np.log10(maximum_age),cfg.par.N_STELLAR_AGE_BINS))
+
+    #tack on the maximum age bin
+    age_bins = np.append(age_bins,age_bins[-1]+delta_age)
+
+   
+    mass_bins = sed_mass_bins(stars_list.mass)
+        
+    print ('mass_bins = ',mass_bins)
+    print ('metal_bins = ',metal_bins)
+    print ('age_bins = ',age_bins)
+
+    #every star gets the index of its nearest metal, age and mass bin;
+    #the occupied bins come out of np.unique in the same wz, wa, wm
+    #order the bins would be looped over
+    wz = find_nearest_sorted(metal_bins,stars_list.fsps_zmet[binned_idx])
+    wa = find_nearest_sorted(age_bins,stars_list.age[binned_idx])
+    wm = find_nearest_sorted(mass_bins,stars_list.mass[binned_idx])
+
+    bin_shape = (len(metal_bins),len(age_bins),len(mass_bins))
+    flat_bin = np.ravel_multi_index((wz,wa,wm),bin_shape)
+    occupied_bins,star_bin = np.unique(flat_bin,return_inverse=True)
+    occ_wz,occ_wa,occ_wm = np.unravel_index(occupied_bins,bin_shape)
+
+    return star_bin,metal_bins[occ_wz],age_bins[occ_wa],mass_bins[occ_wm]
+
+
+def sed_mass_bins(mass):
+
+    #the N_MASS_BINS+1 logarithmic mass bins spanning mass
+    minimum_mass = np.min(mass)
+    maximum_mass = np.max(mass)
+
+    #note - for some codes, all star particles have the same mass.  in this case, we have to have a trap:
+    if minimum_mass == maximum_mass or cfg.par.N_MASS_BINS == 0: 
+        return np.zeros(cfg.par.N_MASS_BINS+1)+minimum_mass
+
+    delta_mass = (np.log10(maximum_mass)-np.log10(minimum_mass))/cfg.par.N_MASS_BINS
+    mass_bins = np.arange(np.log10(minimum_mass),np.log10(maximum_mass),delta_mass)
+    mass_bins = np.append(mass_bins,mass_bins[-1]+delta_mass)
+    return 10.**mass_bins
+
+
+def adaptive_sed_bins(stars_list,binned_idx,ssp_grid):
+
+    #error controlled age binning.  at every fsps metallicity the
+    #stars are first put on a fine log-age histogram (four times the
+    #age resolution of the SSP grid), and neighbouring fine bins are then
+    #greedily merged, from young to old, for as long as representing
+    #the merged bin by a single SSP (at the mass weighted mean log age)
+    #keeps the integrated SED error
+    #
+    #   int |F_true - F_binned| dnu / int F_true dnu
+    #
+    #below ADAPTIVE_BINNING_TOLERANCE.  young stars, whose spectra
+    #change quickly with age, thus keep narrow bins while old stars
+    #collapse into a handful of wide ones, and empty age ranges never
+    #get a bin at all.  metallicities stay on the fsps zmet grid.
+    #
+    #the error is measured on the SSP spectra, which is not what
+    #newstars_gen gives the stars with nebular emission or a cluster
+    #decomposition (those spectra also depend on the star mass).  these
+    #are never merged: they keep their fine age bins, and are binned in
+    #mass as well, on the mass bins of fixed_sed_bins.
+
+    tolerance = cfg.par.ADAPTIVE_BINNING_TOLERANCE
+
+    log_age = np.log10(stars_list.age[binned_idx]*1.e9)
+    zmet = stars_list.fsps_zmet[binned_idx]
+    mass = stars_list.mass[binned_idx]
+    nu = 1.e8*constants.c.cgs.value/ssp_grid.wav
+
+    grid_age = ssp_grid.log_age
+    fine_nodes = np.interp(np.arange(0,len(grid_age)-0.75,0.25),np.arange(len(grid_age)),grid_age)
+    fine = find_nearest_sorted(fine_nodes,log_age)
+
+    star_bin = np.zeros(len(binned_idx),dtype=int)
+    bin_zmet = []
+    bin_age = []
+    bin_mass = []
+
+    def binned_sed(mass_sum,logage_sum,z):
+        fnu,mfrac = ssp_grid.interpolate([10.**(logage_sum/mass_sum)/1.e9],[z])
+        return fnu[0]*mass_sum/mfrac[0]
+
+    individual = mass_dependent_sps(stars_list.age[binned_idx])
+
+    for z in np.unique(zmet[~individual]):
+        in_z = np.where((zmet == z) & ~individual)[0]
+
+        occ,fine_bin = np.unique(fine[in_z],return_inverse=True)
+        nfine = len(occ)
+        fine_mass = np.bincount(fine_bin,weights=mass[in_z],minlength=nfine)
+        fine_logage = np.bincount(fine_bin,weights=mass[in_z]*log_age[in_z],minlength=nfine)
+
+        #the SED of every fine bin, scaled from formed to current mass
+        fine_fnu,fine_mfrac = ssp_grid.interpolate(10.**(fine_logage/fine_mass)/1.e9,np.repeat(z,nfine))
+        fine_sed = fine_fnu*(fine_mass/fine_mfrac)[:,np.newaxis]
+
+        group = np.zeros(nfine,dtype=int)
+        ngroup = 0
+        true_sed = fine_sed[0].copy()
+        mass_sum = fine_mass[0]
+        logage_sum = fine_logage[0]
+
+        for k in range(1,nfine):
+            trial_sed = true_sed+fine_sed[k]
+            trial_mass = mass_sum+fine_mass[k]
+            trial_logage = logage_sum+fine_logage[k]
+
+            error = np.abs(trapz(np.abs(trial_sed-binned_sed(trial_mass,trial_logage,z)),x=nu)/trapz(trial_sed,x=nu))
+
+            if error <= tolerance:
+                true_sed,mass_sum,logage_sum = trial_sed,trial_mass,trial_logage
+            else:
+                ngroup += 1
+                true_sed = fine_sed[k].copy()
+                mass_sum = fine_mass[k]
+                logage_sum = fine_logage[k]
+            group[k] = ngroup
+        ngroup += 1
+
+        group_mass = np.bincount(group,weights=fine_mass,minlength=ngroup)
+        group_logage = np.bincount(group,weights=fine_logage,minlength=ngroup)/group_mass
+        group_nstars = np.bincount(group[fine_bin],minlength=ngroup)
+
+        star_bin[in_z] = len(bin_zmet)+group[fine_bin]
+        bin_zmet.extend([z]*ngroup)
+        bin_age.extend(10.**group_logage/1.e9)
+        bin_mass.extend(group_mass/group_nstars)
+
+    nadaptive = len(bin_zmet)
+    if np.any(individual):
+        in_ind = np.where(individual)[0]
+        mass_bins = sed_mass_bins(stars_list.mass)
+        wm = find_nearest_sorted(mass_bins,mass[in_ind])
+
+        occ,group = np.unique(np.column_stack([zmet[in_ind],fine[in_ind],wm]),axis=0,return_inverse=True)
+        group = group.ravel()
+        ngroup = len(occ)
+        group_mass = np.bincount(group,weights=mass[in_ind],minlength=ngroup)
+        group_logage = np.bincount(group,weights=mass[in_ind]*log_age[in_ind],minlength=ngroup)/group_mass
+
+        star_bin[in_ind] = len(bin_zmet)+group
+        bin_zmet.extend(occ[:,0])
+        bin_age.extend(10.**group_logage/1.e9)
+        bin_mass.extend(mass_bins[occ[:,2]])
+
+    print ('[source_creation/adaptive_sed_bins:] binned %d stars into %d adaptive SED bins (tolerance = %g), and %d stars with nebular or cluster spectra into %d age and mass bins'%(np.sum(~individual),nadaptive,tolerance,np.sum(individual),len(bin_zmet)-nadaptive))
+
+    return star_bin,np.array(bin_zmet),np.array(bin_age),np.array(bin_mass)
+
+
+class WavelengthCompressor:
+
+    #restricts SEDs on the frequency grid nu to the frequencies covered
+    #by the dust opacity tables (df_nu), and drops everything below the
+    #lyman limit.  the index mask only depends on the two frequency
+    #grids, so it is built once and then applied to any number of SEDs
+    #(a single fnu, or an [nsed,nnu] matrix) without any unit handling.
+
+    def __init__(self,nu,df_nu):
+        nu = np.asarray(nu)
+        lam = 1.e8*constants.c.cgs.value/nu #angstrom
+
+        #in the range of the dust opacities, and lambda above the lyman limit
+        keep = (nu >= np.min(df_nu)) & (nu <= np.max(df_nu)) & (lam >= 912)
+        self.idx = np.where(keep)[0]
+        self.nu = nu[self.idx]
+
+    def __call__(self,fnu):
+        return np.asarray(fnu)[...,self.idx]
+
+
 def wavelength_compress(nu,fnu,df_nu):
-    
-    nu_inrange = np.logical_and(nu >= min(df_nu),nu <= max(df_nu))
-    nu_inrange = np.where(nu_inrange == True)[0]
-  
-    compressed_nu = nu[nu_inrange]
-    compressed_fnu = np.asarray(fnu)[nu_inrange]
-    
-    #get rid of all wavelengths below lyman limit
-    dum_nu = compressed_nu*units.Hz
-    dum_lam = constants.c.cgs/dum_nu
-    dum_lam = dum_lam.to(units.angstrom)
-
-    wll = np.where(dum_lam.value >= 912)[0] #where are lambda is above the lyman limit
-    compressed_nu = compressed_nu[wll] 
-    compressed_fnu = compressed_fnu[wll]
-    
-    return compressed_nu, compressed_fnu
+
+    #one-off convenience wrapper around WavelengthCompressor; callers
+    #that compress many SEDs on the same grid should build the
+    #compressor once instead.
+    compressor = WavelengthCompressor(nu,df_nu)
+    return compressor.nu, compressor(fnu)
     
 
 def BH_source_add(m,reg,df_nu,boost):
@@ -479,10 +563,8 @@ def BH_source_add(m,reg,df_nu,boost):
         print('BH source creation failed. No BH found')
     
     else:
-        #temporary wavelength compress just to get the length of the
-        #compressed nu for a master array
-        dumnu,dumfnu = wavelength_compress(reg["bh","nu"].value,reg["bh","sed"][0,:].value,df_nu)
-        master_bh_fnu = np.zeros([nholes,len(dumnu)])
+        compressor = WavelengthCompressor(reg["bh","nu"].value,df_nu)
+        master_bh_fnu = np.zeros([nholes,len(compressor.nu)])
          
         width = reg.right_edge-reg.left_edge
 
@@ -514,12 +596,11 @@ def BH_source_add(m,reg,df_nu,boost):
         print ('Number AGNs in the cutout with non zero luminositites: ', len(agn_ids))
 
         fnu_arr = sg.get_agn_seds(agn_ids, reg)
-        nu = reg["bh","nu"].value
+        nu = compressor.nu
 
         for j in range(len(agn_ids)):
                 i = agn_ids[j]
-                fnu = fnu_arr[j,:]
-                nu, fnu = wavelength_compress(nu,fnu,df_nu)
+                fnu = compressor(fnu_arr[j,:])
 
                 master_bh_fnu[i,:] = fnu
 
@@ -581,11 +662,7 @@ def DIG_source_add(m,reg,df_nu,boost):
     lam_arr = []
     fnu_arr = []
   
-    sed_file_name = cfg.model.PD_output_dir+"neb_seds_galaxy_"+cfg.model.galaxy_num_str+".npz"
-    data = np.load(sed_file_name)
-    nu = data['nu']
-    stars_fnu = data["fnu"]
-    star_coordinates = data["positions"]
+    nu, stars_fnu, star_coordinates = load_NEB_SEDs()
     
     print ("[Source creation (DIG)] Generating KD Tree")
     tree = spatial.KDTree(star_coordinates)
@@ -636,15 +713,15 @@ def DIG_source_add(m,reg,df_nu,boost):
     print("----------------------------------------------------------------------------------")
     
     fnu_arr_neb = sg.get_dig_seds(lam, fnu_arr, logU, cell_width, met)
+
+    compressor = WavelengthCompressor(1.e8 * constants.c.cgs.value / lam, df_nu)
+    nu = compressor.nu[::-1]
+    fnu_arr_neb = compressor(fnu_arr_neb)[:, ::-1]
+
     for i in range(len(logU)):
-        nu = 1.e8 * constants.c.cgs.value / lam
         fnu = fnu_arr_neb[i,:]
-        nu, fnu = wavelength_compress(nu,fnu,df_nu)
-        
-        nu = nu[::-1]
-        fnu = fnu[::-1]
 
-        lum = np.trapz(fnu,x=nu)*constants.L_sun.cgs.value
+        lum = trapz(fnu,x=nu)*constants.L_sun.cgs.value
         
         source = m.add_point_source()
         source.luminosity = lum # [ergs/s]
@@ -0,0 +1,177 @@
+from __future__ import print_function
+import numpy as np
+import multiprocessing
+from scipy.spatial import cKDTree
+
+#SPH estimates of particle quantities at arbitrary points (the leaves of
+#the octree, or the centres of newly refined octree cells) outside of
+#yt's octree deposition.  the points are split into spatially compact
+#blocks, and every block is owned by one task: the task puts the
+#points of its block in a kd-tree, scatters every particle whose
+#kernel reaches the block onto the points within its smoothing length,
+#and writes the sums of its own points straight into the result.  the
+#cost scales with the number of particle/point pairs rather than with
+#the number of particles times the number of points.  the blocks are
+#deposited by a pool of n_processes forked processes, which share the
+#particle arrays and write into a result in shared memory, so nothing
+#larger than a block index goes through the pool.
+
+#particles deposited at a time: bounds the memory of the
+#particle/point pairs
+DEPOSIT_CHUNK_SIZE = 100000
+
+#the arrays of the deposit in progress, for the forked workers
+_deposit_state = None
+
+
+def cubic_spline_kernel(r,h):
+
+    #the M4 cubic spline with compact support h (the convention of
+    #gadget smoothing lengths, and of yt's deposition), normalized to
+    #integrate to 1 in 3D
+    q = r/h
+    w = np.where(q < 0.5,1.-6.*q**2+6.*q**3,2.*np.clip(1.-q,0.,None)**3)
+    return 8./(np.pi*h**3)*w
+
+
+def point_blocks(points,nblocks):
+
+    #splits the points into nblocks spatially compact blocks by
+    #bisecting the largest block along its longest axis until there
+    #are nblocks (so no block is more than twice the size of another).
+    #returns a list of index arrays
+    blocks = [np.arange(len(points))]
+    while len(blocks) < nblocks:
+        blocks.sort(key=len)
+        idx = blocks.pop()
+        if len(idx) < 2:
+            blocks.append(idx)
+            break
+        block_points = points[idx]
+        axis = np.argmax(np.ptp(block_points,axis=0))
+        half = len(idx)//2
+        split = np.argpartition(block_points[:,axis],half)
+        blocks += [idx[split[:half]],idx[split[half:]]]
+    return blocks
+
+
+def _deposit_block(b):
+
+    #deposits every particle that reaches block b onto the points of
+    #the block, DEPOSIT_CHUNK_SIZE particles at a time, and writes the
+    #sums into the result
+    points,positions,hsml,values,blocks,particle_tree,result = _deposit_state
+    idx = blocks[b]
+    block_points = points[idx]
+    partial = np.zeros((len(idx),)+values.shape[1:])
+
+    lo = np.min(block_points,axis=0)
+    hi = np.max(block_points,axis=0)
+    if particle_tree is None:
+        candidates = np.arange(len(positions))
+    else:
+        #(a ball around the block that holds every particle whose
+        #kernel can reach it, then the exact test)
+        candidates = np.asarray(particle_tree.query_ball_point((lo+hi)/2.,np.sqrt(np.sum((hi-lo)**2))/2.+np.max(hsml)),dtype=np.int64)
+    reach = np.all((positions[candidates]+hsml[candidates,np.newaxis] >= lo) &
+                   (positions[candidates]-hsml[candidates,np.newaxis] <= hi),axis=1)
+    candidates = np.sort(candidates[reach])
+
+    if len(candidates) > 0:
+        tree = cKDTree(block_points)
+    for start in range(0,len(candidates),DEPOSIT_CHUNK_SIZE):
+        ichunk = candidates[start:start+DEPOSIT_CHUNK_SIZE]
+        neighbours = tree.query_ball_point(positions[ichunk],r=hsml[ichunk])
+        counts = np.fromiter(map(len,neighbours),dtype=np.int64,count=len(neighbours))
+        if np.sum(counts) == 0: continue
+
+        ipoint = np.concatenate([nb for nb in neighbours if len(nb) > 0]).astype(np.int64)
+        ipart = np.repeat(ichunk,counts)
+
+        #the kernel weights are computed once for all of the fields
+        r = np.sqrt(np.sum((block_points[ipoint]-positions[ipart])**2,axis=1))
+        weights = cubic_spline_kernel(r,hsml[ipart])
+        if values.ndim == 1:
+            partial += np.bincount(ipoint,weights=weights*values[ipart],minlength=len(idx))
+        else:
+            for i in range(values.shape[1]):
+                partial[:,i] += np.bincount(ipoint,weights=weights*values[ipart,i],minlength=len(idx))
+
+    #(every point belongs to exactly one block)
+    result[idx] = partial
+
+
+def deposit(points,positions,hsml,values,n_processes=1):
+
+    #sum_j values_j W(|x - x_j|, h_j) at every point x, for particles
+    #at positions [npart,3] with smoothing lengths hsml [npart], all in
+    #consistent (unitless) units.  values [npart,nfields] deposits
+    #several fields in one pass, giving [npoints,nfields]
+    global _deposit_state
+
+    points = np.atleast_2d(np.asarray(points,dtype=float))
+    positions = np.asarray(positions,dtype=float)
+    hsml = np.asarray(hsml,dtype=float)
+    values = np.asarray(values,dtype=float)
+
+    shape = (len(points),)+values.shape[1:]
+    if len(points) == 0 or len(positions) == 0:
+        return np.zeros(shape)
+
+    #only the particles whose kernels reach the bounding box of the
+    #points can contribute
+    lo = np.min(points,axis=0)
+    hi = np.max(points,axis=0)
+    near = np.all((positions+hsml[:,np.newaxis] >= lo) &
+                  (positions-hsml[:,np.newaxis] <= hi),axis=1)
+    near = np.flatnonzero(near)
+    if len(near) == 0:
+        return np.zeros(shape)
+    positions,hsml,values = positions[near],hsml[near],values[near]
+
+    #a few blocks per process, so that the processes that get the
+    #denser regions do not hold up the others
+    nblocks = min(4*n_processes,len(points)) if n_processes > 1 else 1
+    blocks = point_blocks(points,nblocks)
+    nblocks = len(blocks)
+
+    if nblocks > 1:
+        context = multiprocessing.get_context('fork')
+        result = np.frombuffer(context.RawArray('d',int(np.prod(shape))),dtype=float).reshape(shape)
+        _deposit_state = (points,positions,hsml,values,blocks,cKDTree(positions),result)
+        try:
+            pool = context.Pool(processes=n_processes)
+            try:
+                for _ in pool.imap_unordered(_deposit_block,range(nblocks)):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _deposit_state = None
+    else:
+        result = np.zeros(shape)
+        _deposit_state = (points,positions,hsml,values,blocks,None,result)
+        try:
+            _deposit_block(0)
+        finally:
+            _deposit_state = None
+
+    return result
+
+
+class SPHSampler:
+
+    def __init__(self,positions,masses,hsml,n_processes=1):
+        #positions [npart,3], masses [npart] and smoothing lengths
+        #[npart], all in consistent (unitless) units
+        self.positions = np.asarray(positions,dtype=float)
+        self.masses = np.asarray(masses,dtype=float)
+        self.hsml = np.asarray(hsml,dtype=float)
+        self.n_processes = n_processes
+
+    def density(self,points,weights=None):
+
+        #sum_j m_j (x weights_j) W(|x - x_j|, h_j) at every point
+        values = self.masses if weights is None else self.masses*np.asarray(weights)
+        return deposit(points,self.positions,self.hsml,values,self.n_processes)
@@ -11,12 +11,15 @@ import matplotlib as mpl
 mpl.use('Agg')
 import powderday.config as cfg
 
-from powderday.grid_construction import yt_octree_generate
+from powderday.grid_construction import yt_octree_generate,tau_adaptive_octree
+from powderday.octree_tools import OctreeTraversal,prune_octree
 from powderday.find_order import find_order
+from powderday.sph_deposit import SPHSampler
+from powderday.octree_cache import octree_ordering
 import powderday.powderday_test_octree as pto
 import powderday.hyperion_octree_stats as hos
 
-from hyperion.dust import SphericalDust
+from powderday.helpers import load_dust
 
 from powderday.helpers import energy_density_absorbed_by_CMB
 from powderday.analytics import dump_cell_info
@@ -54,6 +57,11 @@ def sph_m_gen(fname,field_add):
     dy = (np.max(ymax)-np.min(ymin)).value
     dz = (np.max(zmax)-np.min(zmin)).value
 
+    #the centre of the parent grid, which the hyperion octree is
+    #centred on
+    root_center = np.array([(np.max(xmax)+np.min(xmin)).value/2.,
+                            (np.max(ymax)+np.min(ymin)).value/2.,
+                            (np.max(zmax)+np.min(zmin)).value/2.])
 
     xcent = float(ds.quan(cfg.model.x_cent,"code_length").to('cm').value)
     ycent = float(ds.quan(cfg.model.y_cent,"code_length").to('cm').value)
@@ -75,23 +83,56 @@ def sph_m_gen(fname,field_add):
     refined_array = np.array(refined)
     refined_array = np.squeeze(refined_array)
     
-    order = find_order(refined_array)
-    refined_reordered = []
-    dustdens_reordered = np.zeros(len(order))
-    
-
-
-    
-    for i in range(len(order)): 
-        refined_reordered.append(refined[order[i]])
-        dustdens_reordered[i] = dustdens[order[i]]
-
-
-    refined = refined_reordered
-    dustdens=dustdens_reordered
+    #the ordering comes from the octree cache if there is one; otherwise
+    #one traversal of the octree gives both the reordering and the
+    #octree statistics (which do not depend on the cell ordering)
+    order, octree = octree_ordering(reg, refined_array)
+
+    refined = refined_array[order]
+    dustdens = np.asarray(dustdens)[order]
+
+    #the octree yt built, which the cell positions and sizes (fc1,
+    #fw1) describe and which analytics.dump_data takes the gridded
+    #gas, dust and star quantities from
+    yt_refined = refined
+
+    octree_changed = False
+
+    if cfg.par.OCTREE_TAU_REFINEMENT:
+        #merge optically thin and refine optically thick cells
+        sampler = SPHSampler(reg["gas","coordinates"].in_units('cm').value-root_center,
+                             reg["gas","masses"].in_units('g').value,
+                             reg["gas","smoothinglength"].in_units('cm').value,
+                             n_processes=cfg.par.n_processes)
+        refined,dustdens = tau_adaptive_octree(refined,dustdens,[dx,dy,dz],sampler)
+        octree_changed = True
+
+    if cfg.par.OCTREE_PRUNE:
+        #collapse empty subtrees.  the grain size distributions of the
+        #active dust model are per leaf, in yt order: they are spread
+        #over the (hyperion ordered) cells to be pruned along with the
+        #densities, and collected again afterwards
+        cell_sizes = None
+        if cfg.par.otf_extinction:
+            yt_order = find_order(refined)
+            cell_sizes = np.zeros([len(refined),reg.parameters["octree_of_sizes"].shape[1]])
+            cell_sizes[yt_order[~refined[yt_order]]] = reg.parameters["octree_of_sizes"]
+
+        refined,dustdens,cell_sizes = prune_octree(refined,dustdens,cfg.par.OCTREE_PRUNE_TOLERANCE,cell_sizes)
+
+        if cfg.par.otf_extinction:
+            yt_order = find_order(refined)
+            reg.parameters["octree_of_sizes"] = cell_sizes[yt_order][~refined[yt_order]]
+        octree_changed = True
+
+    if octree_changed:
+        #(for the octree statistics).  the cell positions and sizes that
+        #are dumped below stay those of the yt octree, so that they
+        #match the other gridded quantities of the dumps
+        octree = OctreeTraversal(refined)
 
     #hyperion octree stats
-    max_level = hos.hyperion_octree_stats(refined)
+    max_level = hos.hyperion_octree_stats(refined,octree)
 
 
     pto.test_octree(refined,max_level)
@@ -100,9 +141,9 @@ def sph_m_gen(fname,field_add):
     #an effective 'size' of a cell by density = mass/volume and assume
     #spherical geometry.  similarly, saving the particle location information
     if float(yt.__version__[0:3]) >= 4:
-        dump_cell_info(refined,fc1.to('cm'),fw1.to('cm'),xmin,xmax,ymin,ymax,zmin,zmax)
+        dump_cell_info(yt_refined,fc1.to('cm'),fw1.to('cm'),xmin,xmax,ymin,ymax,zmin,zmax)
     else:
-        dump_cell_info(refined,fc1.convert_to_units('cm'),fw1.convert_to_units('cm'),xmin,xmax,ymin,ymax,zmin,zmax)
+        dump_cell_info(yt_refined,fc1.convert_to_units('cm'),fw1.convert_to_units('cm'),xmin,xmax,ymin,ymax,zmin,zmax)
     reg.parameters['cell_size']=fw1.convert_to_units('cm') #so that we can have a uniform naming scheme for different front ends for saving in analytics/dump_data(
     reg.parameters['cell_position'] = fc1
 
@@ -148,16 +189,12 @@ def sph_m_gen(fname,field_add):
             frac = {k: v / total for k, v in frac.items()}
 
             for size in frac.keys():
-                d = SphericalDust(cfg.par.dustdir+'%s.hdf5'%size)
-                if cfg.par.SUBLIMATION == True:
-                    d.set_sublimation_temperature('fast',temperature=cfg.par.SUBLIMATION_TEMPERATURE)
+                d = load_dust(cfg.par.dustdir+'%s.hdf5'%size)
                 #m.add_density_grid(dustdens * frac[size], cfg.par.dustdir+'%s.hdf5' % size)
                 m.add_density_grid(dustdens*frac[size],d,specific_energy=specific_energy)
             m.set_enforce_energy_range(cfg.par.enforce_energy_range)
         else:
-            d = SphericalDust(cfg.par.dustdir+cfg.par.dustfile)
-            if cfg.par.SUBLIMATION == True:
-                d.set_sublimation_temperature('fast',temperature=cfg.par.SUBLIMATION_TEMPERATURE)
+            d = load_dust(cfg.par.dustdir+cfg.par.dustfile)
             m.add_density_grid(dustdens,d,specific_energy=specific_energy)
         #m.add_density_grid(dustdens,cfg.par.dustdir+cfg.par.dustfile)  
 
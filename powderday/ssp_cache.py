@@ -0,0 +1,104 @@
+from __future__ import print_function
+import numpy as np
+import powderday.config as cfg
+import hashlib
+import os
+import sys
+import tempfile
+
+#on-disk cache of FSPS spectra.  every spectrum is stored under a key
+#that is a hash of the full FSPS parameter state (ages, metallicity,
+#IMF, nebular and birth cloud settings all live in sp.params) plus the
+#isochrone/spectral libraries, so that a cached spectrum can never be
+#returned for a stellar population that would have been computed
+#differently.  reruns of the same snapshot (for example while tuning
+#dust parameters) then skip sp.get_spectrum entirely.
+
+
+def ssp_cache_dir():
+    return os.path.expanduser(cfg.par.SSP_CACHE_DIR)
+
+
+def ssp_cache_key(sp, tage, zmet):
+
+    #sp.params holds every parameter that changes the spectrum, so we
+    #hash all of them rather than trying to guess which cfg.par
+    #options are relevant
+    signature = []
+    for key in sorted(sp.params.all_params):
+        try:
+            value = np.asarray(sp.params[key]).tolist()
+        except KeyError:
+            continue
+        signature.append((key, value))
+
+    signature.append(('libraries', [np.asarray(lib).tolist() for lib in sp.libraries]))
+    #the version of the fsps package sp comes from (found through sp,
+    #so that this module does not need to import fsps)
+    package = sys.modules.get(type(sp).__module__.split('.')[0])
+    signature.append(('fsps_version', getattr(package, '__version__', None)))
+    signature.append(('tage', float(tage)))
+    signature.append(('zmet', None if zmet is None else int(zmet)))
+
+    return hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()
+
+
+def get_spectrum(sp, tage=0, zmet=None):
+
+    #drop-in replacement for sp.get_spectrum that also returns the
+    #surviving stellar mass fraction and (if nebular emission is on)
+    #the emission line luminosities, since those are attributes of sp
+    #that are not set when the spectrum comes from the cache.
+    #
+    #returns wav, spec, stellar_mass, emline_luminosity
+
+    if not cfg.par.SSP_CACHE:
+        return _fsps_spectrum(sp, tage, zmet)
+
+    key = ssp_cache_key(sp, tage, zmet)
+    fname = os.path.join(ssp_cache_dir(), key[0:2], key+'.npz')
+
+    if os.path.isfile(fname):
+        try:
+            data = np.load(fname)
+            emline = data['emline'] if data['has_emline'] else None
+            return data['wav'], data['spec'], data['stellar_mass'][()], emline
+        except Exception:
+            #a corrupt or partially written entry is just treated as a miss
+            print('[ssp_cache/get_spectrum:] could not read cache entry %s; regenerating' % fname)
+
+    wav, spec, stellar_mass, emline = _fsps_spectrum(sp, tage, zmet)
+    _write_entry(fname, wav, spec, stellar_mass, emline)
+
+    return wav, spec, stellar_mass, emline
+
+
+def _fsps_spectrum(sp, tage, zmet):
+    wav, spec = sp.get_spectrum(tage=tage, zmet=zmet)
+    stellar_mass = sp.stellar_mass
+    if sp.params['add_neb_emission']:
+        emline = sp.emline_luminosity
+    else:
+        emline = None
+    return wav, spec, stellar_mass, emline
+
+
+def _write_entry(fname, wav, spec, stellar_mass, emline):
+
+    #write to a temporary file and then move it into place so that
+    #concurrent workers (or runs) never see a half written entry
+    entry_dir = os.path.dirname(fname)
+    os.makedirs(entry_dir, exist_ok=True)
+
+    has_emline = emline is not None
+    if not has_emline:
+        emline = np.zeros(0)
+
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=entry_dir, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, wav=wav, spec=spec, stellar_mass=np.asarray(stellar_mass),
+                     emline=emline, has_emline=has_emline)
+        os.replace(tmpname, fname)
+    except OSError as err:
+        print('[ssp_cache/_write_entry:] could not write cache entry %s: %s' % (fname, err))
@@ -0,0 +1,295 @@
+from __future__ import print_function
+import numpy as np
+import powderday.config as cfg
+import h5py
+
+from powderday.ssp_cache import get_spectrum
+
+#a dense (metallicity x age x wavelength) grid of FSPS SSP spectra that
+#is built once, and from which the spectra for every star (or star
+#bin) are then interpolated in a single vectorized step, instead of
+#calling sp.get_spectrum once per star in a worker process.
+
+
+class SSPGrid:
+    def __init__(self,wav,log_age,zlegend,spectra,stellar_mass):
+        self.wav = np.asarray(wav)                    # angstrom
+        self.log_age = np.asarray(log_age)            # log10(age/yr)
+        self.zlegend = np.asarray(zlegend)
+        self.spectra = np.asarray(spectra)            # [nz,nage,nlam] Lsun/Hz per Msun formed
+        self.stellar_mass = np.asarray(stellar_mass)  # [nz,nage] surviving mass fraction
+
+    @classmethod
+    def from_fsps(cls,sp):
+
+        #the grid carries the same (non-nebular, dust free) SSP
+        #settings that newstars_gen uses for stars that do not need
+        #any special handling
+        set_ssp_params(sp)
+
+        zlegend = np.array(sp.zlegend)
+        spectra = []
+        stellar_mass = []
+        for zmet in range(1,len(zlegend)+1):
+            #with sfh=0 and tage=0 FSPS returns the spectra at every
+            #age in the isochrone grid
+            wav,spec,mass,_ = get_spectrum(sp,tage=0,zmet=zmet)
+            spectra.append(spec)
+            stellar_mass.append(mass)
+
+        return cls(wav,sp.log_age,zlegend,np.array(spectra),np.array(stellar_mass))
+
+    @classmethod
+    def load(cls,filename):
+        with h5py.File(filename,'r') as f:
+            return cls.read(f)
+
+    def save(self,filename):
+        with h5py.File(filename,'w') as f:
+            self.write(f)
+
+    @classmethod
+    def read(cls,group):
+        return cls(group['wav'][:],group['log_age'][:],group['zlegend'][:],group['spectra'][:],group['stellar_mass'][:])
+
+    def write(self,group):
+        group.create_dataset('wav',data=self.wav)
+        group.create_dataset('log_age',data=self.log_age)
+        group.create_dataset('zlegend',data=self.zlegend)
+        group.create_dataset('spectra',data=self.spectra)
+        group.create_dataset('stellar_mass',data=self.stellar_mass)
+
+    def interpolate(self,age,fsps_zmet):
+
+        #age is in Gyr and fsps_zmet in (1-indexed) fsps metallicity
+        #units.  stars are placed exactly on their fsps metallicity
+        #(as elsewhere in powderday), and interpolated linearly in
+        #log age between the two bracketing SSPs, which is how FSPS
+        #itself interpolates SSPs at an arbitrary tage.
+        #
+        #returns fnu [nstars,nlam] and the surviving mass fraction [nstars]
+
+        log_age = np.log10(np.atleast_1d(age)*1.e9)
+        log_age = np.clip(log_age,self.log_age[0],self.log_age[-1])
+        iz = np.atleast_1d(fsps_zmet).astype(int)-1
+
+        ia = np.searchsorted(self.log_age,log_age,side='right')-1
+        ia = np.clip(ia,0,len(self.log_age)-2)
+        w = (log_age-self.log_age[ia])/(self.log_age[ia+1]-self.log_age[ia])
+
+        fnu = (1.-w)[:,None]*self.spectra[iz,ia,:] + w[:,None]*self.spectra[iz,ia+1,:]
+        mfrac = (1.-w)*self.stellar_mass[iz,ia] + w*self.stellar_mass[iz,ia+1]
+
+        return fnu,mfrac
+
+
+class NebularGrid:
+
+    #FSPS SSPs including the nebular emission from the FSPS (CLOUDY)
+    #lookup tables, on a (metallicity x logU x age x wavelength) grid
+    #that covers the young ages that get nebular emission.  the gas
+    #metallicity of every grid point is that of the stellar
+    #metallicity, so stars take the nebular emission of the fsps
+    #metallicity they are placed on.
+
+    def __init__(self,wav,log_age,zlegend,logu,spectra,emline):
+        self.wav = np.asarray(wav)              # angstrom
+        self.log_age = np.asarray(log_age)      # log10(age/yr)
+        self.zlegend = np.asarray(zlegend)
+        self.logu = np.asarray(logu)
+        self.spectra = np.asarray(spectra)      # [nz,nlogu,nage,nlam] Lsun/Hz per Msun formed
+        self.emline = np.asarray(emline)        # [nz,nlogu,nage,nline] Lsun per Msun formed
+
+    @classmethod
+    def from_fsps(cls,sp,logu=np.arange(-4.,-0.5,0.5),max_age=1.e-2):
+
+        set_ssp_params(sp)
+        sp.params["add_neb_emission"] = True
+
+        #all the ages up to (and including the first one past) max_age
+        zlegend = np.array(sp.zlegend)
+        nyoung = np.searchsorted(sp.log_age,np.log10(max_age*1.e9))+1
+        young = np.arange(len(sp.log_age)) < nyoung
+
+        spectra = np.zeros([len(zlegend),len(logu),np.sum(young),len(sp.wavelengths)])
+        emline = []
+        for zmet in range(1,len(zlegend)+1):
+            sp.params['gas_logz'] = np.log10(zlegend[zmet-1]/cfg.par.solar)
+            for j in range(len(logu)):
+                sp.params['gas_logu'] = logu[j]
+                wav,spec,_,lines = get_spectrum(sp,tage=0,zmet=zmet)
+                spectra[zmet-1,j,:,:] = spec[young]
+                emline.append(np.atleast_2d(lines)[young])
+
+        emline = np.array(emline).reshape(len(zlegend),len(logu),np.sum(young),-1)
+
+        return cls(wav,np.array(sp.log_age)[young],zlegend,logu,spectra,emline)
+
+    @classmethod
+    def read(cls,group):
+        return cls(group['wav'][:],group['log_age'][:],group['zlegend'][:],group['logu'][:],group['spectra'][:],group['emline'][:])
+
+    def write(self,group):
+        group.create_dataset('wav',data=self.wav)
+        group.create_dataset('log_age',data=self.log_age)
+        group.create_dataset('zlegend',data=self.zlegend)
+        group.create_dataset('logu',data=self.logu)
+        group.create_dataset('spectra',data=self.spectra)
+        group.create_dataset('emline',data=self.emline)
+
+    def interpolate(self,age,fsps_zmet,logu):
+
+        #single star: age in Gyr, (1-indexed) fsps_zmet and logU.
+        #bilinear in log age and logU (both clipped to the grid), at
+        #the exact fsps metallicity.  returns fnu [nlam] and the line
+        #luminosities [nline]
+        iz = int(fsps_zmet)-1
+
+        def bracket(grid,x):
+            x = np.clip(x,grid[0],grid[-1])
+            i = int(np.clip(np.searchsorted(grid,x,side='right')-1,0,len(grid)-2))
+            return i,(x-grid[i])/(grid[i+1]-grid[i])
+
+        ia,wa = bracket(self.log_age,np.log10(age*1.e9))
+        iu,wu = bracket(self.logu,logu)
+
+        weights = [((1.-wu)*(1.-wa),iu,ia),((1.-wu)*wa,iu,ia+1),(wu*(1.-wa),iu+1,ia),(wu*wa,iu+1,ia+1)]
+        fnu = sum(w*self.spectra[iz,ju,ja] for w,ju,ja in weights)
+        emline = sum(w*self.emline[iz,ju,ja] for w,ju,ja in weights)
+
+        return fnu,emline
+
+
+#---------------------------------------------------------------------
+# SSP libraries: the SSP (and optionally nebular) grids for a given
+# parameters_master, precomputed with pd_ssp_library.py and read by the
+# galaxy runs through SSP_LIBRARY_FILE
+#---------------------------------------------------------------------
+
+_ssp_libraries = {}
+
+def library_signature(libraries):
+
+    #the parameters the library grids depend on, including the FSPS
+    #isochrone / spectral / dust emission libraries; a library is only
+    #used by runs with the same values
+    libraries = ','.join(lib.decode() if isinstance(lib,bytes) else str(lib) for lib in libraries)
+    return {'imf_type':cfg.par.imf_type,'imf1':cfg.par.imf1,'imf2':cfg.par.imf2,'imf3':cfg.par.imf3,
+            'pagb':cfg.par.pagb,'add_agb_dust_model':cfg.par.add_agb_dust_model,'libraries':libraries}
+
+
+def save_ssp_library(filename,ssp_grid,libraries,nebular_grid=None):
+    with h5py.File(filename,'w') as f:
+        for key,value in library_signature(libraries).items():
+            f.attrs[key] = value
+        ssp_grid.write(f.create_group('ssp'))
+        if nebular_grid is not None:
+            nebular_grid.write(f.create_group('nebular'))
+
+
+def _grid_mismatch(grid,sp):
+
+    #the grid axes that do not match the stellar population sp (a
+    #library built with other FSPS data would give spectra of the wrong
+    #length, or metallicities off the end of zlegend)
+    mismatch = []
+    if grid.zlegend.shape != np.shape(sp.zlegend) or not np.allclose(grid.zlegend,sp.zlegend):
+        mismatch.append('zlegend')
+    if grid.wav.shape != np.shape(sp.wavelengths):
+        mismatch.append('wavelengths')
+    return mismatch
+
+
+def load_ssp_library(filename,sp):
+
+    #returns (ssp_grid, nebular_grid); nebular_grid is None if the
+    #library was built without it, and both are None if the library
+    #does not match the current parameters or the FSPS data of sp, in
+    #which case the spectra come from FSPS star by star.  libraries are
+    #only read once per process.
+    signature = library_signature(sp.libraries)
+    key = (filename,tuple(sorted(signature.items())),tuple(np.asarray(sp.zlegend).tolist()),len(sp.wavelengths),len(sp.log_age))
+    if key not in _ssp_libraries:
+        ssp_grid,nebular_grid = None,None
+        with h5py.File(filename,'r') as f:
+            mismatch = [name for name,value in signature.items() if name not in f.attrs or not np.all(_attr(f.attrs[name]) == value)]
+            if len(mismatch) == 0:
+                ssp_grid = SSPGrid.read(f['ssp'])
+                mismatch = _grid_mismatch(ssp_grid,sp)
+                #(the nebular grid only covers the young ages)
+                if ssp_grid.log_age.shape != np.shape(sp.log_age):
+                    mismatch.append('log_age')
+                if 'nebular' in f and len(mismatch) == 0:
+                    nebular_grid = NebularGrid.read(f['nebular'])
+                    mismatch = _grid_mismatch(nebular_grid,sp)
+        if len(mismatch) > 0:
+            print('[ssp_grid/load_ssp_library:] WARNING: %s was built with different %s; not using it (the spectra are computed with FSPS instead)' % (filename,', '.join(mismatch)))
+            ssp_grid,nebular_grid = None,None
+        _ssp_libraries[key] = (ssp_grid,nebular_grid)
+
+    return _ssp_libraries[key]
+
+
+def _attr(value):
+    return value.decode() if isinstance(value,bytes) else value
+
+
+def get_ssp_grid(sp):
+
+    #the SSP grid from the library if there is one, otherwise
+    #computed with FSPS
+    if cfg.par.SSP_LIBRARY_FILE is not None:
+        ssp_grid,_ = load_ssp_library(cfg.par.SSP_LIBRARY_FILE,sp)
+        if ssp_grid is not None:
+            return ssp_grid
+    return SSPGrid.from_fsps(sp)
+
+
+def get_nebular_grid(sp):
+    if cfg.par.SSP_LIBRARY_FILE is None:
+        return None
+    return load_ssp_library(cfg.par.SSP_LIBRARY_FILE,sp)[1]
+
+
+def set_ssp_params(sp):
+    sp.params["imf_type"] = cfg.par.imf_type
+    sp.params["imf1"] = cfg.par.imf1
+    sp.params["imf2"] = cfg.par.imf2
+    sp.params["imf3"] = cfg.par.imf3
+    sp.params["pagb"] = cfg.par.pagb
+    sp.params["sfh"] = 0
+    sp.params["add_neb_emission"] = False
+    sp.params["add_agb_dust_model"] = cfg.par.add_agb_dust_model
+
+
+def needs_individual_sps(age):
+
+    #stars that newstars_gen treats specially (birth clouds, alpha
+    #enhancement, or any of the nebular / cluster decomposition
+    #branches) cannot be taken from the SSP grid.  this only depends
+    #on the star ages (in Gyr), so the mask is computed for a whole
+    #catalog at once
+    age = np.asarray(age)
+    if cfg.par.CF_on or cfg.par.alpha_enhance:
+        return np.ones(age.shape,dtype=bool)
+    return mass_dependent_sps(age)
+
+
+def mass_dependent_sps(age):
+
+    #the stars whose spectra newstars_gen computes from their mass as
+    #well as from their age and metallicity: the nebular emission
+    #(with the ionization parameter of the star or of its clusters) and
+    #the cluster decomposition branches
+    age = np.asarray(age)
+    individual = np.zeros(age.shape,dtype=bool)
+    if cfg.par.add_neb_emission and cfg.par.use_cloudy_tables:
+        individual |= age <= 1.e-2
+
+    if (cfg.par.add_neb_emission or cfg.par.use_cmdf) and not cfg.par.use_cloudy_tables:
+        if cfg.par.add_pagb_stars:
+            individual |= (cfg.par.PAGB_min_age <= age) & (age <= cfg.par.PAGB_max_age)
+        if cfg.par.add_young_stars:
+            individual |= (cfg.par.HII_min_age <= age) & (age <= cfg.par.HII_max_age)
+
+    return individual
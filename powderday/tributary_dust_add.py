@@ -6,7 +6,7 @@
 from __future__ import print_function
 import numpy as np
 import powderday.config as cfg
-from hyperion.dust import SphericalDust
+from powderday.helpers import load_dust
 import pdb
 from powderday.helpers import find_nearest
 from powderday.active_dust.dust_file_writer import *
@@ -25,7 +25,9 @@ def active_dust_add(ds,m,grid_of_sizes,nsizes,dustdens,specific_energy,refined=[
         ds.parameters['reg_grid_of_sizes_silicate'] = grid_of_sizes_silicates
         ds.parameters['reg_grid_of_sizes_aromatic_fraction'] = grid_of_sizes_aromatic_fraction
 
-        #for empty cells, use the median size distribution
+        #for empty cells, use the median size distribution (for octrees
+        #with OCTREE_PRUNE set, most empty cells have already been
+        #collapsed in sph_m_gen, so there are few left to fill)
         for isize in range(nsizes):
                 wzero = np.where(grid_of_sizes[:,isize] == 0)[0]
                 wnonzero = np.where(grid_of_sizes[:,isize] != 0)[0]
@@ -184,7 +186,7 @@ def active_dust_add(ds,m,grid_of_sizes,nsizes,dustdens,specific_energy,refined=[
         for bin in range(nbins):
                 file = dust_filenames[bin]
                 
-                d = SphericalDust(file)
+                d = load_dust(file,sublimation=False)
                 
                 
                 m.add_density_grid(dustdens*frac_grid[:,bin],d,specific_energy=specific_energy)
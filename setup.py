@@ -26,7 +26,7 @@ setup(
         'scikit-learn',
         'p_tqdm'
     ],
-    scripts=["pd_front_end.py"],
+    scripts=["pd_front_end.py", "pd_ssp_library.py"],
     project_urls={
         'Source': 'https://github.com/dnarayanan/powderday.git',
     },
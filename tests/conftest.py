@@ -0,0 +1,33 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+#the tests import powderday from this checkout
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#nebular_emission.ASCIItools (imported by SED_gen) reads the cloudy
+#settings of cfg.par when it is imported, so it is imported once here
+#with nebular emission off.  the tests then set the parameters they
+#need with par
+import powderday.config as cfg
+cfg_par = cfg.par
+cfg.par = SimpleNamespace(add_neb_emission=False,use_cloudy_tables=True)
+try:
+    import powderday.nebular_emission.ASCIItools
+except ImportError:
+    #the tests that need it are skipped for their missing packages
+    pass
+finally:
+    cfg.par = cfg_par
+
+
+@pytest.fixture
+def par(monkeypatch):
+    #an empty cfg.par for the test to fill in with the parameters the
+    #code under test reads
+    import powderday.config as cfg
+    par = SimpleNamespace()
+    monkeypatch.setattr(cfg,'par',par)
+    return par
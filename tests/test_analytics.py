@@ -0,0 +1,62 @@
+import h5py
+import numpy as np
+import pytest
+
+for module in ['astropy','hyperion','yt','matplotlib']:
+    pytest.importorskip(module)
+
+from powderday.analytics import HDF5RecordWriter
+
+
+def test_rows_are_appended_in_order(tmp_path):
+    rng = np.random.default_rng(0)
+    writer = HDF5RecordWriter(str(tmp_path/'records.h5'),buffer_rows=7)
+    writer.set_static('nu',np.arange(5.))
+
+    rows = rng.random((50,5))
+    positions = rng.random((50,3))
+    #single rows and blocks of rows, across several flushes
+    writer.append(fnu=rows[0],positions=positions[0])
+    for start,stop in [(1,4),(4,20),(20,21),(21,50)]:
+        writer.append(fnu=rows[start:stop],positions=positions[start:stop])
+
+    nu,fnu,pos = writer.load('nu','fnu','positions')
+    assert np.array_equal(nu,np.arange(5.))
+    assert np.array_equal(fnu,rows)
+    assert np.array_equal(pos,positions)
+
+
+def test_rows_are_buffered(tmp_path):
+    outfile = str(tmp_path/'records.h5')
+    writer = HDF5RecordWriter(outfile,buffer_rows=10)
+    writer.append(emlines=np.ones((4,3)))
+    with h5py.File(outfile,'r') as f:
+        assert 'emlines' not in f
+
+    writer.append(emlines=np.ones((6,3)))
+    with h5py.File(outfile,'r') as f:
+        assert f['emlines'].shape == (10,3)
+
+
+@pytest.mark.parametrize('ncol',[1,3,6000,200000])
+def test_chunks_are_about_a_megabyte(tmp_path,ncol):
+    writer = HDF5RecordWriter(str(tmp_path/'records.h5'))
+    writer.append(fnu=np.zeros((2,ncol)))
+    writer.flush()
+    with h5py.File(writer.outfile,'r') as f:
+        chunks = f['fnu'].chunks
+    assert chunks[1] == ncol
+    assert chunks[0] >= 1
+    assert chunks[0] == 1 or chunks[0]*ncol*8 <= 2**20
+
+
+def test_new_writer_starts_an_empty_file(tmp_path):
+    outfile = str(tmp_path/'records.h5')
+    writer = HDF5RecordWriter(outfile)
+    writer.append(emlines=np.ones(3))
+    writer.flush()
+
+    writer = HDF5RecordWriter(outfile)
+    writer.flush()
+    with h5py.File(outfile,'r') as f:
+        assert len(f.keys()) == 0
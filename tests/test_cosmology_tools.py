@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+yt = pytest.importorskip('yt')
+
+from powderday.front_ends.cosmology_tools import CosmicTimeTable,cosmic_time_table
+
+
+def dataset(redshift):
+    return SimpleNamespace(hubble_constant=0.68,omega_matter=0.3,omega_lambda=0.7,current_redshift=redshift)
+
+
+def yt_cosmology(ds):
+    return yt.utilities.cosmology.Cosmology(hubble_constant=ds.hubble_constant,omega_matter=ds.omega_matter,
+                                            omega_lambda=ds.omega_lambda)
+
+
+@pytest.mark.parametrize('redshift',[0.,2.,6.])
+def test_ages_match_yt(redshift):
+    ds = dataset(redshift)
+    table = CosmicTimeTable(ds)
+    cosmology = yt_cosmology(ds)
+
+    rng = np.random.default_rng(0)
+    scalefactor = 10.**rng.uniform(-2.5,np.log10(1./(1.+redshift)),200)
+    expected = (cosmology.t_from_z(redshift)-cosmology.t_from_z(1./scalefactor-1.)).in_units('Gyr').value
+
+    #to within ~1 kyr
+    assert np.allclose(table.ages(scalefactor),expected,rtol=0.,atol=1.e-5)
+    assert np.all(table.ages(scalefactor) >= -1.e-6)
+    assert np.isclose(table.simtime,cosmology.t_from_z(redshift).in_units('Gyr').value)
+
+
+def test_table_is_built_once_per_dataset():
+    ds = dataset(1.)
+    table = cosmic_time_table(ds)
+    assert cosmic_time_table(ds) is table
+    assert cosmic_time_table(dataset(1.)) is not table
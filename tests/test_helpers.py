@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('astropy')
+pytest.importorskip('hyperion')
+
+from powderday.helpers import find_nearest,find_nearest_sorted
+
+
+@pytest.mark.parametrize('seed',range(10))
+def test_find_nearest_sorted(seed):
+    rng = np.random.default_rng(seed)
+    array = np.sort(rng.uniform(-5.,5.,rng.integers(1,50)))
+    values = np.concatenate([rng.uniform(-7.,7.,100),array,
+                             #midpoints, where the lower index wins
+                             (array[1:]+array[:-1])/2.])
+    expected = [find_nearest(array,value) for value in values]
+    assert np.array_equal(find_nearest_sorted(array,values),expected)
+
+
+def test_find_nearest_sorted_repeated_values():
+    array = np.array([0.,1.,1.,1.,2.,4.])
+    values = np.linspace(-1.,5.,61)
+    expected = [find_nearest(array,value) for value in values]
+    assert np.array_equal(find_nearest_sorted(array,values),expected)
+
+
+def test_find_nearest_sorted_single_element():
+    assert np.array_equal(find_nearest_sorted([3.],[-1.,3.,10.]),[0,0,0])
@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+from powderday.octree_cache import OctreeCache,snapshot_files,snapshot_signature
+
+
+class Dataset:
+    #stands in for a yt dataset whose octree has already been deposited
+    def __init__(self,fields=None):
+        self.fields = fields
+        self.filename = 'snapshot.hdf5'
+
+    def octree(self,left,right,n_ref):
+        if self.fields is None:
+            raise AssertionError('the octree should have come from the cache')
+        return self.fields
+
+
+@pytest.fixture
+def cache_dir(par,tmp_path):
+    par.OCTREE_CACHE = False
+    par.DEPOSITION_KERNEL = 'yt'
+    par.n_ref = 32
+    return str(tmp_path/'octree')
+
+
+def make_cache(directory,fields=None):
+    cache = OctreeCache(Dataset(fields),[0.,0.,0.],[1.,1.,1.])
+    cache.directory = directory
+    return cache
+
+
+def test_fields_are_cached(cache_dir):
+    fields = {('PartType0','density'):np.arange(9.),('index','x'):np.linspace(0.,1.,9)}
+    cache = make_cache(cache_dir,fields)
+    for field,value in fields.items():
+        assert np.array_equal(cache[field],value)
+
+    #a new run reads them without building the octree
+    cache = make_cache(cache_dir)
+    for field,value in fields.items():
+        assert np.array_equal(cache[field],value)
+
+
+def test_ordering_is_cached(cache_dir):
+    refined = np.array([True]+[False]*8)
+    order,traversal = make_cache(cache_dir).ordering(refined)
+    assert traversal is not None
+
+    cached_order,traversal = make_cache(cache_dir).ordering(refined)
+    assert traversal is None
+    assert np.array_equal(cached_order,order)
+
+    #another octree does not get the ordering of the cached one
+    refined = np.array([True,True]+[False]*15)
+    order,traversal = make_cache(cache_dir).ordering(refined)
+    assert traversal is not None
+    assert np.array_equal(order,traversal.order)
+
+
+def test_writes_leave_the_other_entries_alone(cache_dir):
+    cache = make_cache(cache_dir)
+    cache._write({('gas','density'):np.ones(3)})
+    entry = cache._entry(('gas','density'))
+    stat = os.stat(entry)
+
+    cache._write({('gas','metals'):np.zeros(3),'ordering':np.arange(3)})
+    assert os.stat(entry).st_ino == stat.st_ino
+    assert os.stat(entry).st_mtime_ns == stat.st_mtime_ns
+    assert sorted(os.listdir(cache_dir)) == sorted(os.path.basename(cache._entry(field))
+                                                   for field in [('gas','density'),('gas','metals'),'ordering'])
+
+
+def _write_fields(directory,worker):
+    cache = make_cache(directory)
+    for i in range(10):
+        cache._write({('gas','field_%d_%d' % (worker,i)):np.full(1000,worker)})
+
+
+def test_concurrent_writers(cache_dir):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_write_fields,args=(cache_dir,worker)) for worker in range(6)]
+    for process in processes: process.start()
+    for process in processes: process.join()
+
+    cache = make_cache(cache_dir)
+    for worker in range(6):
+        for i in range(10):
+            assert np.array_equal(cache._read(('gas','field_%d_%d' % (worker,i))),np.full(1000,worker))
+    #no temporary files are left behind
+    assert len(os.listdir(cache_dir)) == 60
+
+
+def test_corrupt_file_is_a_miss(cache_dir):
+    cache = make_cache(cache_dir)
+    os.makedirs(cache_dir)
+    with open(cache._entry(('gas','density')),'wb') as f:
+        f.write(b'not an hdf5 file')
+    assert cache._read(('gas','density')) is None
+
+    cache._write({('gas','density'):np.ones(3)})
+    assert np.array_equal(make_cache(cache_dir)._read(('gas','density')),np.ones(3))
+
+
+def test_snapshot_signature(tmp_path):
+    template = str(tmp_path/'snap_010.%(num)s.hdf5')
+    for i in range(3):
+        with open(template % {'num':i},'w') as f:
+            f.write('x'*(i+1))
+
+    class MultiFileDataset:
+        filename = template % {'num':0}
+        filename_template = template
+        file_count = 3
+
+    ds = MultiFileDataset()
+    assert snapshot_files(ds) == [template % {'num':i} for i in range(3)]
+    signature = snapshot_signature(ds)
+
+    #a rewritten sibling file changes the signature
+    with open(template % {'num':2},'w') as f:
+        f.write('y'*10)
+    assert snapshot_signature(ds) != signature
+
+    single = Dataset()
+    single.filename = template % {'num':1}
+    assert snapshot_files(single) == [single.filename]
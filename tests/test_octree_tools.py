@@ -0,0 +1,208 @@
+import numpy as np
+import pytest
+
+from powderday.octree_tools import (OctreeTraversal,XFIRST,octree_error,octree_cell_geometry,
+                                    collapse_octree_cells,split_octree_cells,prune_octree)
+from powderday.find_order import find_order
+
+
+def random_octree(rng,max_depth,p=0.5,depth=0):
+    #a random depth-first refined array
+    if depth < max_depth and rng.random() < p:
+        refined = [True]
+        for _ in range(8):
+            refined += random_octree(rng,max_depth,p,depth+1)
+        return refined
+    return [False]
+
+
+def random_octrees(n,seed=0):
+    rng = np.random.default_rng(seed)
+    return [np.array(random_octree(rng,int(rng.integers(0,6)),p=0.9)) for _ in range(n)]
+
+
+def recursive_find_order(refined):
+    #find_order as it was before OctreeTraversal: a recursive walk
+    if not refined[0]:
+        return [0]
+
+    def find_nested(i):
+        cells = [i]
+        for cell in range(8):
+            i += 1
+            if i >= len(refined):
+                return i,np.hstack(cells)
+            if refined[i]:
+                i,sub_cells = find_nested(i)
+                cells.append(sub_cells)
+            else:
+                cells.append(i)
+        cells = [cells[j] for j in [0,1,5,3,7,2,6,4,8]]
+        return i,np.hstack(cells)
+
+    return find_nested(0)[1]
+
+
+def recursive_walk(refined):
+    #depth, parent, index among its siblings and end of the subtree of
+    #every cell; None if refined is not a single consistent octree
+    n = len(refined)
+    depth = np.zeros(n,dtype=int)
+    parent = np.full(n,-1)
+    child_index = np.zeros(n,dtype=int)
+    end = np.zeros(n,dtype=int)
+
+    def walk(i,d):
+        if i >= n:
+            raise IndexError
+        depth[i] = d
+        j = i+1
+        if refined[i]:
+            for k in range(8):
+                if j < n:
+                    parent[j],child_index[j] = i,k
+                j = walk(j,d+1)
+        end[i] = j
+        return j
+
+    try:
+        if walk(0,0) != n:
+            return None
+    except IndexError:
+        return None
+    return depth,parent,child_index,end
+
+
+@pytest.mark.parametrize('refined',random_octrees(200))
+def test_traversal_matches_recursive_walk(refined):
+    depth,parent,child_index,end = recursive_walk(refined)
+    traversal = OctreeTraversal(refined)
+
+    assert np.array_equal(traversal.subtree_end,end)
+    assert np.array_equal(traversal.subtree_size,end-np.arange(len(refined)))
+    assert np.array_equal(traversal.depth,depth)
+    assert np.array_equal(traversal.parent,parent)
+    assert np.array_equal(traversal.child_index,child_index)
+    assert traversal.max_level == np.max(depth[~refined])
+    assert np.array_equal(traversal.leaves_per_level,np.bincount(depth[~refined]))
+    assert traversal.n_leaves == np.sum(~refined)
+
+
+@pytest.mark.parametrize('refined',random_octrees(200,seed=1))
+def test_find_order_matches_recursive(refined):
+    order = find_order(refined)
+    assert np.array_equal(order,recursive_find_order(refined))
+    assert np.array_equal(OctreeTraversal(refined).position[order],np.arange(len(refined)))
+
+
+def test_find_order_deep_octree():
+    #deeper than the recursion limit of the recursive walk
+    refined = np.zeros(8*5000+1,dtype=bool)
+    refined[np.arange(5000)*8] = True
+    order = find_order(refined)
+    assert np.array_equal(np.sort(order),np.arange(len(refined)))
+    assert OctreeTraversal(refined).max_level == 5000
+
+
+def test_octree_error():
+    rng = np.random.default_rng(2)
+    for _ in range(2000):
+        refined = rng.random(int(rng.integers(1,60))) < 0.2
+        consistent = recursive_walk(refined) is not None
+        assert (octree_error(refined) is None) == consistent
+        if not consistent:
+            with pytest.raises(ValueError):
+                OctreeTraversal(refined)
+
+
+def yt_geometry(refined_yt,root_width):
+    #cell centres and widths of a yt-ordered octree, walked
+    #recursively: yt deposits the children z-first
+    centers = np.zeros([len(refined_yt),3])
+    widths = np.zeros([len(refined_yt),3])
+
+    def walk(i,center,width):
+        centers[i],widths[i] = center,width
+        j = i+1
+        if refined_yt[i]:
+            for k in range(8):
+                sign = np.array([(k>>2)&1,(k>>1)&1,k&1])*2-1
+                j = walk(j,center+sign*width/4.,width/2.)
+        return j
+
+    walk(0,np.zeros(3),np.asarray(root_width,dtype=float))
+    return centers,widths
+
+
+@pytest.mark.parametrize('refined_yt',random_octrees(50,seed=3))
+def test_cell_geometry_matches_yt_order(refined_yt):
+    root_width = np.array([2.,3.,5.])
+    expected_center,expected_width = yt_geometry(refined_yt,root_width)
+
+    refined = refined_yt[find_order(refined_yt)]
+    center,width = octree_cell_geometry(refined,root_width)
+    yt_order = find_order(refined)
+    assert np.allclose(center[yt_order],expected_center)
+    assert np.allclose(width[yt_order],expected_width)
+
+
+def test_xfirst_is_the_bit_reversal():
+    assert np.array_equal(XFIRST[XFIRST],np.arange(8))
+    for k in range(8):
+        assert XFIRST[k] == int('{:03b}'.format(k)[::-1],2)
+
+
+def test_split_then_collapse():
+    rng = np.random.default_rng(4)
+    for refined in random_octrees(30,seed=4):
+        values = rng.random(len(refined))
+        values[refined] = 0.
+        leaves = np.flatnonzero(~refined)
+        idx = np.sort(rng.choice(leaves,size=max(1,len(leaves)//3),replace=False))
+        child_values = np.repeat(values[idx,np.newaxis],8,axis=1)
+
+        split_refined,split_values = split_octree_cells(refined,values,idx,child_values)
+        assert octree_error(split_refined) is None
+        assert len(split_refined) == len(refined)+8*len(idx)
+
+        #every split cell has moved up by the children of the cells
+        #split before it
+        split = idx+8*np.arange(len(idx))
+        assert np.all(split_refined[split])
+        assert np.allclose(split_values[split[:,np.newaxis]+1+np.arange(8)],child_values)
+
+        new_refined,new_values = collapse_octree_cells(split_refined,split_values,split)
+        assert np.array_equal(new_refined,refined)
+        assert np.allclose(new_values,values)
+
+
+def mass(refined,values):
+    return np.sum((values*8.**(-OctreeTraversal(refined).depth))[~refined])
+
+
+@pytest.mark.parametrize('tolerance',[0.,0.01,0.1])
+def test_prune_octree(tolerance):
+    rng = np.random.default_rng(5)
+    for refined in random_octrees(30,seed=5):
+        values = np.where(rng.random(len(refined)) < 0.3,rng.random(len(refined)),0.)
+        values[refined] = 0.
+        cell_values = np.column_stack([values,2*values])
+
+        pruned,pruned_values,pruned_cells = prune_octree(refined,values,tolerance,cell_values)
+
+        assert octree_error(pruned) is None
+        assert len(pruned) <= len(refined)
+        assert np.isclose(mass(pruned,pruned_values),mass(refined,values))
+        assert np.allclose(pruned_cells[:,0],pruned_values)
+        assert np.allclose(pruned_cells[:,1],2*pruned_values)
+
+        #no family of empty leaves is left
+        traversal = OctreeTraversal(pruned)
+        family = np.flatnonzero(pruned & (traversal.subtree_size == 9))
+        children = family[:,np.newaxis]+1+np.arange(8)
+        assert np.all(np.sum(pruned_values[children],axis=1) > 0)
+
+        if tolerance == 0.:
+            #the non-empty leaves are untouched
+            assert np.array_equal(np.sort(pruned_values[~pruned][pruned_values[~pruned] > 0]),
+                                  np.sort(values[~refined][values[~refined] > 0]))
@@ -0,0 +1,93 @@
+import gc
+import sys
+import types
+
+import h5py
+import numpy as np
+import pytest
+
+for module in ['astropy','hyperion','yt','p_tqdm','matplotlib']:
+    pytest.importorskip(module)
+
+
+class StellarPopulation:
+    #stands in for fsps.StellarPopulation
+    libraries = (b'mist',b'miles',b'DL07')
+    solar_metallicity = 0.0142
+    zlegend = np.logspace(-3,-1.5,5)
+
+
+class StopRun(Exception):
+    pass
+
+
+@pytest.fixture
+def fresh_powderday(monkeypatch):
+    #powderday (and pd_front_end) are imported anew by the test, with
+    #a stand-in for fsps, and the modules of the other tests are put
+    #back afterwards (the parameter files of the test are dropped)
+    for name in list(sys.modules):
+        if name in ['powderday','pd_front_end'] or name.startswith('powderday.'):
+            monkeypatch.delitem(sys.modules,name)
+    fsps = types.ModuleType('fsps')
+    fsps.StellarPopulation = StellarPopulation
+    monkeypatch.setitem(sys.modules,'fsps',fsps)
+    monkeypatch.setattr(sys,'path',list(sys.path))
+    threshold = gc.get_threshold()
+    yield
+    gc.set_threshold(*threshold)
+    for name in list(sys.modules):
+        if name.startswith('batch_parameters'):
+            del sys.modules[name]
+
+
+def write_parameter_files(tmp_path,nmodels):
+    with h5py.File(str(tmp_path/'dust.hdf5'),'w') as f:
+        f.create_group('optical_properties').create_dataset('nu',data=np.logspace(10,16,50))
+
+    with open(str(tmp_path/'batch_parameters_master.py'),'w') as f:
+        f.write("from parameters_master import *\n"
+                "dustdir = %r\n"
+                "dustfile = 'dust.hdf5'\n"
+                "n_processes = 1\n" % (str(tmp_path)+'/'))
+
+    modelfiles = []
+    for i in range(nmodels):
+        open(str(tmp_path/('snapshot_%d.hdf5' % i)),'w').close()
+        modelfiles.append('batch_parameters_model_%d' % i)
+        with open(str(tmp_path/(modelfiles[-1]+'.py')),'w') as f:
+            f.write("from parameters_model import *\n"
+                    "hydro_dir = %r\n"
+                    "snapshot_name = 'snapshot_%d.hdf5'\n"
+                    "PD_output_dir = %r\n" % (str(tmp_path)+'/',i,str(tmp_path)+'/'))
+    return modelfiles
+
+
+@pytest.mark.parametrize('batch',[False,True])
+def test_main_reaches_the_first_snapshot(fresh_powderday,tmp_path,monkeypatch,batch):
+    #everything up to reading the snapshot runs: parsing the command
+    #line, reading and checking the parameter files of every model,
+    #setting up fsps and the dust, and importing the powderday modules
+    #(e.g. the nebular emission ones, which once read the parameter
+    #files from the command line)
+    modelfiles = write_parameter_files(tmp_path,2 if batch else 1)
+    argv = ['pd_front_end.py',str(tmp_path),'batch_parameters_master']
+    argv += ['--batch']+modelfiles if batch else modelfiles
+    monkeypatch.setattr(sys,'argv',argv)
+
+    import pd_front_end
+    import powderday.config as cfg
+    from powderday.front_ends import front_end_controller
+
+    streamed = []
+    def stream(fname):
+        streamed.append((fname,cfg.model.__name__))
+        raise StopRun
+    monkeypatch.setattr(front_end_controller,'stream',stream)
+
+    with pytest.raises(StopRun):
+        pd_front_end.main()
+
+    assert streamed == [(str(tmp_path/'snapshot_0.hdf5'),modelfiles[0])]
+    assert cfg.par.__name__ == 'batch_parameters_master'
+    assert cfg.par.solar == StellarPopulation.solar_metallicity
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+for module in ['astropy','hyperion','yt','p_tqdm']:
+    pytest.importorskip(module)
+
+from powderday import SED_gen
+from powderday.SED_gen import cluster_decomposition,cluster_spectrum
+
+
+@pytest.fixture
+def cluster_par(par,monkeypatch):
+    par.use_cmdf = True
+    par.cmdf_min_mass,par.cmdf_max_mass = 3.5,5.
+    par.cmdf_bins,par.cmdf_beta = 6,-2.
+    par.use_age_distribution = True
+    par.age_dist_min,par.age_dist_max = 3.e-3,1.e-2
+    par.HII_max_age = 1.e-2
+    par.cmdf_memo_logm_res,par.cmdf_memo_age_res = 0.01,1.e-4
+    par.alpha_enhance = par.CF_on = False
+    monkeypatch.setattr(SED_gen,'_cluster_decompositions',{})
+    monkeypatch.setattr(SED_gen,'_cluster_spectra',{})
+    return par
+
+
+@pytest.fixture
+def spectrum_calls(monkeypatch):
+    #the ages the cluster spectra are computed at
+    calls = []
+
+    def stellar_spectrum(age,fsps_zmet):
+        calls.append(age)
+        return np.arange(3.),np.full(3,age),1.,None
+
+    monkeypatch.setattr(SED_gen,'stellar_spectrum',stellar_spectrum)
+    return calls
+
+
+def total_mass(cluster_mass,num_clusters):
+    return np.sum(num_clusters*10**cluster_mass)
+
+
+def test_decomposition_conserves_mass(cluster_par):
+    for star_mass in [10**5.5,10**6.003,3.7e6]:
+        for star_age in [2.e-3,5.02e-3,9.99e-3,0.5]:
+            cluster_mass,num_clusters,age,spectrum_age = cluster_decomposition(star_mass,star_age)
+            assert np.isclose(total_mass(cluster_mass,num_clusters),star_mass)
+            assert np.all(np.abs(spectrum_age-age) <= cluster_par.cmdf_memo_age_res/2.)
+
+
+@pytest.mark.parametrize('use_age_distribution',[True,False])
+def test_particles_of_a_bin_share_the_cluster_spectra(cluster_par,spectrum_calls,use_age_distribution):
+    cluster_par.use_age_distribution = use_age_distribution
+    star = SimpleNamespace(fsps_zmet=3,all_metals=[-1]*11)
+
+    #the same mass and age bin
+    first = cluster_decomposition(10**6.001,5.02e-3)
+    second = cluster_decomposition(10**6.003,5.04e-3)
+    assert len(SED_gen._cluster_decompositions) == 1
+    assert np.isclose(total_mass(*first[:2]),10**6.001)
+    assert np.isclose(total_mass(*second[:2]),10**6.003)
+    assert not np.array_equal(first[2],second[2])
+
+    spectra = [cluster_spectrum(star,age,None) for age in first[3]]
+    ncalls = len(spectrum_calls)
+    assert ncalls == len(np.unique(first[3]))
+
+    for age,spectrum in zip(second[3],spectra):
+        assert cluster_spectrum(star,age,None) is spectrum
+    assert len(spectrum_calls) == ncalls
+
+
+def test_exact_ages_without_memoization(cluster_par,spectrum_calls):
+    cluster_par.cmdf_memo_logm_res = cluster_par.cmdf_memo_age_res = 0.
+    first = cluster_decomposition(10**6.001,5.02e-3)
+    second = cluster_decomposition(10**6.003,5.04e-3)
+    assert np.array_equal(first[2],first[3])
+    assert np.array_equal(second[2],second[3])
+    assert np.isclose(total_mass(*first[:2]),10**6.001)
+
+
+def test_pool_is_restarted_for_a_new_model(par,monkeypatch):
+    class Pool:
+        def __init__(self,processes,initializer):
+            self.closed = False
+        def close(self):
+            self.closed = True
+        def join(self):
+            pass
+
+    par.n_processes = 2
+    monkeypatch.setattr(SED_gen,'Pool',Pool)
+    monkeypatch.setattr(SED_gen,'_pool',None)
+    monkeypatch.setattr(SED_gen.cfg,'model',SimpleNamespace(),raising=False)
+
+    #the pool is kept for the same model
+    first = SED_gen.get_pool()
+    assert SED_gen.get_pool() is first
+
+    #and forked anew (with the new settings) for the next one
+    monkeypatch.setattr(SED_gen.cfg,'model',SimpleNamespace())
+    second = SED_gen.get_pool()
+    assert second is not first and first.closed
+    assert SED_gen.get_pool() is second
+
+    SED_gen.close_pool()
+    assert second.closed and SED_gen._pool is None
@@ -0,0 +1,264 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+for module in ['astropy','hyperion','yt','p_tqdm','matplotlib']:
+    pytest.importorskip(module)
+
+import astropy.units as units
+import astropy.constants as constants
+
+from powderday import SED_gen
+from powderday.SED_gen import StarCatalog
+from powderday.helpers import find_nearest,trapz
+from powderday.source_creation import (fixed_sed_bins,adaptive_sed_bins,sed_mass_bins,
+                                       WavelengthCompressor,wavelength_compress,direct_add_stars)
+from powderday.ssp_grid import SSPGrid,mass_dependent_sps
+
+
+def random_catalog(seed,nstars=500,nz=5):
+    rng = np.random.default_rng(seed)
+    age = 10.**rng.uniform(-3.,1.,nstars)
+    mass = 10.**rng.uniform(4.,6.,nstars)*1.989e33
+    return StarCatalog(mass,rng.random(nstars),rng.random((nstars,3)),age,fsps_zmet=rng.integers(1,nz+1,nstars))
+
+
+@pytest.fixture
+def binning_par(par):
+    par.FORCE_BINNED = True
+    par.max_age_direct = 1.e-2
+    par.N_STELLAR_AGE_BINS = 20
+    par.N_MASS_BINS = 4
+    return par
+
+
+@pytest.mark.parametrize('seed',range(5))
+def test_fixed_bins_match_nearest_bins(binning_par,seed):
+    stars_list = random_catalog(seed)
+    sp = SimpleNamespace(zlegend=np.logspace(-3,-1.5,5))
+    binned_idx = np.arange(len(stars_list))
+    star_bin,bin_zmet,bin_age,bin_mass = fixed_sed_bins(stars_list,binned_idx,sp)
+
+    #the bins of the original per-star loop
+    minimum_age,maximum_age = np.min(stars_list.age),np.max(stars_list.age)
+    age_bins = 10.**np.linspace(np.log10(minimum_age),np.log10(maximum_age),binning_par.N_STELLAR_AGE_BINS)
+    age_bins = np.append(age_bins,age_bins[-1]+(maximum_age-minimum_age)/binning_par.N_STELLAR_AGE_BINS)
+    mass_bins = sed_mass_bins(stars_list.mass)
+    metal_bins = np.arange(len(sp.zlegend))+1
+    for i in binned_idx:
+        assert bin_zmet[star_bin[i]] == metal_bins[find_nearest(metal_bins,stars_list.fsps_zmet[i])]
+        assert bin_age[star_bin[i]] == age_bins[find_nearest(age_bins,stars_list.age[i])]
+        assert bin_mass[star_bin[i]] == mass_bins[find_nearest(mass_bins,stars_list.mass[i])]
+
+    #every bin is occupied, and they come in metal, age, mass order
+    assert np.array_equal(np.unique(star_bin),np.arange(len(bin_zmet)))
+    order = np.lexsort((bin_mass,bin_age,bin_zmet))
+    assert np.array_equal(order,np.arange(len(bin_zmet)))
+
+
+def test_unbinned_young_stars(binning_par):
+    binning_par.FORCE_BINNED = False
+    stars_list = random_catalog(0)
+    sp = SimpleNamespace(zlegend=np.logspace(-3,-1.5,5))
+    binned_idx = np.where(stars_list.age > binning_par.max_age_direct)[0]
+    star_bin,bin_zmet,bin_age,bin_mass = fixed_sed_bins(stars_list,binned_idx,sp)
+    assert len(star_bin) == len(binned_idx)
+    assert np.min(bin_age) > binning_par.max_age_direct
+
+
+def test_single_age_is_not_binned(binning_par):
+    stars_list = random_catalog(0)
+    stars_list.age[:] = 1.
+    sp = SimpleNamespace(zlegend=np.logspace(-3,-1.5,5))
+    assert fixed_sed_bins(stars_list,np.arange(len(stars_list)),sp) is None
+
+
+def smooth_ssp_grid(nz=5):
+    #spectra that redden and fade smoothly with age
+    log_age = np.linspace(5.5,10.2,60)
+    wav = np.logspace(2.,5.,200)
+    spectra = np.exp(-wav[np.newaxis,np.newaxis,:]*(log_age[np.newaxis,:,np.newaxis]-5.)/2.e3)
+    spectra = spectra*(1.+0.1*np.arange(nz))[:,np.newaxis,np.newaxis]
+    stellar_mass = np.tile(1.-0.05*(log_age-5.5),(nz,1))
+    return SSPGrid(wav,log_age,np.logspace(-3,-1.5,nz),spectra,stellar_mass)
+
+
+@pytest.fixture
+def adaptive_par(binning_par):
+    binning_par.add_neb_emission = binning_par.use_cmdf = False
+    binning_par.use_cloudy_tables = False
+    binning_par.add_pagb_stars = binning_par.add_young_stars = False
+    binning_par.HII_min_age,binning_par.HII_max_age = 0.,1.e-2
+    binning_par.PAGB_min_age,binning_par.PAGB_max_age = 0.1,10.
+    return binning_par
+
+
+def check_bins(stars_list,binned_idx,star_bin,bin_zmet,bin_age,bin_mass):
+    #every bin is occupied, has a single metallicity, the mass weighted
+    #mean log age of its stars and (for merged bins) their mean mass
+    nbins = len(bin_zmet)
+    assert np.array_equal(np.unique(star_bin),np.arange(nbins))
+    zmet = stars_list.fsps_zmet[binned_idx]
+    mass = stars_list.mass[binned_idx]
+    log_age = np.log10(stars_list.age[binned_idx]*1.e9)
+    for k in range(nbins):
+        members = star_bin == k
+        assert np.all(zmet[members] == bin_zmet[k])
+        assert np.isclose(np.log10(bin_age[k]*1.e9),np.average(log_age[members],weights=mass[members]))
+
+
+@pytest.mark.parametrize('seed',range(3))
+def test_adaptive_bins(adaptive_par,seed):
+    stars_list = random_catalog(seed,nstars=2000)
+    binned_idx = np.arange(len(stars_list))
+    grid = smooth_ssp_grid()
+
+    nbins = []
+    for tolerance in [0.,0.01,0.1,10.]:
+        adaptive_par.ADAPTIVE_BINNING_TOLERANCE = tolerance
+        star_bin,bin_zmet,bin_age,bin_mass = adaptive_sed_bins(stars_list,binned_idx,grid)
+        check_bins(stars_list,binned_idx,star_bin,bin_zmet,bin_age,bin_mass)
+        assert np.allclose(np.bincount(star_bin,weights=stars_list.mass)/np.bincount(star_bin),bin_mass)
+        nbins.append(len(bin_zmet))
+
+    #a looser tolerance never needs more bins, and with no limit on the
+    #error every metallicity is a single bin
+    assert np.all(np.diff(nbins) <= 0)
+    assert nbins[-1] == len(np.unique(stars_list.fsps_zmet))
+    assert nbins[0] > nbins[1]
+
+
+def test_adaptive_bins_keep_nebular_stars_apart(adaptive_par):
+    adaptive_par.ADAPTIVE_BINNING_TOLERANCE = 10.
+    adaptive_par.add_neb_emission = adaptive_par.add_young_stars = True
+    stars_list = random_catalog(0,nstars=2000)
+    binned_idx = np.arange(len(stars_list))
+    star_bin,bin_zmet,bin_age,bin_mass = adaptive_sed_bins(stars_list,binned_idx,smooth_ssp_grid())
+    check_bins(stars_list,binned_idx,star_bin,bin_zmet,bin_age,bin_mass)
+
+    individual = mass_dependent_sps(stars_list.age)
+    assert np.any(individual) and not np.all(individual)
+    for k in range(len(bin_zmet)):
+        members = star_bin == k
+        assert np.all(individual[members]) or not np.any(individual[members])
+        if np.all(individual[members]):
+            #binned in mass as well, on the mass bins of fixed_sed_bins
+            mass_bins = sed_mass_bins(stars_list.mass)
+            assert bin_mass[k] in mass_bins
+            assert np.all(mass_bins[[find_nearest(mass_bins,mass) for mass in stars_list.mass[members]]] == bin_mass[k])
+
+
+def test_mass_dependent_sps(par):
+    par.add_neb_emission,par.use_cloudy_tables,par.use_cmdf = True,True,False
+    par.add_pagb_stars,par.add_young_stars = False,True
+    par.HII_min_age,par.HII_max_age = 0.,5.e-3
+    par.PAGB_min_age,par.PAGB_max_age = 0.1,10.
+
+    age = np.array([1.e-3,8.e-3,1.e-2,0.5])
+    assert np.array_equal(mass_dependent_sps(age),[True,True,True,False])
+
+    par.use_cloudy_tables = False
+    assert np.array_equal(mass_dependent_sps(age),[True,False,False,False])
+
+    par.add_pagb_stars = True
+    assert np.array_equal(mass_dependent_sps(age),[True,False,False,True])
+
+
+def reference_wavelength_compress(nu,fnu,df_nu):
+    #the original per-SED implementation
+    nu_inrange = np.logical_and(nu >= min(df_nu),nu <= max(df_nu))
+    nu_inrange = np.where(nu_inrange == True)[0]
+
+    compressed_nu = nu[nu_inrange]
+    compressed_fnu = np.asarray(fnu)[nu_inrange]
+
+    dum_nu = compressed_nu*units.Hz
+    dum_lam = constants.c.cgs/dum_nu
+    dum_lam = dum_lam.to(units.angstrom)
+
+    wll = np.where(dum_lam.value >= 912)[0]
+    return compressed_nu[wll],compressed_fnu[wll]
+
+
+@pytest.fixture
+def grids():
+    rng = np.random.default_rng(0)
+    c = constants.c.cgs.value
+    #100 angstrom to 1 mm, straddling the lyman limit, in decreasing
+    #frequency like the fsps grids
+    nu = c/(np.logspace(2,7,300)*1.e-8)
+    df_nu = c/(np.logspace(2.5,6,80)*1.e-8)
+    fnu = rng.random((5,len(nu)))
+    return nu,df_nu,fnu
+
+
+def test_wavelength_compress(grids):
+    nu,df_nu,fnu = grids
+    for sed in fnu:
+        compressed = wavelength_compress(nu,sed,df_nu)
+        expected = reference_wavelength_compress(nu,sed,df_nu)
+        assert np.array_equal(compressed[0],expected[0])
+        assert np.array_equal(compressed[1],expected[1])
+
+
+def test_compressor_on_many_seds(grids):
+    nu,df_nu,fnu = grids
+    compressor = WavelengthCompressor(nu,df_nu)
+    expected = np.array([reference_wavelength_compress(nu,sed,df_nu)[1] for sed in fnu])
+    assert np.array_equal(compressor.nu,reference_wavelength_compress(nu,fnu[0],df_nu)[0])
+    assert np.array_equal(compressor(fnu),expected)
+    assert np.all(constants.c.cgs.value/compressor.nu*1.e8 >= 912)
+
+
+class Model:
+    #stands in for the hyperion model the stars are added to
+    def __init__(self):
+        self.sources = []
+
+    def add_point_source_collection(self):
+        self.sources.append(SimpleNamespace())
+        return self.sources[-1]
+
+    def set_sample_sources_evenly(self,value):
+        pass
+
+
+def test_unbinned_stars_are_grouped_on_the_isochrone_ages(adaptive_par,grids,monkeypatch):
+    adaptive_par.max_age_direct = 1.e-2
+    adaptive_par.CF_on = adaptive_par.alpha_enhance = False
+    adaptive_par.dump_emlines = False
+    nu,df_nu,_ = grids
+    rng = np.random.default_rng(0)
+    nstars = 500
+    age = 10.**rng.uniform(-3.,-2.,nstars)
+    stars_list = StarCatalog(rng.uniform(1.,2.,nstars)*1.e38,rng.random(nstars),rng.random((nstars,3)),age,
+                             fsps_zmet=rng.integers(1,4,nstars))
+    sp = SimpleNamespace(log_age=np.linspace(5.5,10.2,60),zlegend=np.logspace(-3,-1.5,5))
+
+    #spectra that change continuously with age
+    lam = constants.c.cgs.value/nu*1.e8
+    stellar_fnu = np.exp(-lam[np.newaxis,:]/(1.e3*(1.+100.*age[:,np.newaxis])))*stars_list.fsps_zmet[:,np.newaxis]
+    mfrac = rng.uniform(0.8,0.9,nstars)
+    monkeypatch.setattr(SED_gen,'allstars_sed_gen',lambda *args: (nu,stellar_fnu,None,None,mfrac,None))
+
+    m = direct_add_stars(df_nu,stars_list,None,None,True,Model(),sp)
+
+    #one collection per metallicity and nearest isochrone age, rather
+    #than one per star
+    node = [find_nearest(sp.log_age,log_age) for log_age in np.log10(age*1.e9)]
+    ngroups = len(set(zip(node,stars_list.fsps_zmet)))
+    assert len(m.sources) == ngroups < nstars/10
+
+    #with the luminosity of every star, and the summed spectrum of the
+    #members of a collection
+    compressor = WavelengthCompressor(nu,df_nu)
+    compressed_fnu = compressor(stellar_fnu)[:,::-1]
+    lums = np.abs(trapz(compressed_fnu,x=compressor.nu[::-1],axis=1))*stars_list.mass/constants.M_sun.cgs.value/mfrac
+    lums *= constants.L_sun.cgs.value
+    assert np.isclose(np.sum([np.sum(source.luminosity) for source in m.sources]),np.sum(lums))
+    for source in m.sources:
+        members = [np.flatnonzero(np.all(stars_list.positions == position,axis=1))[0] for position in source.position]
+        assert np.allclose(source.luminosity,lums[members])
+        expected = np.sum(compressed_fnu[members]*(stars_list.mass/mfrac)[members,np.newaxis],axis=0)
+        assert np.allclose(source.spectrum[1],expected)
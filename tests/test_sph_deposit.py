@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from powderday.sph_deposit import cubic_spline_kernel,deposit,point_blocks,SPHSampler
+
+
+def brute_force_deposit(points,positions,hsml,values):
+    r = np.sqrt(np.sum((points[:,np.newaxis,:]-positions[np.newaxis,:,:])**2,axis=2))
+    return cubic_spline_kernel(r,hsml[np.newaxis,:]) @ values
+
+
+@pytest.fixture
+def particles():
+    rng = np.random.default_rng(0)
+    points = rng.random((2000,3))
+    #(some of the particles are outside of the points, but reach them)
+    positions = rng.random((1500,3))*1.2-0.1
+    hsml = rng.uniform(0.02,0.2,1500)
+    values = rng.random((1500,3))
+    return points,positions,hsml,values
+
+
+def test_kernel_normalization():
+    #4 pi int_0^h W(r) r^2 dr = 1
+    h = 0.7
+    r = np.linspace(0.,h,200001)
+    integrand = 4.*np.pi*r**2*cubic_spline_kernel(r,h)
+    assert np.isclose(np.sum((integrand[1:]+integrand[:-1])/2.*np.diff(r)),1.,rtol=1.e-6)
+    assert np.all(cubic_spline_kernel(np.array([h,1.5*h]),h) == 0.)
+
+
+@pytest.mark.parametrize('n_processes',[1,2,3])
+def test_deposit_matches_brute_force(particles,n_processes):
+    points,positions,hsml,values = particles
+    expected = brute_force_deposit(points,positions,hsml,values)
+
+    assert np.allclose(deposit(points,positions,hsml,values,n_processes),expected)
+    assert np.allclose(deposit(points,positions,hsml,values[:,0],n_processes),expected[:,0])
+
+
+def test_deposit_chunks(particles,monkeypatch):
+    import powderday.sph_deposit as sph_deposit
+    points,positions,hsml,values = particles
+    monkeypatch.setattr(sph_deposit,'DEPOSIT_CHUNK_SIZE',37)
+    assert np.allclose(deposit(points,positions,hsml,values,2),brute_force_deposit(points,positions,hsml,values))
+
+
+def test_deposit_without_overlap():
+    points = np.zeros((5,3))
+    result = deposit(points,np.full((4,3),10.),np.ones(4),np.ones((4,2)),2)
+    assert result.shape == (5,2) and np.all(result == 0.)
+    assert deposit(np.zeros((0,3)),np.ones((4,3)),np.ones(4),np.ones(4)).shape == (0,)
+
+
+def test_point_blocks():
+    points = np.random.default_rng(1).random((1001,3))
+    blocks = point_blocks(points,13)
+    assert len(blocks) == 13
+    assert np.array_equal(np.sort(np.concatenate(blocks)),np.arange(len(points)))
+    sizes = [len(block) for block in blocks]
+    assert max(sizes) <= 2*min(sizes)+1
+
+
+def test_sampler_density(particles):
+    points,positions,hsml,values = particles
+    masses = values[:,0]
+    sampler = SPHSampler(positions,masses,hsml,n_processes=2)
+    assert np.allclose(sampler.density(points),brute_force_deposit(points,positions,hsml,masses))
+    assert np.allclose(sampler.density(points,weights=values[:,1]),
+                       brute_force_deposit(points,positions,hsml,masses*values[:,1]))
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+
+from powderday import ssp_cache
+
+
+class Params(dict):
+    @property
+    def all_params(self):
+        return list(self.keys())
+
+
+class StellarPopulation:
+    #stands in for fsps.StellarPopulation, and counts the spectra it
+    #computes
+    def __init__(self):
+        self.params = Params(add_neb_emission=False,imf_type=2,dust1=0.)
+        self.libraries = (b'mist',b'miles',b'DL07')
+        self.ncalls = 0
+
+    def get_spectrum(self,tage=0,zmet=None):
+        self.ncalls += 1
+        self.stellar_mass = 0.5+0.01*tage
+        self.emline_luminosity = np.arange(3.)*(1.+tage)
+        wav = np.linspace(100.,1.e4,50)
+        return wav,np.exp(-wav/1.e3)*(1.+tage+zmet)
+
+
+@pytest.fixture
+def cache_par(par,tmp_path):
+    par.SSP_CACHE = True
+    par.SSP_CACHE_DIR = str(tmp_path)
+    return par
+
+
+def cache_entry(sp,tage,zmet):
+    key = ssp_cache.ssp_cache_key(sp,tage,zmet)
+    return os.path.join(ssp_cache.ssp_cache_dir(),key[0:2],key+'.npz')
+
+
+def assert_same_spectrum(a,b):
+    for x,y in zip(a,b):
+        if x is None or y is None:
+            assert x is None and y is None
+        else:
+            assert np.array_equal(x,y)
+
+
+def test_spectra_are_cached(cache_par):
+    sp = StellarPopulation()
+    spectrum = ssp_cache.get_spectrum(sp,tage=0.1,zmet=3)
+    assert spectrum[3] is None
+    assert_same_spectrum(ssp_cache.get_spectrum(sp,tage=0.1,zmet=3),spectrum)
+    assert sp.ncalls == 1
+
+    #a fresh stellar population with the same parameters hits the cache
+    other = StellarPopulation()
+    assert_same_spectrum(ssp_cache.get_spectrum(other,tage=0.1,zmet=3),spectrum)
+    assert other.ncalls == 0
+
+
+def test_emission_lines_are_cached(cache_par):
+    sp = StellarPopulation()
+    sp.params['add_neb_emission'] = True
+    spectrum = ssp_cache.get_spectrum(sp,tage=0.002,zmet=5)
+    assert np.array_equal(spectrum[3],sp.emline_luminosity)
+    assert_same_spectrum(ssp_cache.get_spectrum(sp,tage=0.002,zmet=5),spectrum)
+    assert sp.ncalls == 1
+
+
+def test_key_covers_the_stellar_population(cache_par):
+    sp = StellarPopulation()
+    key = ssp_cache.ssp_cache_key(sp,0.1,3)
+    assert ssp_cache.ssp_cache_key(StellarPopulation(),0.1,3) == key
+    assert ssp_cache.ssp_cache_key(sp,0.2,3) != key
+    assert ssp_cache.ssp_cache_key(sp,0.1,4) != key
+
+    sp.params['dust1'] = 1.
+    assert ssp_cache.ssp_cache_key(sp,0.1,3) != key
+
+    sp = StellarPopulation()
+    sp.libraries = (b'padova',b'miles',b'DL07')
+    assert ssp_cache.ssp_cache_key(sp,0.1,3) != key
+
+
+def test_corrupt_entry_is_regenerated(cache_par):
+    sp = StellarPopulation()
+    spectrum = ssp_cache.get_spectrum(sp,tage=1.,zmet=2)
+    with open(cache_entry(sp,1.,2),'wb') as f:
+        f.write(b'truncated')
+
+    assert_same_spectrum(ssp_cache.get_spectrum(sp,tage=1.,zmet=2),spectrum)
+    assert sp.ncalls == 2
+    assert_same_spectrum(ssp_cache.get_spectrum(sp,tage=1.,zmet=2),spectrum)
+    assert sp.ncalls == 2
+
+
+def test_cache_off(par,tmp_path):
+    par.SSP_CACHE = False
+    par.SSP_CACHE_DIR = str(tmp_path)
+    sp = StellarPopulation()
+    ssp_cache.get_spectrum(sp,tage=1.,zmet=2)
+    ssp_cache.get_spectrum(sp,tage=1.,zmet=2)
+    assert sp.ncalls == 2
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+from powderday import ssp_grid
+from powderday.ssp_grid import SSPGrid,NebularGrid,save_ssp_library,load_ssp_library,needs_individual_sps
+
+
+class StellarPopulation:
+    #the FSPS data a grid is built on, and a library is checked against
+    def __init__(self,nz=3,nage=6,nlam=20,libraries=(b'mist',b'miles',b'DL07')):
+        self.zlegend = np.logspace(-3,-1.5,nz)
+        self.log_age = np.linspace(5.5,10.,nage)
+        self.wavelengths = np.linspace(100.,1.e4,nlam)
+        self.libraries = libraries
+        self.params = {}
+
+    def get_spectrum(self,tage=0,zmet=None):
+        #with tage=0, the spectra (and surviving masses) at every age
+        assert tage == 0 and not self.params['add_neb_emission']
+        self.stellar_mass = 1.-0.05*np.arange(len(self.log_age))-0.01*zmet
+        spec = np.outer(10.**-self.log_age,np.exp(-self.wavelengths/1.e3))*zmet
+        return self.wavelengths,spec
+
+
+def make_grid(sp):
+    rng = np.random.default_rng(0)
+    spectra = rng.random((len(sp.zlegend),len(sp.log_age),len(sp.wavelengths)))
+    stellar_mass = rng.uniform(0.5,1.,(len(sp.zlegend),len(sp.log_age)))
+    return SSPGrid(sp.wavelengths,sp.log_age,sp.zlegend,spectra,stellar_mass)
+
+
+def make_nebular_grid(sp):
+    rng = np.random.default_rng(1)
+    logu = np.array([-4.,-3.,-2.])
+    young = sp.log_age[:3]
+    spectra = rng.random((len(sp.zlegend),len(logu),len(young),len(sp.wavelengths)))
+    emline = rng.random((len(sp.zlegend),len(logu),len(young),4))
+    return NebularGrid(sp.wavelengths,young,sp.zlegend,logu,spectra,emline)
+
+
+@pytest.fixture
+def library_par(par,monkeypatch):
+    par.imf_type = 2
+    par.imf1,par.imf2,par.imf3 = 1.3,2.3,2.3
+    par.pagb = 1
+    par.add_agb_dust_model = True
+    monkeypatch.setattr(ssp_grid,'_ssp_libraries',{})
+    return par
+
+
+def test_interpolate():
+    sp = StellarPopulation()
+    grid = make_grid(sp)
+
+    #on the grid ages the grid spectra come back
+    age = 10.**sp.log_age/1.e9
+    fnu,mfrac = grid.interpolate(age,np.repeat(2,len(age)))
+    assert np.allclose(fnu,grid.spectra[1])
+    assert np.allclose(mfrac,grid.stellar_mass[1])
+
+    #linear in log age in between, and clipped to the grid
+    mid = 10.**((sp.log_age[1]+sp.log_age[2])/2.)/1.e9
+    fnu,mfrac = grid.interpolate([mid,1.e-9,1.e3],[3,1,1])
+    assert np.allclose(fnu[0],(grid.spectra[2,1]+grid.spectra[2,2])/2.)
+    assert np.allclose(fnu[1],grid.spectra[0,0])
+    assert np.allclose(fnu[2],grid.spectra[0,-1])
+
+
+def test_grid_from_fsps(library_par):
+    library_par.SSP_CACHE = False
+    sp = StellarPopulation()
+    grid = SSPGrid.from_fsps(sp)
+    assert sp.params['imf_type'] == 2 and sp.params['sfh'] == 0
+    assert grid.spectra.shape == (len(sp.zlegend),len(sp.log_age),len(sp.wavelengths))
+
+    for zmet in range(1,len(sp.zlegend)+1):
+        wav,spec = sp.get_spectrum(tage=0,zmet=zmet)
+        fnu,mfrac = grid.interpolate(10.**sp.log_age/1.e9,np.repeat(zmet,len(sp.log_age)))
+        assert np.allclose(fnu,spec)
+        assert np.allclose(mfrac,sp.stellar_mass)
+
+
+def test_library_roundtrip(library_par,tmp_path):
+    sp = StellarPopulation()
+    grid,nebular_grid = make_grid(sp),make_nebular_grid(sp)
+    filename = str(tmp_path/'library.h5')
+    save_ssp_library(filename,grid,sp.libraries,nebular_grid=nebular_grid)
+
+    loaded,loaded_nebular = load_ssp_library(filename,sp)
+    assert np.array_equal(loaded.spectra,grid.spectra)
+    assert np.array_equal(loaded.stellar_mass,grid.stellar_mass)
+    assert np.array_equal(loaded_nebular.spectra,nebular_grid.spectra)
+    assert np.array_equal(loaded_nebular.emline,nebular_grid.emline)
+
+    fnu,emline = loaded_nebular.interpolate(10.**sp.log_age[1]/1.e9,2,-3.)
+    assert np.allclose(fnu,nebular_grid.spectra[1,1,1])
+    assert np.allclose(emline,nebular_grid.emline[1,1,1])
+
+
+@pytest.mark.parametrize('other',[StellarPopulation(nz=4),StellarPopulation(nlam=21),StellarPopulation(nage=7),
+                                  StellarPopulation(libraries=(b'padova',b'miles',b'DL07'))])
+def test_library_of_other_fsps_data_is_not_used(library_par,tmp_path,other):
+    sp = StellarPopulation()
+    filename = str(tmp_path/'library.h5')
+    save_ssp_library(filename,make_grid(sp),sp.libraries)
+    assert load_ssp_library(filename,other) == (None,None)
+    assert load_ssp_library(filename,sp)[0] is not None
+
+
+def test_library_of_other_parameters_is_not_used(library_par,tmp_path):
+    sp = StellarPopulation()
+    filename = str(tmp_path/'library.h5')
+    save_ssp_library(filename,make_grid(sp),sp.libraries)
+    library_par.imf_type = 1
+    assert load_ssp_library(filename,sp) == (None,None)
+
+
+def test_needs_individual_sps(par):
+    par.CF_on = par.alpha_enhance = False
+    par.add_neb_emission,par.use_cloudy_tables,par.use_cmdf = True,True,False
+    par.add_pagb_stars,par.add_young_stars = False,True
+    par.HII_min_age,par.HII_max_age = 0.,5.e-3
+    par.PAGB_min_age,par.PAGB_max_age = 0.1,10.
+
+    age = np.array([1.e-3,8.e-3,1.e-2,0.5])
+    #(the cloudy lookup tables apply to every star up to 10 Myr,
+    #whatever the HII age range)
+    assert np.array_equal(needs_individual_sps(age),[True,True,True,False])
+
+    par.use_cloudy_tables = False
+    assert np.array_equal(needs_individual_sps(age),[True,False,False,False])
+
+    par.CF_on = True
+    assert np.all(needs_individual_sps(age))